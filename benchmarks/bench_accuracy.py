@@ -0,0 +1,155 @@
+"""Accuracy and speed of the faster detection modes, relative to the reference detection
+
+Run from the repository root, e.g.:
+    python benchmarks/bench_accuracy.py --images tests/data/inputs/*.npy
+and the report is written (as JSON) to stdout. Synthetic images are always included.
+"""
+
+import argparse
+import json
+import sys
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+
+from spotfishing import detect_spots_dog, detect_spots_int
+from spotfishing.accuracy import compare_detectors
+from spotfishing.prescreen import PreScreen
+from spotfishing_looptrace import ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+
+# The synthetic images are those of the tests.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "tests"))
+from helpers import (  # pylint: disable=wrong-import-position
+    SYNTHETIC_BACKGROUND,
+    budgeted_detector,
+    synthetic_spots_image,
+)
+
+SPEC = ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+
+
+def parse_cmdl(cmdl: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--images", nargs="*", type=Path, default=[], help="Real images (.npy)"
+    )
+    parser.add_argument("--dog-threshold", type=float, default=15)
+    parser.add_argument(
+        "--noisy-dog-threshold",
+        type=float,
+        default=6,
+        help="DoG threshold for the noisy synthetic image",
+    )
+    parser.add_argument("--int-threshold", type=float, default=300)
+    parser.add_argument("--max-distance", type=float, default=2)
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per timing")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for randomness")
+    return parser.parse_args(cmdl)
+
+
+def main(cmdl: list[str]) -> None:
+    opts = parse_cmdl(cmdl)
+    synthetic = {
+        "synthetic_dense": synthetic_spots_image(
+            (32, 512, 512), num_spots=500, seed=opts.seed
+        ),
+        "synthetic_sparse": synthetic_spots_image(
+            (32, 512, 512),
+            num_spots=50,
+            seed=opts.seed + 1,
+            spots_region=(32, 128, 128),
+        ),
+    }
+    noisy = {
+        "synthetic_noisy_sparse": synthetic_spots_image(
+            (32, 512, 512),
+            num_spots=50,
+            seed=opts.seed + 2,
+            spots_region=(32, 128, 128),
+            noise_sd=40,
+        ),
+    }
+    real = {path.stem: np.load(path) for path in opts.images}
+    reference_dog = partial(
+        detect_spots_dog,
+        spot_threshold=opts.dog_threshold,
+        expand_px=10,
+        transform=SPEC.transformation,
+    )
+    reference_int = partial(
+        detect_spots_int, spot_threshold=opts.int_threshold, expand_px=1
+    )
+
+    noisy_dog = partial(reference_dog, spot_threshold=opts.noisy_dog_threshold)
+    budgeted_corpus = {**synthetic, **real}
+    # The budgets are found for each image here, before any detection is timed.
+    budgeted = partial(
+        budgeted_detector,
+        reference_dog,
+        budgeted_corpus,
+        transform=SPEC.transformation,
+        expand_px=10,
+    )
+
+    # (mode, corpus, reference, candidate)
+    modes = [
+        (
+            "dog_tiled_float64",
+            budgeted_corpus,
+            reference_dog,
+            budgeted(precision=np.float64),
+        ),
+        (
+            "dog_tiled_float32",
+            budgeted_corpus,
+            reference_dog,
+            budgeted(precision=np.float32),
+        ),
+        (
+            # The signal floor is only known for the synthetic images.
+            "dog_prescreen",
+            synthetic,
+            reference_dog,
+            partial(
+                reference_dog,
+                prescreen=PreScreen(signal_floor=SYNTHETIC_BACKGROUND + 50),
+            ),
+        ),
+        (
+            # A low threshold on a noisy image makes plenty of noise pass the transform.
+            "dog_prescreen_noisy",
+            noisy,
+            noisy_dog,
+            partial(
+                noisy_dog,
+                prescreen=PreScreen(signal_floor=SYNTHETIC_BACKGROUND + 200),
+            ),
+        ),
+        (
+            "int_prescreen",
+            {**synthetic, **real},
+            reference_int,
+            partial(reference_int, prescreen=PreScreen()),
+        ),
+    ]
+    cases = []
+    for mode, corpus, reference, candidate in modes:
+        report = compare_detectors(
+            corpus,
+            reference=reference,
+            candidate=candidate,
+            mode=mode,
+            max_distance=opts.max_distance,
+            repeats=opts.repeats,
+        )
+        cases.extend(c.to_dict() for c in report.cases)
+    json.dump({"cases": cases}, sys.stdout, indent=2)
+    print("")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,108 @@
+"""Throughput of batched sub-pixel spot refinement, on a synthetic image
+
+Run from the repository root, e.g.:
+    python benchmarks/bench_refinement.py --num-spots 5000 --baseline-spots 200
+and the report is written (as JSON) to stdout.
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit
+
+from spotfishing.crops import extract_spot_crops
+from spotfishing.detection_result import DETECTION_RESULT_TABLE_COLUMNS
+from spotfishing.refinement import RefinementMethod, refine_spots
+
+# The synthetic images are those of the tests.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "tests"))
+from helpers import synthetic_spots  # pylint: disable=wrong-import-position
+
+BOX_SHAPE = (9, 9, 9)
+
+
+def parse_cmdl(cmdl: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--num-spots", type=int, default=5000, help="Spots to refine")
+    parser.add_argument(
+        "--baseline-spots",
+        type=int,
+        default=200,
+        help="Spots to fit one-by-one with scipy's curve_fit, for comparison; 0 to skip",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed for randomness")
+    return parser.parse_args(cmdl)
+
+
+def time_call(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def gaussian_model(coords, background, amplitude, z0, y0, x0, sigma_z, sigma_xy):
+    z, y, x = coords
+    return background + amplitude * np.exp(
+        -((z - z0) ** 2) / (2 * sigma_z**2)
+        - ((y - y0) ** 2 + (x - x0) ** 2) / (2 * sigma_xy**2)
+    )
+
+
+def fit_one_by_one(table: pd.DataFrame, image: np.ndarray) -> None:
+    crops = extract_spot_crops(table, image=image, box_shape=BOX_SHAPE)
+    coords = np.indices(BOX_SHAPE, dtype=float).reshape(3, -1)
+    for crop in crops.crops:
+        values = crop.ravel().astype(float)
+        guess = [values.min(), np.ptp(values), 4, 4, 4, 1.5, 1.5]
+        curve_fit(gaussian_model, coords, values, p0=guess, maxfev=2000)
+
+
+def main(cmdl: list[str]) -> None:
+    opts = parse_cmdl(cmdl)
+    side = int(np.ceil(np.sqrt(opts.num_spots))) * 12
+    centers, image = synthetic_spots(
+        (32, side, side),
+        num_spots=opts.num_spots,
+        seed=opts.seed,
+        amplitudes=1000,
+        noise_sd=5,
+        margin=(6, 6, 6),
+    )
+    table = pd.DataFrame(
+        [(*c, 1.0, 1.0) for c in np.round(centers)],
+        columns=DETECTION_RESULT_TABLE_COLUMNS,
+    )
+    report: dict[str, object] = {"num_spots": opts.num_spots, "box_shape": BOX_SHAPE}
+    for method in RefinementMethod:
+        seconds = time_call(
+            lambda m=method: refine_spots(
+                table, image=image, box_shape=BOX_SHAPE, method=m
+            )
+        )
+        report[method.value] = {
+            "seconds": seconds,
+            "spots_per_second": opts.num_spots / seconds,
+        }
+    if opts.baseline_spots > 0:
+        subset = table.iloc[: opts.baseline_spots]
+        seconds = time_call(lambda: fit_one_by_one(subset, image))
+        report["one_by_one_curve_fit"] = {
+            "num_spots": len(subset),
+            "seconds": seconds,
+            "spots_per_second": len(subset) / seconds,
+        }
+    json.dump(report, sys.stdout, indent=2)
+    print("")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,7 +1,12 @@
 """Package-level members"""
 
 from ._constants import ROI_MEAN_INTENSITY_KEY  # just for top-level availability
-from ._constants import ROI_AREA_KEY, ROI_MEAN_INTENSITY_KEY_CAMEL_CASE
+from ._constants import (
+    ROI_AREA_KEY,
+    ROI_MEAN_INTENSITY_KEY_CAMEL_CASE,
+    ROI_REGION_ID_KEY,
+    ROI_SCALE_KEY,
+)
 from ._exceptions import *
 from .detection_result import DetectionResult, RoiCenterKeys
 from .detectors import detect_spots_dog, detect_spots_int
@@ -13,8 +18,12 @@ __credits__ = ["Vince Reuter", "Kai Sandoval Beckwith"]
 __all__ = [
     "ROI_AREA_KEY",
     "ROI_MEAN_INTENSITY_KEY_CAMEL_CASE",  # Only export this (not the snake case one).
+    "ROI_REGION_ID_KEY",
+    "ROI_SCALE_KEY",
     "DifferenceOfGaussiansTransformation",
     "DimensionalityError",
+    "IncompleteWorkError",
+    "InsufficientMemoryBudgetError",
     "RoiCenterKeys",
     "DetectionResult",
     "detect_spots_dog",
@@ -8,6 +8,8 @@ __all__ = [
     "ROI_CENTROID_KEY",
     "ROI_MEAN_INTENSITY_KEY",  # Export this for package-internal use.
     "ROI_MEAN_INTENSITY_KEY_CAMEL_CASE",
+    "ROI_REGION_ID_KEY",
+    "ROI_SCALE_KEY",
 ]
 
 
@@ -21,3 +23,9 @@ ROI_CENTROID_KEY = "centroid_weighted"
 ROI_MEAN_INTENSITY_KEY = "intensity_mean"
 
 ROI_MEAN_INTENSITY_KEY_CAMEL_CASE = "intensityMean"
+
+# the key for the ID of the masked region (e.g., nucleus) in which an ROI lies, when detection is restricted by a mask
+ROI_REGION_ID_KEY = "regionId"
+
+# the key for the index of the scale at which an ROI was detected, when detection is at several scales
+ROI_SCALE_KEY = "scale"
@@ -5,8 +5,18 @@ __credits__ = ["Vince Reuter"]
 
 __all__ = [
     "DimensionalityError",
+    "IncompleteWorkError",
+    "InsufficientMemoryBudgetError",
 ]
 
 
 class DimensionalityError(Exception):
     """Error subtype when dimensionality of something isn't as expected"""
+
+
+class IncompleteWorkError(Exception):
+    """Error subtype for when results are requested before all units of work are done"""
+
+
+class InsufficientMemoryBudgetError(Exception):
+    """Error subtype for when no way of running a computation fits in the memory available"""
@@ -0,0 +1,91 @@
+"""Input checking, and the labelling and measurement of spots, shared by the detection procedures"""
+
+from typing import Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from scipy import ndimage as ndi
+from skimage.measure import regionprops_table
+from skimage.segmentation import expand_labels
+
+from ._constants import ROI_AREA_KEY, ROI_CENTROID_KEY, ROI_MEAN_INTENSITY_KEY
+from ._exceptions import DimensionalityError
+from ._types import NumpyFloat, NumpyInt, PixelValue
+from .detection_result import (
+    SKIMAGE_REGIONPROPS_TABLE_COLUMNS_EXPANDED,
+    SPOT_DETECTION_COLUMN_RENAMING,
+    DetectionResult,
+)
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter", "Kai Sandoval Beckwith"]
+
+Numeric = Union[int, float]
+
+
+def check_input_image(img: npt.NDArray[PixelValue]) -> None:
+    """Check that the image in which to detect spots is a 3D array."""
+    if not isinstance(img, np.ndarray):
+        raise TypeError(
+            f"Expected numpy array for input image but got {type(img).__name__}"
+        )
+    if img.ndim != 3:
+        raise DimensionalityError(
+            f"Expected 3D input image but got {img.ndim}-dimensional"
+        )
+
+
+def measure_spots(
+    *,
+    labels: npt.NDArray[NumpyInt],
+    input_image: npt.NDArray[PixelValue],
+    expand_px: Optional[Numeric],
+) -> tuple[pd.DataFrame, npt.NDArray[NumpyInt]]:
+    """Expand the labelled spots, and tabulate the centroid, area, and mean (input) intensity of each."""
+    if expand_px:
+        labels = expand_labels(labels, expand_px)  # type: ignore[no-untyped-call]
+    if np.all(labels == 0):
+        # No substructures (ROIs) exist.
+        spot_props = pd.DataFrame(columns=SKIMAGE_REGIONPROPS_TABLE_COLUMNS_EXPANDED)
+    else:
+        spot_props = pd.DataFrame(
+            regionprops_table(
+                label_image=labels,
+                intensity_image=input_image,
+                properties=(ROI_CENTROID_KEY, ROI_AREA_KEY, ROI_MEAN_INTENSITY_KEY),
+            )
+        )
+    spot_props = spot_props.rename(
+        columns=dict(SPOT_DETECTION_COLUMN_RENAMING),
+        inplace=False,
+        errors="raise",
+    )
+    spot_props = spot_props.reset_index(drop=True)
+    return spot_props, labels
+
+
+def detect_in_transformed(
+    img: npt.NDArray[NumpyFloat],
+    *,
+    input_image: npt.NDArray[PixelValue],
+    spot_threshold: Numeric,
+    expand_px: Optional[Numeric],
+) -> DetectionResult:
+    """Label each connected group of pixels of the transformed image above the threshold as a spot, and measure the spots in the input image.
+
+    As for all DoG-based detection, the image of the result is the transformed one.
+    """
+    labels, _ = ndi.label(img > spot_threshold)  # type: ignore[attr-defined]
+    table, labels = measure_spots(
+        labels=labels, input_image=input_image, expand_px=expand_px
+    )
+    return DetectionResult(table=table, image=img, labels=labels)  # type: ignore[arg-type]
+
+
+def empty_result(*, image: npt.NDArray[PixelValue]) -> DetectionResult:
+    """Result with no spots, for the given image"""
+    table, labels = measure_spots(
+        labels=np.zeros(image.shape, dtype=np.int32), input_image=image, expand_px=None
+    )
+    return DetectionResult(table=table, image=image, labels=labels)
@@ -0,0 +1,165 @@
+"""Piecewise application of image transformations, to regions of an image"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from typing import Iterable
+
+import numpy as np
+import numpy.typing as npt
+
+from ._types import NumpyFloat, PixelValue
+from .dog_transform import DifferenceOfGaussiansTransformation
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+# a rectangular region of a 3D image
+Region = tuple[slice, slice, slice]
+
+
+def pad_region(region: Region, *, padding: int, shape: tuple[int, ...]) -> Region:
+    """Grow the region by the padding on each side, staying within the given shape."""
+    return tuple(  # type: ignore[return-value]
+        slice(max(s.start - padding, 0), min(s.stop + padding, n))
+        for s, n in zip(region, shape)
+    )
+
+
+def relative_region(inner: Region, *, outer: Region) -> Region:
+    """Express the inner region in the coordinates of the outer region which contains it."""
+    return tuple(  # type: ignore[return-value]
+        slice(i.start - o.start, i.stop - o.start) for i, o in zip(inner, outer)
+    )
+
+
+def grid_regions(
+    shape: tuple[int, ...], *, block_shape: tuple[int, ...]
+) -> list[Region]:
+    """Partition an image of the given shape into blocks (smaller at the far edges) of the given shape, in C order."""
+    return [
+        (slice(z, z + block_shape[0]), slice(y, y + block_shape[1]), slice(x, x + block_shape[2]))  # type: ignore[misc]
+        for z in range(0, shape[0], block_shape[0])
+        for y in range(0, shape[1], block_shape[1])
+        for x in range(0, shape[2], block_shape[2])
+    ]
+
+
+def transform_region(
+    transform: DifferenceOfGaussiansTransformation,
+    image: npt.NDArray[PixelValue],
+    *,
+    region: Region,
+) -> npt.NDArray[NumpyFloat]:
+    """Compute the (unstandardised) transformation of one region of the image, as if the whole image had been transformed.
+
+    The region is transformed with the transformation's support radius of surrounding
+    context, and the context is then cropped away.
+    """
+    if transform.standardise:
+        transform = replace(transform, standardise=False)
+    padded = pad_region(
+        region, padding=transform.effective_support_radius, shape=image.shape
+    )
+    values = transform(image[padded])
+    return values[relative_region(region, outer=padded)]  # type: ignore[no-any-return]
+
+
+def transform_regions(
+    transform: DifferenceOfGaussiansTransformation,
+    image: npt.NDArray[PixelValue],
+    *,
+    regions: Iterable[Region],
+    out: npt.NDArray[NumpyFloat],
+    workers: int = 1,
+) -> None:
+    """Write the (unstandardised) transformation of each region of the image into the output.
+
+    Each region is transformed with enough surrounding context (the transformation's
+    support radius) that the values written for the region are as if the whole image
+    had been transformed. Standardisation is global, so it's never applied here; see
+    standardise_in_place. With more than one worker, regions are transformed in
+    concurrent threads (the filters release the GIL), so the regions should then be
+    disjoint.
+    """
+    unstandardised = replace(transform, standardise=False)
+
+    def transform_one(region: Region) -> None:
+        out[region] = transform_region(unstandardised, image, region=region)
+
+    if workers == 1:
+        for region in regions:
+            transform_one(region)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Consume the results, to propagate any exception.
+            for _ in pool.map(transform_one, regions):
+                pass
+
+
+def standardise_in_place(img: npt.NDArray[NumpyFloat]) -> None:
+    """Shift and scale the image to mean 0 and standard deviation 1, unless it's constant.
+
+    Statistics are accumulated (at double precision) one z-slice at a time, so no
+    temporary array the size of the image is needed.
+    """
+    if img.size == 0:
+        return
+    total = sum(float(np.sum(plane, dtype=np.float64)) for plane in img)
+    mean = total / img.size
+    sq_dev = sum(float(np.sum((plane.astype(np.float64) - mean) ** 2)) for plane in img)
+    std = np.sqrt(sq_dev / img.size)
+    for plane in img:
+        plane -= mean
+        if std > 0:
+            plane /= std
+
+
+def merge_overlapping_regions(regions: Iterable[Region]) -> list[Region]:
+    """Replace each group of overlapping (or touching) regions by its bounding box, until the regions are disjoint."""
+    merged = list(regions)
+    changed = True
+    while changed:
+        changed = False
+        result: list[Region] = []
+        for region in merged:
+            for i, other in enumerate(result):
+                if all(
+                    r.start <= o.stop and o.start <= r.stop
+                    for r, o in zip(region, other)
+                ):
+                    result[i] = tuple(  # type: ignore[assignment]
+                        slice(min(r.start, o.start), max(r.stop, o.stop))
+                        for r, o in zip(region, other)
+                    )
+                    changed = True
+                    break
+            else:
+                result.append(region)
+        merged = result
+    return merged
+
+
+def region_statistics(
+    img: npt.NDArray[NumpyFloat], *, regions: list[Region]
+) -> tuple[float, float]:
+    """Mean and standard deviation of the values of the disjoint regions of the image, over all of them together (both 0 if there are no values)."""
+    num_pixels = sum(img[r].size for r in regions)
+    if num_pixels == 0:
+        return 0.0, 0.0
+    mean = sum(float(np.sum(img[r], dtype=np.float64)) for r in regions) / num_pixels
+    sq_dev = sum(
+        float(np.sum((img[r].astype(np.float64) - mean) ** 2)) for r in regions
+    )
+    return mean, float(np.sqrt(sq_dev / num_pixels))
+
+
+def standardise_regions_in_place(
+    img: npt.NDArray[NumpyFloat], *, regions: list[Region]
+) -> None:
+    """Shift and scale the disjoint regions of the image to mean 0 and standard deviation 1 over all of them together, unless they're constant."""
+    mean, std = region_statistics(img, regions=regions)
+    for region in regions:
+        values = img[region]
+        np.subtract(values, mean, out=values)
+        if std > 0:
+            np.divide(values, std, out=values)
@@ -0,0 +1,327 @@
+"""Measurement of the accuracy and speed of a detection mode, relative to a reference"""
+
+import json
+import math
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Mapping, Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+from scipy.spatial import cKDTree
+
+from ._exceptions import DimensionalityError
+from ._types import PixelValue
+from .detection_result import DetectionResult
+from .roi_tools import get_centroids_array
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = [
+    "AccuracyReport",
+    "AccuracyThresholds",
+    "CaseReport",
+    "SpotMatching",
+    "compare_detectors",
+    "match_spots",
+]
+
+Numeric = Union[int, float]
+
+VoxelSize = tuple[Numeric, Numeric, Numeric]
+
+Detector = Callable[[npt.NDArray[PixelValue]], DetectionResult]
+
+
+@doc(
+    summary="One-to-one pairing of candidate spots with reference spots",
+    parameters=dict(
+        reference_indices="Index (into the reference spots) of each matched pair",
+        candidate_indices="Index (into the candidate spots) of each matched pair",
+        distances="Distance between the centroids of each matched pair, in physical units",
+        num_reference="Total number of reference spots",
+        num_candidate="Total number of candidate spots",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class SpotMatching:  # pylint: disable=missing-class-docstring
+    reference_indices: npt.NDArray[np.intp]
+    candidate_indices: npt.NDArray[np.intp]
+    distances: npt.NDArray[np.float64]
+    num_reference: int
+    num_candidate: int
+
+    @property
+    def num_matched(self) -> int:
+        """Number of matched pairs"""
+        return len(self.distances)
+
+    @property
+    def recall(self) -> float:
+        """Fraction of reference spots which are matched; 1 if there's no reference spot"""
+        return self.num_matched / self.num_reference if self.num_reference else 1.0
+
+    @property
+    def precision(self) -> float:
+        """Fraction of candidate spots which are matched; 1 if there's no candidate spot"""
+        return self.num_matched / self.num_candidate if self.num_candidate else 1.0
+
+
+@doc(
+    summary="Pair candidate spots one-to-one with reference spots, by centroid distance.",
+    extended_summary="""
+        All pairs within the maximum distance are considered in order of increasing
+        distance (ties broken by reference index, then candidate index), and a pair is
+        accepted if neither of its spots is already matched. This greedy assignment is
+        the usual one for spot detection benchmarks; when spots are farther apart than
+        twice the maximum distance, as they are for any sensible choice of it, the
+        result is the same as an optimal assignment.
+    """,
+    parameters=dict(
+        reference="Array of (z, y, x) centroids of the reference spots, in pixel units",
+        candidate="Array of (z, y, x) centroids of the candidate spots, in pixel units",
+        max_distance="Greatest distance (in physical units) between the centroids of matched spots",
+        voxel_size="Physical size of a voxel along each of (z, y, x)",
+    ),
+    raises=dict(
+        DimensionalityError="If either collection of centroids isn't an (N, 3) array",
+        ValueError="If the maximum distance is negative, or any component of the voxel size isn't strictly positive",
+    ),
+    returns="The matched pairs, in order of increasing distance",
+)
+def match_spots(  # pylint: disable=missing-function-docstring
+    reference: npt.NDArray[np.float64],
+    candidate: npt.NDArray[np.float64],
+    *,
+    max_distance: Numeric,
+    voxel_size: VoxelSize = (1, 1, 1),
+) -> SpotMatching:
+    for name, points in [("Reference", reference), ("Candidate", candidate)]:
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise DimensionalityError(
+                f"{name} centroids must be an (N, 3) array; got shape {points.shape}"
+            )
+    if max_distance < 0:
+        raise ValueError(f"Maximum distance must be nonnegative; got {max_distance}")
+    scale = np.asarray(voxel_size, dtype=np.float64)
+    if scale.shape != (3,) or np.any(scale <= 0):
+        raise ValueError(
+            f"Voxel size must be 3 strictly positive values; got {voxel_size}"
+        )
+    pairs = cKDTree(reference * scale).sparse_distance_matrix(
+        cKDTree(candidate * scale), max_distance, output_type="ndarray"
+    )
+    accepted_pairs = _accept_greedily(
+        pairs, num_reference=len(reference), num_candidate=len(candidate)
+    )
+    return SpotMatching(
+        reference_indices=accepted_pairs["i"].astype(np.intp),
+        candidate_indices=accepted_pairs["j"].astype(np.intp),
+        distances=accepted_pairs["v"].astype(np.float64),
+        num_reference=len(reference),
+        num_candidate=len(candidate),
+    )
+
+
+@doc(
+    summary="Accuracy and speed of a detection mode on one image, relative to the reference",
+    parameters=dict(
+        case="Name of the image",
+        mode="Name of the detection mode",
+        num_reference="Number of spots found by the reference",
+        num_candidate="Number of spots found by the mode",
+        num_matched="Number of spots found by the mode which match a reference spot",
+        recall="Fraction of reference spots which the mode found",
+        precision="Fraction of the mode's spots which match a reference spot",
+        mean_centroid_error="Mean distance between matched centroids (physical units), or null if nothing matched",
+        max_centroid_error="Greatest distance between matched centroids (physical units), or null if nothing matched",
+        reference_seconds="Fastest time taken by the reference, over the repeats",
+        candidate_seconds="Fastest time taken by the mode, over the repeats",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class CaseReport:  # pylint: disable=missing-class-docstring,too-many-instance-attributes
+    case: str
+    mode: str
+    num_reference: int
+    num_candidate: int
+    num_matched: int
+    recall: float
+    precision: float
+    mean_centroid_error: Optional[float]
+    max_centroid_error: Optional[float]
+    reference_seconds: float
+    candidate_seconds: float
+
+    @property
+    def speedup(self) -> float:
+        """Ratio of the reference's time to the mode's time"""
+        return (
+            self.reference_seconds / self.candidate_seconds
+            if self.candidate_seconds > 0
+            else math.inf
+        )
+
+    def to_dict(self) -> dict[str, object]:
+        """Plain mapping of the report's values (including the speedup), e.g. for JSON"""
+        return {**asdict(self), "speedup": self.speedup}
+
+
+@doc(
+    summary="Minimum accuracy (and optionally speed) demanded of a detection mode",
+    parameters=dict(
+        min_recall="Least acceptable recall",
+        min_precision="Least acceptable precision",
+        max_centroid_error="Greatest acceptable mean centroid error, in physical units",
+        min_speedup="Least acceptable speedup, or null to not demand any",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class AccuracyThresholds:  # pylint: disable=missing-class-docstring
+    min_recall: float = 1.0
+    min_precision: float = 1.0
+    max_centroid_error: float = 0.0
+    min_speedup: Optional[float] = None
+
+    def violations(self, report: CaseReport) -> list[str]:
+        """Describe each way in which the report falls short of these thresholds."""
+        prefix = f"{report.mode} on {report.case}"
+        problems = []
+        if report.recall < self.min_recall:
+            problems.append(f"{prefix}: recall {report.recall:.4f} < {self.min_recall}")
+        if report.precision < self.min_precision:
+            problems.append(
+                f"{prefix}: precision {report.precision:.4f} < {self.min_precision}"
+            )
+        if (
+            report.mean_centroid_error is not None
+            and report.mean_centroid_error > self.max_centroid_error
+        ):
+            problems.append(
+                f"{prefix}: mean centroid error {report.mean_centroid_error:.4g} > {self.max_centroid_error}"
+            )
+        if self.min_speedup is not None and report.speedup < self.min_speedup:
+            problems.append(
+                f"{prefix}: speedup {report.speedup:.3f} < {self.min_speedup}"
+            )
+        return problems
+
+
+@doc(
+    summary="Accuracy and speed of a detection mode over a corpus of images",
+    parameters=dict(
+        cases="Report for each image of the corpus, in order",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class AccuracyReport:  # pylint: disable=missing-class-docstring
+    cases: tuple[CaseReport, ...]
+
+    def violations(self, thresholds: AccuracyThresholds) -> list[str]:
+        """Describe each way in which any case falls short of the given thresholds."""
+        return [v for c in self.cases for v in thresholds.violations(c)]
+
+    def to_frame(self) -> pd.DataFrame:
+        """Table with one row per case"""
+        return pd.DataFrame([c.to_dict() for c in self.cases])
+
+    def to_json(self, **kwargs: object) -> str:
+        """Serialise the report as JSON (an object with a list of cases), passing along keyword arguments to json.dumps."""
+        return json.dumps({"cases": [c.to_dict() for c in self.cases]}, **kwargs)  # type: ignore[arg-type]
+
+
+@doc(
+    summary="Run a detection mode and the reference on each image, and compare the results.",
+    extended_summary="""
+        Each detector is run on each image the given number of times, and the fastest
+        run is the one timed; the results of the last run are compared, by matching
+        spots by centroid distance (see match_spots). The detectors should be
+        deterministic, so that which run is compared doesn't matter.
+    """,
+    parameters=dict(
+        corpus="Images on which to compare detection, by name",
+        reference="Detection to treat as ground truth, e.g. detect_spots_dog with fixed settings",
+        candidate="Detection to assess, e.g. the reference with a faster option turned on",
+        mode="Name of the candidate detection mode, for the report",
+        max_distance="Greatest distance (in physical units) between the centroids of matched spots",
+        voxel_size="Physical size of a voxel along each of (z, y, x)",
+        repeats="Number of times to run each detector on each image, for timing",
+    ),
+    raises=dict(
+        ValueError="If the number of repeats isn't positive",
+    ),
+    returns="Report of accuracy and speed of the candidate, for each image",
+)
+def compare_detectors(  # pylint: disable=missing-function-docstring,too-many-arguments,too-many-locals
+    corpus: Mapping[str, npt.NDArray[PixelValue]],
+    *,
+    reference: Detector,
+    candidate: Detector,
+    mode: str,
+    max_distance: Numeric,
+    voxel_size: VoxelSize = (1, 1, 1),
+    repeats: int = 1,
+) -> AccuracyReport:
+    if repeats < 1:
+        raise ValueError(f"Number of repeats must be positive; got {repeats}")
+    cases = []
+    for name, image in corpus.items():
+        expected, reference_seconds = _time_detection(reference, image, repeats)
+        observed, candidate_seconds = _time_detection(candidate, image, repeats)
+        matching = match_spots(
+            get_centroids_array(expected),
+            get_centroids_array(observed),
+            max_distance=max_distance,
+            voxel_size=voxel_size,
+        )
+        has_matches = matching.num_matched > 0
+        cases.append(
+            CaseReport(
+                case=name,
+                mode=mode,
+                num_reference=matching.num_reference,
+                num_candidate=matching.num_candidate,
+                num_matched=matching.num_matched,
+                recall=matching.recall,
+                precision=matching.precision,
+                mean_centroid_error=(
+                    float(matching.distances.mean()) if has_matches else None
+                ),
+                max_centroid_error=(
+                    float(matching.distances.max()) if has_matches else None
+                ),
+                reference_seconds=reference_seconds,
+                candidate_seconds=candidate_seconds,
+            )
+        )
+    return AccuracyReport(cases=tuple(cases))
+
+
+def _accept_greedily(
+    pairs: npt.NDArray[np.void], *, num_reference: int, num_candidate: int
+) -> npt.NDArray[np.void]:
+    """Accept candidate pairs (i, j, v) in order of increasing distance, skipping any pair with a point already matched."""
+    order = np.lexsort((pairs["j"], pairs["i"], pairs["v"]))
+    ref_used = np.zeros(num_reference, dtype=bool)
+    cand_used = np.zeros(num_candidate, dtype=bool)
+    accepted = []
+    for k in order:
+        i, j = pairs["i"][k], pairs["j"][k]
+        if not (ref_used[i] or cand_used[j]):
+            ref_used[i] = cand_used[j] = True
+            accepted.append(k)
+    return pairs[np.array(accepted, dtype=np.intp)]
+
+
+def _time_detection(
+    detect: Detector, image: npt.NDArray[PixelValue], repeats: int
+) -> tuple[DetectionResult, float]:
+    fastest = math.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = detect(image)
+        fastest = min(fastest, time.perf_counter() - start)
+    return result, fastest
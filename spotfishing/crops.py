@@ -0,0 +1,140 @@
+"""Extraction of fixed-size, spot-centred boxes from an image, in bulk"""
+
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+
+from ._exceptions import DimensionalityError
+from ._types import PixelValue
+from .detection_result import DetectionResult
+from .roi_tools import SpotsTable, get_centroids_array
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = ["SpotCrops", "extract_spot_crops"]
+
+Numeric = Union[int, float]
+
+BoxShape = tuple[int, int, int]
+
+# default number of spots for which to gather crops at once, to bound temporaries
+DEFAULT_SPOTS_PER_CHUNK = 1024
+
+
+@doc(
+    summary="Bundle of spot-centred crops of an image",
+    parameters=dict(
+        crops="(N, dz, dy, dx) array, with one box-shaped crop per spot",
+        valid="Boolean array of the same shape as the crops, flagging the voxels which come from the image (rather than being filled in beyond its border)",
+        origins="(N, 3) array with the image coordinates of each crop's first voxel; these may be negative, or beyond the image, for a spot near the border",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class SpotCrops:  # pylint: disable=missing-class-docstring
+    crops: npt.NDArray[np.generic]
+    valid: npt.NDArray[np.bool_]
+    origins: npt.NDArray[np.int64]
+
+    def __len__(self) -> int:
+        return self.crops.shape[0]
+
+    @property
+    def complete(self) -> npt.NDArray[np.bool_]:
+        """For each spot, whether its crop lies entirely within the image"""
+        return self.valid.all(axis=(1, 2, 3))  # type: ignore[no-any-return]
+
+
+@doc(
+    summary="Crop a fixed-size box around every spot, into one contiguous array.",
+    extended_summary="""
+        Each box is centred on the voxel nearest to the spot's centroid; for an even
+        box side length, the extra voxel goes before the centre. Crops are gathered
+        by vectorised fancy indexing, a chunk of spots at a time, directly into a
+        single preallocated output array, so this works on memory-mapped images
+        without reading the whole image into memory.
+    """,
+    parameters=dict(
+        data="Detection result, or table of detected spots",
+        box_shape="Side lengths (dz, dy, dx) of the box to crop around each spot",
+        image="Image from which to crop; if omitted, the image of the detection result is used (note that this is the transformed image, for detection by difference of Gaussians)",
+        fill_value="Value for the part of a crop which lies beyond the image",
+        spots_per_chunk="Number of spots for which to gather crops at once",
+    ),
+    raises=dict(
+        DimensionalityError="If the image isn't 3D",
+        ValueError="If the box shape isn't 3 positive integers, if the number of spots per chunk isn't positive, or if no image is available",
+    ),
+    returns="The crops, with validity mask and crop origins, in the order of the table's rows",
+)
+def extract_spot_crops(  # pylint: disable=missing-function-docstring
+    data: SpotsTable,
+    *,
+    box_shape: BoxShape,
+    image: Optional[npt.NDArray[PixelValue]] = None,
+    fill_value: Numeric = 0,
+    spots_per_chunk: int = DEFAULT_SPOTS_PER_CHUNK,
+) -> SpotCrops:
+    if image is None:
+        if not isinstance(data, DetectionResult):
+            raise ValueError("An image is required to crop spots from a table")
+        image = data.image
+    if image.ndim != 3:
+        raise DimensionalityError(
+            f"Expected 3D image from which to crop spots but got {image.ndim}-dimensional"
+        )
+    if len(box_shape) != 3 or any(int(s) != s or s < 1 for s in box_shape):
+        raise ValueError(f"Box shape must be 3 positive integers; got {box_shape}")
+    if spots_per_chunk < 1:
+        raise ValueError(
+            f"Number of spots per chunk must be positive; got {spots_per_chunk}"
+        )
+    return extract_crops_at(
+        image,
+        centers=get_centroids_array(data),
+        box_shape=box_shape,
+        fill_value=fill_value,
+        spots_per_chunk=spots_per_chunk,
+    )
+
+
+def extract_crops_at(  # pylint: disable=too-many-locals
+    image: npt.NDArray[PixelValue],
+    *,
+    centers: npt.NDArray[np.float64],
+    box_shape: BoxShape,
+    fill_value: Numeric,
+    spots_per_chunk: int,
+) -> SpotCrops:
+    """Crop boxes of the given shape around the given (z, y, x) centers, assumed validated."""
+    box = np.asarray(box_shape, dtype=np.int64)
+    origins = np.floor(centers + 0.5).astype(np.int64) - box // 2
+    num_spots = origins.shape[0]
+    crops = np.empty(
+        (num_spots, *box_shape), dtype=np.result_type(image.dtype, fill_value)
+    )
+    valid = np.empty((num_spots, *box_shape), dtype=bool)
+    offsets = [np.arange(n, dtype=np.int64) for n in box_shape]
+    bounds = image.shape
+    for start in range(0, num_spots, spots_per_chunk):
+        chunk = slice(start, start + spots_per_chunk)
+        # Per-axis indices (spots x side length), clipped into the image for gathering.
+        indices = [origins[chunk, i, None] + offsets[i] for i in range(3)]
+        in_bounds = [(idx >= 0) & (idx < n) for idx, n in zip(indices, bounds)]
+        clipped = [np.clip(idx, 0, n - 1) for idx, n in zip(indices, bounds)]
+        gathered = image[
+            clipped[0][:, :, None, None],
+            clipped[1][:, None, :, None],
+            clipped[2][:, None, None, :],
+        ]
+        inside = (
+            in_bounds[0][:, :, None, None]
+            & in_bounds[1][:, None, :, None]
+            & in_bounds[2][:, None, None, :]
+        )
+        valid[chunk] = inside
+        crops[chunk] = np.where(inside, gathered, fill_value)
+    return SpotCrops(crops=crops, valid=valid, origins=origins)
@@ -15,6 +15,8 @@ from ._constants import (
     ROI_CENTROID_KEY,
     ROI_MEAN_INTENSITY_KEY,
     ROI_MEAN_INTENSITY_KEY_CAMEL_CASE,
+    ROI_REGION_ID_KEY,
+    ROI_SCALE_KEY,
 )
 from ._exceptions import DimensionalityError
 from ._types import NumpyInt, PixelValue
@@ -51,6 +53,9 @@ SKIMAGE_REGIONPROPS_TABLE_COLUMNS_EXPANDED = [
 # the expected column names in a detection result table, after extraction and renaming
 DETECTION_RESULT_TABLE_COLUMNS = [new for _, new in SPOT_DETECTION_COLUMN_RENAMING]
 
+# the columns which a detection result table may have after the expected ones, depending on detection options, in this order
+OPTIONAL_DETECTION_RESULT_TABLE_COLUMNS = [ROI_REGION_ID_KEY, ROI_SCALE_KEY]
+
 
 @doc(
     summary="The result of applying spot detection to an input image",
@@ -70,7 +75,7 @@ class DetectionResult:  # pylint: disable=missing-class-docstring
         """Validate that the structure and values of the inputs are as required."""
         errors: list[Exception] = []
         cols = list(self.table.columns)
-        if cols != DETECTION_RESULT_TABLE_COLUMNS:
+        if not _are_legal_table_columns(cols):
             errors.append(IllegalDetectionResultTableColumns(observed_columns=cols))
         if self.image.ndim != 3:
             errors.append(
@@ -101,5 +106,13 @@ class IllegalDetectionResultTableColumns(Exception):
 
     def __init__(self, *, observed_columns: list[str]) -> None:
         super().__init__(
-            f"Table columns don't match expectation: {observed_columns} != {DETECTION_RESULT_TABLE_COLUMNS}"
+            f"Table columns don't match expectation: {observed_columns} != {DETECTION_RESULT_TABLE_COLUMNS} (optionally followed by some of {OPTIONAL_DETECTION_RESULT_TABLE_COLUMNS}, in that order)"
         )
+
+
+def _are_legal_table_columns(cols: list[str]) -> bool:
+    num_expected = len(DETECTION_RESULT_TABLE_COLUMNS)
+    expected, extra = cols[:num_expected], cols[num_expected:]
+    return expected == DETECTION_RESULT_TABLE_COLUMNS and extra == [
+        c for c in OPTIONAL_DETECTION_RESULT_TABLE_COLUMNS if c in extra
+    ]
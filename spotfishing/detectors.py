@@ -1,27 +1,42 @@
 """Different spot detection implementations"""
 
 from dataclasses import dataclass
-from typing import Optional, Tuple, Union
+from typing import Callable, Optional, Union
 
 import numpy as np
 import numpy.typing as npt
 import pandas as pd
 from numpydoc_decorator import doc  # type: ignore[import-untyped]
 from scipy import ndimage as ndi
-from skimage.measure import regionprops_table
 from skimage.morphology import remove_small_objects
-from skimage.segmentation import expand_labels
 from typing_extensions import Annotated, Doc
 
-from ._constants import ROI_AREA_KEY, ROI_CENTROID_KEY, ROI_MEAN_INTENSITY_KEY
-from ._exceptions import DimensionalityError
-from ._types import NumpyInt, PixelValue
+from ._constants import ROI_REGION_ID_KEY
+from ._exceptions import InsufficientMemoryBudgetError
+from ._measurement import (
+    check_input_image,
+    detect_in_transformed,
+    empty_result,
+    measure_spots,
+)
+from ._tiling import (
+    Region,
+    merge_overlapping_regions,
+    pad_region,
+    region_statistics,
+    standardise_in_place,
+    standardise_regions_in_place,
+    transform_regions,
+)
+from ._types import NumpyFloat, NumpyInt, PixelValue
 from .detection_result import (
-    SKIMAGE_REGIONPROPS_TABLE_COLUMNS_EXPANDED,
-    SPOT_DETECTION_COLUMN_RENAMING,
+    DETECTION_RESULT_TABLE_COLUMNS,
     DetectionResult,
+    RoiCenterKeys,
 )
 from .dog_transform import DifferenceOfGaussiansTransformation
+from .memory_planner import plan_detection
+from .prescreen import PreScreen, find_candidate_regions
 
 __author__ = "Vince Reuter"
 __credits__ = ["Vince Reuter", "Kai Sandoval Beckwith"]
@@ -30,6 +45,9 @@ __all__ = ["detect_spots_dog", "detect_spots_int"]
 
 Numeric = Union[int, float]
 
+# how far beyond a masked region's bounding box to begin detecting (beyond the reach of expansion), and the step by which to grow the box while spots reach its edge
+MASK_REGION_PADDING_PX = 4
+
 
 @doc(summary="Parameter descriptions common to various spot detection procedures")
 @dataclass(frozen=True)
@@ -45,6 +63,24 @@ class detection_signature:  # pylint: disable=invalid-name,missing-class-docstri
         Optional[Numeric],
         Doc("The number of pixels by which to expand a detected and defined region"),
     ]
+    prescreen = Annotated[
+        Optional[PreScreen],
+        Doc(
+            "Parameters for cheap screening of the image for regions which may contain spots, so that the expensive part of detection is done only there; no screening if omitted"
+        ),
+    ]
+    memory_budget = Annotated[
+        Optional[int],
+        Doc(
+            "Number of bytes available to detection; if given, detection is run in the most precise way which is estimated to fit (see memory_planner.plan_detection), which for DoG-based detection may mean transforming the image tile by tile and at reduced precision. This can't be combined with pre-screening or masking."
+        ),
+    ]
+    mask = Annotated[
+        Optional[npt.NDArray[Union[np.bool_, NumpyInt]]],
+        Doc(
+            "Boolean mask or label image (0 for background) of the same shape as the image, e.g. segmented nuclei, to which to restrict detection; each region of a label image is a positive label, and each region of a boolean mask is a connected group of true pixels. Detection is done only within each region's bounding box, padded (by MASK_REGION_PADDING_PX, plus a margin for the expansion) and then grown until no spot comes within reach of its edge, so that no spot is cut off by a box; only spots whose centroid lies in a region are kept, tagged (in a regionId column) with the ID of that region."
+        ),
+    ]
     result = Annotated[
         DetectionResult,
         Doc(
@@ -55,11 +91,20 @@ class detection_signature:  # pylint: disable=invalid-name,missing-class-docstri
 
 @doc(
     summary="Detect spots by difference of Gaussians filter.",
+    extended_summary="""
+        When detection is restricted to regions of the image--the candidate regions of
+        pre-screening, or the boxes around the regions of a mask--the transformation is
+        computed only within those regions, and the transformed image is 0 elsewhere.
+        Standardisation is then by the mean and standard deviation of the transformed
+        image over the regions together, as the rest of the image isn't transformed.
+    """,
     parameters=dict(
         transform="The subtraction-after-smoothing parameterisation that defined DoG",
     ),
     raises=dict(
         TypeError="If the given `transform` isn't specifically a `DifferenceOfGaussiansTransformation`",
+        ValueError="If pre-screening is requested without a signal floor, or if any two of pre-screening, a mask, and a memory budget are given, or if the mask is invalid",
+        InsufficientMemoryBudgetError="If a memory budget is given, and no way of running detection is estimated to fit",
     ),
 )
 def detect_spots_dog(  # pylint: disable=missing-function-docstring
@@ -68,26 +113,71 @@ def detect_spots_dog(  # pylint: disable=missing-function-docstring
     spot_threshold: detection_signature.threshold,
     expand_px: detection_signature.expand_px,
     transform: DifferenceOfGaussiansTransformation,
+    prescreen: detection_signature.prescreen = None,
+    memory_budget: detection_signature.memory_budget = None,
+    mask: detection_signature.mask = None,
 ) -> detection_signature.result:
     # TODO: consider replacing by something from scikit-image.
     # See: https://github.com/gerlichlab/spotfishing/issues/5
-    _check_input_image(input_image)
+    check_input_image(input_image)
     if not isinstance(transform, DifferenceOfGaussiansTransformation):
         raise TypeError(
             f"For DoG-based detection, the transformation must be of type {DifferenceOfGaussiansTransformation.__name__}; got {type(transform).__name__}"
         )
-    img = transform(input_image)
-    labels, _ = ndi.label(img > spot_threshold)  # type: ignore[attr-defined]
-    spot_props, labels = _build_props_table(
-        labels=labels, input_image=input_image, expand_px=expand_px
+    _check_exclusive_options(
+        prescreen=prescreen, mask=mask, memory_budget=memory_budget
+    )
+    if mask is not None:
+        return _detect_within_mask(
+            input_image,
+            mask=mask,
+            spot_threshold=spot_threshold,
+            expand_px=expand_px,
+            transform=transform,
+        )
+    if prescreen is None and memory_budget is None:
+        img = transform(input_image)
+    elif prescreen is None:
+        img = _transform_within_budget(
+            input_image,
+            transform=transform,
+            memory_budget=memory_budget,  # type: ignore[arg-type]
+            expand_px=expand_px,
+        )
+    else:
+        if prescreen.signal_floor is None:
+            raise ValueError(
+                "Pre-screening for DoG-based detection requires a signal floor"
+            )
+        # The regions are made disjoint, so that each pixel counts once in their statistics.
+        regions = merge_overlapping_regions(
+            find_candidate_regions(
+                input_image,
+                block_shape=prescreen.block_shape,
+                signal_floor=prescreen.signal_floor,
+            )
+        )
+        # Outside the candidate regions, the response is taken to be flat (0).
+        img = np.zeros(input_image.shape, dtype=np.float64)
+        if not regions:
+            return empty_result(image=img)
+        transform_regions(transform, input_image, regions=regions, out=img)
+        if transform.standardise:
+            standardise_regions_in_place(img, regions=regions)
+    return detect_in_transformed(
+        img,
+        input_image=input_image,
+        spot_threshold=spot_threshold,
+        expand_px=expand_px,
     )
-    return DetectionResult(table=spot_props, image=img, labels=labels)
 
 
 @doc(
     summary="Detect spots by a simply pixel value threshold.",
     raises=dict(
         TypeError="If the given `transform` isn't specifically a `DifferenceOfGaussiansTransformation`",
+        ValueError="If any two of pre-screening, a mask, and a memory budget are given, or if the mask is invalid",
+        InsufficientMemoryBudgetError="If a memory budget is given, and detection is estimated not to fit",
     ),
 )
 def detect_spots_int(  # pylint: disable=missing-function-docstring
@@ -95,53 +185,288 @@ def detect_spots_int(  # pylint: disable=missing-function-docstring
     *,
     spot_threshold: detection_signature.threshold,
     expand_px: detection_signature.expand_px,
+    prescreen: detection_signature.prescreen = None,
+    mask: detection_signature.mask = None,
+    memory_budget: detection_signature.memory_budget = None,
 ) -> detection_signature.result:
-    _check_input_image(input_image)
-    binary = input_image > spot_threshold
-    binary = ndi.binary_fill_holes(binary)  # type: ignore[attr-defined]
+    check_input_image(input_image)
+    _check_exclusive_options(
+        prescreen=prescreen, mask=mask, memory_budget=memory_budget
+    )
+    if memory_budget is not None and input_image.size > 0:
+        plan = plan_detection(
+            input_image.shape,
+            input_image.dtype,
+            transform=None,
+            memory_budget=memory_budget,
+            expand_px=expand_px,
+        )
+        if not plan.fits:
+            raise InsufficientMemoryBudgetError(
+                f"Detection is estimated not to fit in the memory budget:\n{plan.report()}"
+            )
+    if mask is not None:
+        return _detect_within_mask(
+            input_image,
+            mask=mask,
+            spot_threshold=spot_threshold,
+            expand_px=expand_px,
+            transform=None,
+        )
+    if prescreen is None:
+        binary = input_image > spot_threshold
+        binary = ndi.binary_fill_holes(binary)  # type: ignore[attr-defined]
+    else:
+        regions = find_candidate_regions(
+            input_image,
+            block_shape=prescreen.block_shape,
+            signal_floor=(
+                spot_threshold
+                if prescreen.signal_floor is None
+                else prescreen.signal_floor
+            ),
+        )
+        if not regions:
+            return empty_result(image=input_image)
+        # Each connected group of foreground pixels, and any hole it encloses, lies within a single region.
+        binary = np.zeros(input_image.shape, dtype=bool)
+        for region in regions:
+            binary[region] |= ndi.binary_fill_holes(input_image[region] > spot_threshold)  # type: ignore[attr-defined]
     struct = ndi.generate_binary_structure(input_image.ndim, 2)  # type: ignore[attr-defined]
     labels, num_obj = ndi.label(binary, structure=struct)  # type: ignore[attr-defined]
     labels = remove_small_objects(labels, min_size=5) if num_obj > 1 else labels
-    spot_props, labels = _build_props_table(
+    spot_props, labels = measure_spots(
         labels=labels, input_image=input_image, expand_px=expand_px
     )
     return DetectionResult(table=spot_props, image=input_image, labels=labels)
 
 
-def _build_props_table(
+def _transform_within_budget(
+    input_image: npt.NDArray[PixelValue],
     *,
-    labels: npt.NDArray[NumpyInt],
+    transform: DifferenceOfGaussiansTransformation,
+    memory_budget: int,
+    expand_px: Optional[Numeric],
+) -> npt.NDArray[NumpyFloat]:
+    whole: npt.NDArray[NumpyFloat]
+    if input_image.size == 0:
+        whole = transform(input_image)
+        return whole
+    plan = plan_detection(
+        input_image.shape,
+        input_image.dtype,
+        transform=transform,
+        memory_budget=memory_budget,
+        expand_px=expand_px,
+    )
+    if not plan.fits:
+        raise InsufficientMemoryBudgetError(
+            f"No way to run detection is estimated to fit in the memory budget; the leanest plan is:\n{plan.report()}"
+        )
+    if plan.tile_shape is None or plan.precision is None:
+        whole = transform(input_image)
+        return whole
+    img = np.empty(input_image.shape, dtype=plan.precision)
+    transform_regions(
+        transform, input_image, regions=plan.tiles(), out=img, workers=plan.workers
+    )
+    if transform.standardise:
+        standardise_in_place(img)
+    return img
+
+
+def _check_exclusive_options(
+    *,
+    prescreen: Optional[PreScreen],
+    mask: Optional[npt.NDArray[Union[np.bool_, NumpyInt]]],
+    memory_budget: Optional[int],
+) -> None:
+    given = [
+        name
+        for name, value in [
+            ("pre-screening", prescreen),
+            ("a mask", mask),
+            ("a memory budget", memory_budget),
+        ]
+        if value is not None
+    ]
+    if len(given) > 1:
+        raise ValueError(f"Detection can't have both {given[0]} and {given[1]}")
+
+
+def _detect_within_mask(  # pylint: disable=too-many-locals
     input_image: npt.NDArray[PixelValue],
+    *,
+    mask: npt.NDArray[Union[np.bool_, NumpyInt]],
+    spot_threshold: Numeric,
     expand_px: Optional[Numeric],
-) -> Tuple[pd.DataFrame, npt.NDArray[NumpyInt]]:
-    if expand_px:
-        labels = expand_labels(labels, expand_px)  # type: ignore[no-untyped-call]
-    if np.all(labels == 0):
-        # No substructures (ROIs) exist.
-        spot_props = pd.DataFrame(columns=SKIMAGE_REGIONPROPS_TABLE_COLUMNS_EXPANDED)
+    transform: Optional[DifferenceOfGaussiansTransformation],
+) -> DetectionResult:
+    region_ids = _get_region_ids(mask, shape=input_image.shape)
+    # A spot within this distance of a box's edge may be cut off by the box, or (once
+    # expanded) be competing for pixels with a spot outside the box.
+    margin = 1 + 2 * int(np.ceil(expand_px or 0))
+    boxes = merge_overlapping_regions(
+        pad_region(
+            box, padding=MASK_REGION_PADDING_PX + margin, shape=input_image.shape
+        )
+        for box in ndi.find_objects(region_ids)  # type: ignore[attr-defined]
+        if box is not None
+    )
+
+    img: npt.NDArray[Union[PixelValue, NumpyFloat]]
+    if transform is None:
+        img = input_image
+        struct = ndi.generate_binary_structure(input_image.ndim, 2)  # type: ignore[attr-defined]
+
+        def label_boxes(boxes: list[Region]) -> list[tuple[npt.NDArray[NumpyInt], int]]:
+            return [
+                ndi.label(  # type: ignore[attr-defined]
+                    ndi.binary_fill_holes(input_image[box] > spot_threshold),  # type: ignore[attr-defined]
+                    structure=struct,
+                )
+                for box in boxes
+            ]
+
+        boxes, box_labels = _grow_boxes_to_fit_spots(
+            boxes, label_boxes=label_boxes, margin=margin, shape=input_image.shape
+        )
+        # As for the whole image, small objects are removed only if there's more than one object.
+        if sum(n for _, n in box_labels) > 1:
+            box_labels = [
+                (remove_small_objects(labels, min_size=5), n)
+                for labels, n in box_labels
+            ]
     else:
-        spot_props = pd.DataFrame(
-            regionprops_table(
-                label_image=labels,
-                intensity_image=input_image,
-                properties=(ROI_CENTROID_KEY, ROI_AREA_KEY, ROI_MEAN_INTENSITY_KEY),
+        transformed: npt.NDArray[NumpyFloat] = np.zeros(
+            input_image.shape, dtype=np.float64
+        )
+        # Each pixel's transformed value doesn't depend on the box, so when boxes grow,
+        # only the new or grown boxes need transforming.
+        done: set[tuple[tuple[int, int], ...]] = set()
+
+        def label_boxes(boxes: list[Region]) -> list[tuple[npt.NDArray[NumpyInt], int]]:
+            todo = [b for b in boxes if _box_key(b) not in done]
+            transform_regions(transform, input_image, regions=todo, out=transformed)
+            done.update(_box_key(b) for b in todo)
+            mean, std = (
+                region_statistics(transformed, regions=boxes)
+                if transform.standardise
+                else (0.0, 0.0)
             )
+            return [
+                ndi.label(_standardise(transformed[box], mean=mean, std=std) > spot_threshold)  # type: ignore[attr-defined]
+                for box in boxes
+            ]
+
+        boxes, box_labels = _grow_boxes_to_fit_spots(
+            boxes, label_boxes=label_boxes, margin=margin, shape=input_image.shape
         )
-    spot_props = spot_props.rename(
-        columns=dict(SPOT_DETECTION_COLUMN_RENAMING),
-        inplace=False,
-        errors="raise",
+        if transform.standardise:
+            standardise_regions_in_place(transformed, regions=boxes)
+        img = transformed
+
+    labels = np.zeros(input_image.shape, dtype=np.int32)
+    tables: list[pd.DataFrame] = []
+    for box, (box_label_image, _) in zip(boxes, box_labels):
+        box_table, box_label_image = measure_spots(
+            labels=box_label_image, input_image=input_image[box], expand_px=expand_px
+        )
+        if box_table.shape[0] == 0:
+            continue
+        offset = np.array([s.start for s in box], dtype=np.float64)
+        box_table[RoiCenterKeys.to_list()] += offset
+        voxels = np.clip(
+            np.floor(box_table[RoiCenterKeys.to_list()].to_numpy() + 0.5).astype(int),
+            0,
+            np.array(input_image.shape) - 1,
+        )
+        box_table[ROI_REGION_ID_KEY] = region_ids[tuple(voxels.T)]
+        # Renumber the kept spots' labels consecutively over all regions, in table order.
+        keep = box_table[ROI_REGION_ID_KEY].to_numpy() > 0
+        relabel = np.zeros(box_label_image.max() + 1, dtype=np.int32)
+        relabel[np.unique(box_label_image[box_label_image > 0])[keep]] = np.arange(
+            1, keep.sum() + 1
+        ) + sum(t.shape[0] for t in tables)
+        # The boxes are disjoint, so there's nothing here yet to overwrite.
+        labels[box] = relabel[box_label_image]
+        tables.append(box_table[keep])
+
+    table = (
+        pd.concat(tables, ignore_index=True)
+        if tables
+        else pd.DataFrame(
+            columns=DETECTION_RESULT_TABLE_COLUMNS + [ROI_REGION_ID_KEY]
+        ).astype({ROI_REGION_ID_KEY: region_ids.dtype})
     )
-    spot_props = spot_props.reset_index(drop=True)
-    return spot_props, labels
+    return DetectionResult(table=table, image=img, labels=labels)  # type: ignore[arg-type]
 
 
-def _check_input_image(img: npt.NDArray[PixelValue]) -> None:
-    if not isinstance(img, np.ndarray):
-        raise TypeError(
-            f"Expected numpy array for input image but got {type(img).__name__}"
+def _grow_boxes_to_fit_spots(
+    boxes: list[Region],
+    *,
+    label_boxes: Callable[[list[Region]], list[tuple[npt.NDArray[NumpyInt], int]]],
+    margin: int,
+    shape: tuple[int, ...],
+) -> tuple[list[Region], list[tuple[npt.NDArray[NumpyInt], int]]]:
+    """Grow each box in which a spot is within the margin of an edge (other than an edge of the image), until no spot is, so that detection in the boxes finds spots as detection in the whole image would."""
+    while True:
+        box_labels = label_boxes(boxes)
+        reaching = [
+            _reaches_box_edge(labels, box=box, margin=margin, shape=shape)
+            for box, (labels, _) in zip(boxes, box_labels)
+        ]
+        if not any(reaching):
+            return boxes, box_labels
+        boxes = merge_overlapping_regions(
+            (
+                pad_region(box, padding=MASK_REGION_PADDING_PX + margin, shape=shape)
+                if reaches
+                else box
+            )
+            for box, reaches in zip(boxes, reaching)
         )
-    if img.ndim != 3:
-        raise DimensionalityError(
-            f"Expected 3D input image but got {img.ndim}-dimensional"
+
+
+def _reaches_box_edge(
+    labels: npt.NDArray[NumpyInt],
+    *,
+    box: Region,
+    margin: int,
+    shape: tuple[int, ...],
+) -> bool:
+    for axis, (side, length) in enumerate(zip(box, shape)):
+        along = np.moveaxis(labels, axis, 0)
+        if side.start > 0 and np.any(along[:margin]):
+            return True
+        if side.stop < length and np.any(along[-margin:]):
+            return True
+    return False
+
+
+def _box_key(box: Region) -> tuple[tuple[int, int], ...]:
+    return tuple((s.start, s.stop) for s in box)
+
+
+def _standardise(
+    values: npt.NDArray[NumpyFloat], *, mean: float, std: float
+) -> npt.NDArray[NumpyFloat]:
+    values = values - mean
+    return values / std if std > 0 else values
+
+
+def _get_region_ids(
+    mask: npt.NDArray[Union[np.bool_, NumpyInt]], *, shape: tuple[int, ...]
+) -> npt.NDArray[NumpyInt]:
+    if not isinstance(mask, np.ndarray) or mask.shape != shape:
+        raise ValueError(
+            f"Mask must be an array of the same shape as the image ({shape}); got {getattr(mask, 'shape', type(mask).__name__)}"
         )
+    if mask.dtype == np.bool_:
+        region_ids, _ = ndi.label(mask, structure=ndi.generate_binary_structure(3, 3))  # type: ignore[attr-defined]
+        return region_ids  # type: ignore[no-any-return]
+    if not np.issubdtype(mask.dtype, np.integer):
+        raise ValueError(f"Mask must be boolean or integer-typed; got {mask.dtype}")
+    if mask.size and mask.min() < 0:
+        raise ValueError("Label image for mask can't have negative values")
+    return mask  # type: ignore[return-value]
@@ -0,0 +1,480 @@
+"""Sharded spot detection by independent workers (e.g. on many nodes), coordinated through a shared filesystem"""
+
+import json
+import os
+import socket
+import threading
+import traceback
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import TracebackType
+from typing import Callable, Optional, Sequence, Union
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+
+from ._exceptions import IncompleteWorkError
+from ._types import PixelValue
+from .detection_result import DetectionResult
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = [
+    "IMAGE_KEY_COLUMN",
+    "Lease",
+    "QueueStatus",
+    "WorkQueue",
+    "merge_results",
+    "run_worker",
+]
+
+PathLike = Union[str, Path]
+
+Image = npt.NDArray[PixelValue]
+
+# the column, prepended to each detection table, which says from which image (manifest entry) each spot comes
+IMAGE_KEY_COLUMN = "image"
+
+_CONFIG_FILENAME = "queue.json"
+_UNITS_FOLDER = "units"
+_LEASES_FOLDER = "leases"
+_RESULTS_FOLDER = "results"
+_FAILURES_FOLDER = "failed"
+_CLOCK_FILENAME = ".clock"
+
+
+@doc(
+    summary="Counts of units of work in each state",
+    parameters=dict(
+        pending="Number of units neither done nor failed, and not currently leased",
+        leased="Number of units neither done nor failed, with a lease (possibly expired)",
+        done="Number of units with results",
+        failed="Number of units whose detection raised an error",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class QueueStatus:  # pylint: disable=missing-class-docstring
+    pending: int
+    leased: int
+    done: int
+    failed: int
+
+    @property
+    def finished(self) -> bool:
+        """Whether every unit is either done or failed"""
+        return self.pending == 0 and self.leased == 0
+
+
+@doc(
+    summary="Queue of units of detection work, in a folder on a filesystem shared by all workers",
+    extended_summary="""
+        The queue is created once (see `create`), sharding a manifest of images into
+        units, and recording the lease timing settings, which every worker then uses
+        (see `open`). Then any number of workers, in any processes on any nodes which
+        see the folder, claim units one at a time. A claim is a lease file, created atomically
+        (exclusive creation), which the holder keeps alive by touching it (a heartbeat)
+        at least every `heartbeat_interval` seconds. A lease untouched for more than
+        `lease_timeout` seconds is expired, e.g. because its holder's node died, and
+        the unit may then be claimed by another worker. Ages of leases are judged by the
+        filesystem's clock, not the workers' own, so clock skew between nodes doesn't
+        matter.
+
+        A unit is done when its results table exists; each table is written under a
+        temporary name and then renamed, so a table is never seen partially written.
+        Detection is deterministic, so if a unit is done twice (by the holder of an
+        expired lease and then by the next claimant), the second table is the same
+        as the first.
+    """,
+    parameters=dict(
+        root="Folder of the queue, on a filesystem shared by all workers",
+        lease_timeout="Seconds after the last heartbeat at which a lease expires",
+        heartbeat_interval="Seconds between heartbeats of a held lease",
+    ),
+    raises=dict(
+        ValueError="If the lease timeout isn't positive, or the heartbeat interval isn't positive and less than the lease timeout",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class WorkQueue:  # pylint: disable=missing-class-docstring
+    root: Path
+    lease_timeout: float = 300.0
+    heartbeat_interval: float = 30.0
+
+    def __post_init__(self) -> None:
+        if self.lease_timeout <= 0:
+            raise ValueError(
+                f"Lease timeout must be positive; got {self.lease_timeout}"
+            )
+        if not 0 < self.heartbeat_interval < self.lease_timeout:
+            raise ValueError(
+                f"Heartbeat interval must be positive and less than the lease timeout ({self.lease_timeout}); got {self.heartbeat_interval}"
+            )
+
+    @classmethod
+    def create(  # pylint: disable=too-many-arguments
+        cls,
+        root: PathLike,
+        *,
+        manifest: Sequence[str],
+        images_per_unit: int,
+        lease_timeout: float = 300.0,
+        heartbeat_interval: float = 30.0,
+    ) -> "WorkQueue":
+        """Create a new queue in the given folder, with the manifest's images split into units, in order.
+
+        Raises
+        ------
+        FileExistsError
+            If the folder already holds a queue
+        ValueError
+            If the number of images per unit isn't positive, or the manifest is empty
+        """
+        if images_per_unit < 1:
+            raise ValueError(
+                f"Number of images per unit must be positive; got {images_per_unit}"
+            )
+        if len(manifest) == 0:
+            raise ValueError("Manifest of images to process is empty")
+        queue = cls(
+            root=Path(root),
+            lease_timeout=lease_timeout,
+            heartbeat_interval=heartbeat_interval,
+        )
+        queue.root.mkdir(parents=True, exist_ok=True)
+        # Exclusive creation of the configuration guards against two queues in one folder.
+        with open(queue.root / _CONFIG_FILENAME, "x", encoding="utf-8") as config:
+            json.dump(
+                {
+                    "images_per_unit": images_per_unit,
+                    "num_images": len(manifest),
+                    "lease_timeout": lease_timeout,
+                    "heartbeat_interval": heartbeat_interval,
+                },
+                config,
+            )
+        for folder in [
+            _UNITS_FOLDER,
+            _LEASES_FOLDER,
+            _RESULTS_FOLDER,
+            _FAILURES_FOLDER,
+        ]:
+            (queue.root / folder).mkdir(exist_ok=True)
+        num_units = -(-len(manifest) // images_per_unit)
+        width = max(5, len(str(num_units - 1)))
+        for i in range(num_units):
+            images = [
+                str(m)
+                for m in manifest[i * images_per_unit : (i + 1) * images_per_unit]
+            ]
+            _write_atomically(
+                queue.root / _UNITS_FOLDER / f"unit_{i:0{width}d}.json",
+                json.dumps({"images": images}),
+            )
+        return queue
+
+    @classmethod
+    def open(cls, root: PathLike) -> "WorkQueue":
+        """Open the existing queue in the given folder, with the settings with which it was created.
+
+        Raises
+        ------
+        FileNotFoundError
+            If the folder doesn't hold a queue
+        """
+        root = Path(root)
+        with open(root / _CONFIG_FILENAME, encoding="utf-8") as config:
+            settings = json.load(config)
+        return cls(
+            root=root,
+            lease_timeout=settings["lease_timeout"],
+            heartbeat_interval=settings["heartbeat_interval"],
+        )
+
+    def unit_ids(self) -> list[str]:
+        """IDs of all units of work, in order of the manifest"""
+        return sorted(p.stem for p in (self.root / _UNITS_FOLDER).glob("*.json"))
+
+    def images(self, unit_id: str) -> list[str]:
+        """Manifest entries (images) of the given unit, in order"""
+        with open(
+            self.root / _UNITS_FOLDER / f"{unit_id}.json", encoding="utf-8"
+        ) as unit:
+            return json.load(unit)["images"]  # type: ignore[no-any-return]
+
+    def results_path(self, unit_id: str) -> Path:
+        """Where the results table of the given unit is (or will be)"""
+        return self.root / _RESULTS_FOLDER / f"{unit_id}.csv"
+
+    def failure_path(self, unit_id: str) -> Path:
+        """Where the error report of the given unit is (or would be)"""
+        return self.root / _FAILURES_FOLDER / f"{unit_id}.txt"
+
+    def lease_path(self, unit_id: str) -> Path:
+        """Where the lease on the given unit is (or would be)"""
+        return self.root / _LEASES_FOLDER / f"{unit_id}.lease"
+
+    def is_finished(self, unit_id: str) -> bool:
+        """Whether the given unit is either done or failed"""
+        return (
+            self.results_path(unit_id).exists() or self.failure_path(unit_id).exists()
+        )
+
+    def status(self) -> QueueStatus:
+        """Count the units in each state."""
+        done = failed = leased = pending = 0
+        for unit_id in self.unit_ids():
+            if self.results_path(unit_id).exists():
+                done += 1
+            elif self.failure_path(unit_id).exists():
+                failed += 1
+            elif self.lease_path(unit_id).exists():
+                leased += 1
+            else:
+                pending += 1
+        return QueueStatus(pending=pending, leased=leased, done=done, failed=failed)
+
+    def claim(self, *, worker_id: str) -> Optional["Lease"]:
+        """Claim the first unit which is neither finished nor validly leased, or return null if there's none.
+
+        Raises
+        ------
+        ValueError
+            If this queue's lease timing settings aren't those with which the queue was
+            created, since a worker with a shorter timeout, or longer heartbeat interval,
+            could break leases which are still alive
+        """
+        self._check_settings()
+        for unit_id in self.unit_ids():
+            if self.is_finished(unit_id):
+                continue
+            lease = self._try_lease(unit_id, worker_id=worker_id)
+            if lease is None:
+                continue
+            # The unit may have been finished by a previous holder since the check above.
+            if self.is_finished(unit_id):
+                lease.release()
+                continue
+            return lease
+        return None
+
+    def _try_lease(self, unit_id: str, *, worker_id: str) -> Optional["Lease"]:
+        path = self.lease_path(unit_id)
+        token = f"{worker_id}\n{uuid.uuid4().hex}\n"
+        for _ in range(2):
+            try:
+                lease_fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._break_if_expired(path):
+                    return None
+                # The expired lease is out of the way; try once more to create one.
+                continue
+            with os.fdopen(lease_fd, "w", encoding="utf-8") as lease_file:
+                lease_file.write(token)
+            return Lease(queue=self, unit_id=unit_id, token=token)
+        return None
+
+    def _check_settings(self) -> None:
+        with open(self.root / _CONFIG_FILENAME, encoding="utf-8") as config:
+            settings = json.load(config)
+        stored = (settings["lease_timeout"], settings["heartbeat_interval"])
+        if stored != (self.lease_timeout, self.heartbeat_interval):
+            raise ValueError(
+                f"Queue was created with lease timeout and heartbeat interval {stored}, not {(self.lease_timeout, self.heartbeat_interval)}; use {type(self).__name__}.open"
+            )
+
+    def _break_if_expired(self, path: Path) -> bool:
+        try:
+            expired = _lease_identity(path)
+            age = self._filesystem_now() - expired[1] / 1e9
+        except FileNotFoundError:
+            # The lease was released (or broken by another worker) in the meantime.
+            return True
+        if age <= self.lease_timeout:
+            return False
+        # Renaming is atomic, so only one of the workers trying to break the lease succeeds.
+        moved = path.with_name(f"{path.name}.expired.{uuid.uuid4().hex}")
+        try:
+            os.rename(path, moved)
+        except FileNotFoundError:
+            return False
+        # Between the check of the lease and the rename, another worker may have broken
+        # it and taken a new lease, or its holder may have renewed it; if what was
+        # renamed isn't the lease which was judged expired, put it back. Linking (unlike
+        # renaming) never replaces a lease taken in the meantime; if one was, the holder
+        # of the lease which was renamed finds at its next heartbeat that it's lost it.
+        if _lease_identity(moved) != expired:
+            try:
+                os.link(moved, path)
+            except FileExistsError:
+                pass
+            moved.unlink()
+            return False
+        return True
+
+    def _filesystem_now(self) -> float:
+        """The current time by the filesystem's clock, found by touching a file"""
+        clock = self.root / _CLOCK_FILENAME
+        clock.touch()
+        return clock.stat().st_mtime
+
+
+@doc(
+    summary="A worker's claim on a unit of work, kept alive by heartbeats while in use as a context manager",
+    parameters=dict(
+        queue="The queue from which the unit was claimed",
+        unit_id="ID of the claimed unit",
+        token="Content of the lease file, unique to this claim",
+    ),
+)
+@dataclass(kw_only=True)
+class Lease:  # pylint: disable=missing-class-docstring
+    queue: WorkQueue
+    unit_id: str
+    token: str
+    _stop: threading.Event = field(
+        default_factory=threading.Event, init=False, repr=False
+    )
+    _heartbeat: Optional[threading.Thread] = field(default=None, init=False, repr=False)
+
+    @property
+    def path(self) -> Path:
+        """Path to the lease file"""
+        return self.queue.lease_path(self.unit_id)
+
+    def is_held(self) -> bool:
+        """Whether the lease file is still this claim's, i.e. hasn't been broken and taken over"""
+        try:
+            return self.path.read_text(encoding="utf-8") == self.token
+        except FileNotFoundError:
+            return False
+
+    def beat(self) -> bool:
+        """Touch the lease file, if it's still held, to keep it from expiring; return whether it's held."""
+        if not self.is_held():
+            return False
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self) -> None:
+        """Stop heartbeats, and remove the lease file if it's still held."""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        if self.is_held():
+            self.path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "Lease":
+        def beat_until_stopped() -> None:
+            while not self._stop.wait(self.queue.heartbeat_interval):
+                if not self.beat():
+                    return
+
+        self._heartbeat = threading.Thread(target=beat_until_stopped, daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        exc_traceback: Optional[TracebackType],
+    ) -> None:
+        self.release()
+
+
+@doc(
+    summary="Claim and process units of work until none is left to claim.",
+    extended_summary="""
+        For each claimed unit, each of its images is loaded and spots are detected in
+        it, and the unit's tables (each with the image's manifest entry prepended, as
+        the `image` column) are written as one table. If loading or detection raises
+        an error, the unit is marked failed with the traceback, and not retried.
+        Run one of these in each worker process, on any number of nodes.
+    """,
+    parameters=dict(
+        queue="The queue from which to claim work",
+        detect="Function which detects spots in an image, e.g. detect_spots_dog with its settings fixed",
+        load="Function which loads the image for a manifest entry",
+        worker_id="Name of this worker, recorded in its leases; defaults to host name and process ID",
+        max_units="Greatest number of units to process, or null for no limit",
+    ),
+    returns="Number of units processed (done or failed) by this worker",
+)
+def run_worker(  # pylint: disable=missing-function-docstring
+    queue: WorkQueue,
+    *,
+    detect: Callable[[Image], DetectionResult],
+    load: Callable[[str], Image] = np.load,
+    worker_id: Optional[str] = None,
+    max_units: Optional[int] = None,
+) -> int:
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    num_processed = 0
+    while max_units is None or num_processed < max_units:
+        lease = queue.claim(worker_id=worker_id)
+        if lease is None:
+            break
+        with lease:
+            try:
+                tables = []
+                for image in queue.images(lease.unit_id):
+                    table = detect(load(image)).table
+                    tables.append(table.assign(**{IMAGE_KEY_COLUMN: image}))
+                table = pd.concat(tables, ignore_index=True)
+                # Put the image key first.
+                table = table[[IMAGE_KEY_COLUMN] + list(table.columns[:-1])]
+                _write_atomically(
+                    queue.results_path(lease.unit_id), table.to_csv(index=False)
+                )
+            except Exception:  # pylint: disable=broad-exception-caught
+                _write_atomically(
+                    queue.failure_path(lease.unit_id),
+                    f"worker: {worker_id}\n{traceback.format_exc()}",
+                )
+        num_processed += 1
+    return num_processed
+
+
+@doc(
+    summary="Combine the tables of all units into one, in order of the manifest.",
+    parameters=dict(
+        queue="The queue whose results to combine",
+        allow_incomplete="Whether to combine whatever tables exist, rather than raise an error when any unit isn't done",
+    ),
+    raises=dict(
+        IncompleteWorkError="If any unit isn't done (e.g. still pending, or failed) and incompleteness isn't allowed",
+    ),
+    returns="Table of all spots, with the manifest entry of each spot's image in the first column",
+)
+def merge_results(  # pylint: disable=missing-function-docstring
+    queue: WorkQueue, *, allow_incomplete: bool = False
+) -> pd.DataFrame:
+    unit_ids = queue.unit_ids()
+    missing = {u for u in unit_ids if not queue.results_path(u).exists()}
+    if missing and not allow_incomplete:
+        failed = [u for u in missing if queue.failure_path(u).exists()]
+        raise IncompleteWorkError(
+            f"{len(missing)} of {len(unit_ids)} unit(s) not done, of which {len(failed)} failed: {', '.join(sorted(missing))}"
+        )
+    tables = [pd.read_csv(queue.results_path(u)) for u in unit_ids if u not in missing]
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+
+def _lease_identity(path: Path) -> tuple[int, int, str]:
+    """Inode, modification time (ns), and token of a lease file, which together tell one lease from another"""
+    stat = path.stat()
+    return stat.st_ino, stat.st_mtime_ns, path.read_text(encoding="utf-8")
+
+
+def _write_atomically(path: Path, text: str) -> None:
+    """Write the text to a temporary file beside the target, then rename that to the target."""
+    temp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    temp.write_text(text, encoding="utf-8")
+    os.replace(temp, path)
@@ -17,6 +17,9 @@ __all__ = ["DifferenceOfGaussiansTransformation"]
 
 Numeric = Union[float, int, NumpyFloat, NumpyInt]
 
+# number of standard deviations at which a Gaussian kernel is truncated (skimage's default)
+GAUSSIAN_TRUNCATE = 4.0
+
 
 class PostDifferenceTransformation(
     Protocol
@@ -39,10 +42,11 @@ class PostDifferenceTransformation(
         sigma_wide=common_params.sigma_wide,
         post_diff="What (if anything) to do to the transformed image after difference but before standardisation; note that if non-null, this will be fed the *original* image as the first argument, and the *transformed image as the second argument",
         standardise=common_params.standardise,
+        support_radius="How far (in pixels) the value of a pixel of the transformed image (before standardisation) can depend on the input, along any axis; if omitted, the pre- and post-difference steps are assumed to be pixelwise, so that the radius is that of the wider Gaussian. This is used only when the transformation is applied piecewise, e.g. to pre-screened regions of an image.",
     ),
     raises=dict(
         TypeError="If either of the standard deviations is non-numeric.",
-        ValueError="If the narrower Gaussian's standard deviation isn't less than the wider Gaussian's.",
+        ValueError="If the narrower Gaussian's standard deviation isn't less than the wider Gaussian's, or if the support radius is negative.",
     ),
     returns="A structure of the same shape as the input, just with all transformations applied",
 )
@@ -53,6 +57,7 @@ class DifferenceOfGaussiansTransformation:  # pylint: disable=missing-class-docs
     sigma_wide: Numeric
     post_diff: Optional[PostDifferenceTransformation]
     standardise: bool
+    support_radius: Optional[int] = None
 
     def __post_init__(self) -> None:
         # skimage raises errors for negative sigma, but we raise these.
@@ -64,6 +69,8 @@ class DifferenceOfGaussiansTransformation:  # pylint: disable=missing-class-docs
             raise ValueError(
                 f"sigma for narrow Gaussian must be strictly less than sigma for wide Gaussian, but {self.sigma_narrow} >= {self.sigma_wide}"
             )
+        if self.support_radius is not None and self.support_radius < 0:
+            raise ValueError(f"Negative support radius: {self.support_radius}")
 
     @doc(
         summary="Apply the sequence of transformations in this instance to given image.",
@@ -84,6 +91,15 @@ class DifferenceOfGaussiansTransformation:  # pylint: disable=missing-class-docs
             img = self.post_diff(old_img=input_image, new_img=img)
         return (img - np.mean(img)) / np.std(img) if self.standardise else img
 
+    @property
+    def effective_support_radius(self) -> int:
+        """The support radius if given, otherwise the radius of the wider Gaussian's kernel"""
+        return (
+            gaussian_radius(self.sigma_wide)
+            if self.support_radius is None
+            else self.support_radius
+        )
+
 
 @doc(
     summary="Test the given object for membership in a numeric type",
@@ -91,3 +107,14 @@ class DifferenceOfGaussiansTransformation:  # pylint: disable=missing-class-docs
 )
 def is_numeric(obj: object) -> bool:  # pylint: disable=missing-function-docstring
     return isinstance(obj, Numeric)  # type: ignore
+
+
+@doc(
+    summary="Get the radius of the kernel with which skimage (by way of scipy) applies a Gaussian blur.",
+    parameters=dict(sigma="Standard deviation of the Gaussian"),
+    returns="Number of pixels on either side of the center of the kernel",
+)
+def gaussian_radius(  # pylint: disable=missing-function-docstring
+    sigma: Numeric,
+) -> int:
+    return int(GAUSSIAN_TRUNCATE * sigma + 0.5)
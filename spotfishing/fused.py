@@ -0,0 +1,321 @@
+"""DoG spot detection which streams through the image block by block, never building the whole transformed image"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterable, Optional, TypeVar, Union
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+from scipy import ndimage as ndi
+
+from ._measurement import check_input_image, measure_spots
+from ._tiling import Region, grid_regions, transform_region
+from ._types import NumpyFloat, NumpyInt, PixelValue
+from .detection_result import DetectionResult
+from .dog_transform import DifferenceOfGaussiansTransformation
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = [
+    "DEFAULT_BLOCK_SHAPE",
+    "FusedDetectionResult",
+    "ResponseStatistics",
+    "SparseResponse",
+    "detect_spots_dog_fused",
+]
+
+Numeric = Union[int, float]
+
+ImageShape = tuple[int, int, int]
+
+# Not cache-sized: each block is transformed with its context (the transformation's
+# support radius, 12 pixels for the looptrace settings) on every side, so a block must be
+# several times that radius across for the context not to dominate the work. For a
+# 32x512x512 image, blocks of 16x32x32 took over 3 times as long as these; these keep a
+# block's filter temporaries (a few float64 arrays of the padded block) to some tens of
+# MB, which is below the image-sized mask and labels. The whole of z is taken, for
+# typical images.
+DEFAULT_BLOCK_SHAPE: ImageShape = (64, 128, 128)
+
+_T = TypeVar("_T")
+
+
+@doc(
+    summary="Mean and standard deviation of the (unstandardised) DoG response over a whole image",
+    parameters=dict(
+        mean="Mean of the response",
+        std="Standard deviation (population, not sample) of the response",
+    ),
+    raises=dict(ValueError="If the standard deviation is negative"),
+)
+@dataclass(frozen=True, kw_only=True)
+class ResponseStatistics:  # pylint: disable=missing-class-docstring
+    mean: float
+    std: float
+
+    def __post_init__(self) -> None:
+        if self.std < 0:
+            raise ValueError(f"Standard deviation can't be negative; got {self.std}")
+
+    def standardise(self, values: npt.NDArray[NumpyFloat]) -> npt.NDArray[NumpyFloat]:
+        """Shift and scale the values by these statistics (only shift, if the standard deviation is 0)."""
+        values = values - self.mean
+        return values / self.std if self.std > 0 else values
+
+
+@doc(
+    summary="The response of the transformed image, at only the pixels above the detection threshold",
+    parameters=dict(
+        shape="Shape of the image",
+        indices="Flat (C-order) index of each pixel above the threshold, in increasing order",
+        values="Value of the (standardised, if applicable) response at each pixel above the threshold",
+    ),
+    raises=dict(ValueError="If the numbers of indices and values differ"),
+)
+@dataclass(frozen=True, kw_only=True)
+class SparseResponse:  # pylint: disable=missing-class-docstring
+    shape: ImageShape
+    indices: npt.NDArray[np.int64]
+    values: npt.NDArray[np.float64]
+
+    def __post_init__(self) -> None:
+        if self.indices.shape != self.values.shape:
+            raise ValueError(
+                f"Need as many values as indices; got {self.values.shape} and {self.indices.shape}"
+            )
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes of the indices and values"""
+        return int(self.indices.nbytes + self.values.nbytes)
+
+    def coordinates(self) -> npt.NDArray[np.int64]:
+        """Array of (z, y, x) coordinates of the pixels, one row per pixel"""
+        return np.stack(np.unravel_index(self.indices, self.shape), axis=1)
+
+    def to_dense(self, fill_value: float = np.nan) -> npt.NDArray[np.float64]:
+        """Image of the response, with the given value at each pixel not above the threshold"""
+        img = np.full(self.shape, fill_value, dtype=np.float64)
+        img.flat[self.indices] = self.values
+        return img
+
+
+@doc(
+    summary="Spots detected by streaming DoG detection, with the response kept only where it's above the threshold",
+    extended_summary="""
+        The whole transformed image isn't kept, but can be rebuilt on request (by
+        build_image, or to_detection_result), by transforming the input image again with
+        the same statistics.
+    """,
+    parameters=dict(
+        table="Table of ROI coordinates and data, as for DetectionResult",
+        labels="Region labels array, as for DetectionResult",
+        response="Response of the transformed image above the detection threshold",
+        statistics="The statistics by which the response was standardised, or null if the transformation doesn't standardise",
+        input_image="The image in which spots were detected (not a copy)",
+        transform="The transformation with which spots were detected",
+        block_shape="The shape of the blocks in which the image was transformed",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class FusedDetectionResult:  # pylint: disable=missing-class-docstring,too-many-instance-attributes
+    table: pd.DataFrame
+    labels: npt.NDArray[NumpyInt]
+    response: SparseResponse
+    statistics: Optional[ResponseStatistics]
+    input_image: npt.NDArray[PixelValue]
+    transform: DifferenceOfGaussiansTransformation
+    block_shape: ImageShape
+
+    def build_image(self, *, workers: int = 1) -> npt.NDArray[np.float64]:
+        """Transform the whole input image, exactly as was done (block by block) for detection."""
+        img = np.empty(self.input_image.shape, dtype=np.float64)
+
+        def transform_one(region: Region) -> None:
+            img[region] = _transform_block(
+                self.transform,
+                self.input_image,
+                region=region,
+                statistics=self.statistics,
+            )
+
+        _map_blocks(
+            transform_one,
+            grid_regions(img.shape, block_shape=self.block_shape),
+            workers=workers,
+        )
+        return img
+
+    def to_detection_result(self, *, workers: int = 1) -> DetectionResult:
+        """Bundle the table and labels with the whole transformed image (built by build_image)."""
+        return DetectionResult(
+            table=self.table,
+            image=self.build_image(workers=workers),  # type: ignore[arg-type]
+            labels=self.labels,
+        )
+
+
+@doc(
+    summary="Detect spots by difference of Gaussians filter, without building the whole transformed image.",
+    extended_summary="""
+        The image is processed block by block: each block is transformed (with enough
+        surrounding context that its values are as if the whole image had been
+        transformed), standardised by whole-image statistics, and thresholded, keeping
+        only a boolean mask of the image and the response at the pixels above the
+        threshold. What's fused is the transformation and thresholding of each block;
+        the block is transformed by the same (separable) filters as the whole image is
+        by detect_spots_dog, not by a single combined kernel.
+
+        Standardisation needs the whole image's statistics before any block can be
+        thresholded, and keeping each block's response until they're known would take
+        the memory which this saves. So if the transformation standardises and no
+        statistics are given, there are two passes through the blocks: the first
+        transforms each block only to accumulate the statistics, and the second
+        transforms it again to threshold it, which about doubles the time. Giving
+        statistics (e.g. those of an earlier result for a similar image) skips the
+        first pass.
+
+        Peak memory is the input image, the mask and label arrays, the temporaries for
+        one block per worker, and the sparse response, instead of several float64
+        copies of the image. Spots are the same as those from detect_spots_dog, up to
+        floating-point rounding at pixels which are right at the threshold.
+    """,
+    parameters=dict(
+        input_image="3D image in which to detect spots",
+        spot_threshold="The minimum (after any transformations) pixel value required to regard a pixel as part of a spot",
+        expand_px="The number of pixels by which to expand a detected and defined region",
+        transform="The subtraction-after-smoothing parameterisation that defined DoG",
+        block_shape="Shape of the blocks in which to process the image",
+        statistics="Statistics by which to standardise the response, if the transformation standardises; computed from the image if omitted",
+        workers="Number of blocks to process concurrently, in threads",
+    ),
+    returns="Bundle of table of ROI coordinates and data, region labels array, and the sparse response",
+    raises=dict(
+        TypeError="If the given `transform` isn't specifically a `DifferenceOfGaussiansTransformation`",
+        ValueError="If the block shape or number of workers isn't positive, or if statistics are given for a transformation which doesn't standardise",
+    ),
+)
+def detect_spots_dog_fused(  # pylint: disable=missing-function-docstring,too-many-locals
+    input_image: npt.NDArray[PixelValue],
+    *,
+    spot_threshold: Numeric,
+    expand_px: Optional[Numeric],
+    transform: DifferenceOfGaussiansTransformation,
+    block_shape: ImageShape = DEFAULT_BLOCK_SHAPE,
+    statistics: Optional[ResponseStatistics] = None,
+    workers: int = 1,
+) -> FusedDetectionResult:
+    check_input_image(input_image)
+    if not isinstance(transform, DifferenceOfGaussiansTransformation):
+        raise TypeError(
+            f"For DoG-based detection, the transformation must be of type {DifferenceOfGaussiansTransformation.__name__}; got {type(transform).__name__}"
+        )
+    if len(block_shape) != 3 or any(n < 1 for n in block_shape):
+        raise ValueError(f"Block shape must be 3 positive lengths; got {block_shape}")
+    if workers < 1:
+        raise ValueError(f"Number of workers must be positive; got {workers}")
+    if statistics is not None and not transform.standardise:
+        raise ValueError("Statistics are only for a transformation which standardises")
+
+    blocks = grid_regions(input_image.shape, block_shape=block_shape)
+    if transform.standardise and statistics is None:
+        statistics = _accumulate_statistics(
+            _map_blocks(
+                lambda region: _block_moments(
+                    transform_region(transform, input_image, region=region)
+                ),
+                blocks,
+                workers=workers,
+            )
+        )
+    mask = np.zeros(input_image.shape, dtype=bool)
+
+    def threshold_one(
+        region: Region,
+    ) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.float64]]:
+        values = _transform_block(
+            transform, input_image, region=region, statistics=statistics
+        )
+        above = values > spot_threshold
+        mask[region] = above
+        indices = np.asarray(
+            np.ravel_multi_index(
+                tuple(i + s.start for i, s in zip(np.nonzero(above), region)),
+                input_image.shape,
+            ),
+            dtype=np.int64,
+        )
+        # Boolean indexing takes the values in C order, as np.nonzero does.
+        return indices, np.asarray(values[above], dtype=np.float64)
+
+    sparse = _map_blocks(threshold_one, blocks, workers=workers)
+    indices = np.concatenate([i for i, _ in sparse] or [np.zeros(0, dtype=np.int64)])
+    values = np.concatenate([v for _, v in sparse] or [np.zeros(0, dtype=np.float64)])
+    order = np.argsort(indices, kind="stable")
+
+    labels, _ = ndi.label(mask)  # type: ignore[attr-defined]
+    del mask
+    table, labels = measure_spots(
+        labels=labels, input_image=input_image, expand_px=expand_px
+    )
+    return FusedDetectionResult(
+        table=table,
+        labels=labels,
+        response=SparseResponse(
+            shape=input_image.shape,  # type: ignore[arg-type]
+            indices=indices[order],
+            values=values[order],
+        ),
+        statistics=statistics,
+        input_image=input_image,
+        transform=transform,
+        block_shape=block_shape,
+    )
+
+
+def _transform_block(
+    transform: DifferenceOfGaussiansTransformation,
+    image: npt.NDArray[PixelValue],
+    *,
+    region: Region,
+    statistics: Optional[ResponseStatistics],
+) -> npt.NDArray[NumpyFloat]:
+    values = transform_region(transform, image, region=region)
+    return values if statistics is None else statistics.standardise(values)
+
+
+def _map_blocks(
+    func: Callable[[Region], _T], blocks: Iterable[Region], *, workers: int
+) -> list[_T]:
+    if workers == 1:
+        return [func(block) for block in blocks]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, blocks))
+
+
+def _block_moments(values: npt.NDArray[NumpyFloat]) -> tuple[int, float, float]:
+    """Count, mean, and sum of squared deviations from the mean, of the values of one block"""
+    values = values.astype(np.float64, copy=False)
+    mean = float(np.mean(values)) if values.size else 0.0
+    return values.size, mean, float(np.sum((values - mean) ** 2))
+
+
+def _accumulate_statistics(
+    moments: Iterable[tuple[int, float, float]]
+) -> ResponseStatistics:
+    """Combine blocks' moments (by the parallel algorithm of Chan et al.) into whole-image statistics."""
+    count, mean, sq_dev = 0, 0.0, 0.0
+    for block_count, block_mean, block_sq_dev in moments:
+        if block_count == 0:
+            continue
+        total = count + block_count
+        delta = block_mean - mean
+        mean += delta * block_count / total
+        sq_dev += block_sq_dev + delta**2 * count * block_count / total
+        count = total
+    return ResponseStatistics(
+        mean=mean, std=float(np.sqrt(sq_dev / count)) if count else 0.0
+    )
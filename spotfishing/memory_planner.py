@@ -0,0 +1,342 @@
+"""Planning of how to run spot detection within a memory budget"""
+
+import os
+from dataclasses import dataclass
+from typing import Iterable, Optional, Protocol, Union
+
+import numpy as np
+import numpy.typing as npt
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+
+from ._tiling import Region, grid_regions
+from .dog_transform import DifferenceOfGaussiansTransformation
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = ["ExecutionPlan", "StageEstimate", "plan_detection"]
+
+ImageShape = tuple[int, int, int]
+
+# bytes per element of each of the (non-image) arrays which detection builds
+_BOOL_BYTES = 1
+_LABEL_BYTES = np.dtype(np.int32).itemsize
+
+# bytes per pixel built by skimage's expand_labels (measured), mostly for the distance
+# transform with indices (a float64 distance and three int64 indices per pixel)
+_EXPAND_LABELS_BYTES = 49
+
+# bytes per element of the floating-point arrays skimage makes while blurring
+_BLUR_BYTES = np.dtype(np.float64).itemsize
+
+# smallest tile side length (in y and x) which the planner will consider
+MIN_TILE_SIDE = 32
+
+
+class TransformationSpecification(Protocol):  # pylint: disable=too-few-public-methods
+    """Anything which can build a DoG transformation, e.g. the looptrace specification"""
+
+    @property
+    def transformation(  # pylint: disable=missing-function-docstring
+        self,
+    ) -> DifferenceOfGaussiansTransformation:
+        ...
+
+
+@doc(
+    summary="Estimate of the peak memory in use during one stage of detection",
+    parameters=dict(
+        name="Name of the stage of detection",
+        peak_bytes="Estimated peak number of bytes in use during the stage",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class StageEstimate:  # pylint: disable=missing-class-docstring
+    name: str
+    peak_bytes: int
+
+
+@doc(
+    summary="How to run DoG spot detection on an image, and how much memory that will take",
+    extended_summary="""
+        Without tiling, the transformation is applied to the whole image at once, exactly
+        as by the transformation itself. With tiling, the transformation is applied tile
+        by tile (each with enough surrounding context for the result to be unaffected),
+        by possibly several worker threads at once, writing into one output image of the
+        planned precision; standardisation, thresholding, labelling, and measurement
+        still run on the whole image.
+    """,
+    parameters=dict(
+        image_shape="Shape of the image in which spots will be detected",
+        image_dtype="Data type of the image in which spots will be detected",
+        memory_budget="Number of bytes available to detection",
+        tile_shape="Shape of the tiles in which to apply the transformation, or null to apply it to the whole image at once",
+        precision="Floating-point type of the transformed image, or null if detection is by intensity threshold (without transformation)",
+        workers="Number of tiles to transform concurrently",
+        stages="Estimated peak memory use of each stage of detection",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class ExecutionPlan:  # pylint: disable=missing-class-docstring,too-many-instance-attributes
+    image_shape: ImageShape
+    image_dtype: np.dtype  # type: ignore[type-arg]
+    memory_budget: int
+    tile_shape: Optional[ImageShape]
+    precision: Optional[type[np.floating]]  # type: ignore[type-arg]
+    workers: int
+    stages: tuple[StageEstimate, ...]
+
+    @property
+    def peak_bytes(self) -> int:
+        """Estimated peak memory use over all stages of detection"""
+        return max(s.peak_bytes for s in self.stages)
+
+    @property
+    def fits(self) -> bool:
+        """Whether the estimated peak memory use is within the budget"""
+        return self.peak_bytes <= self.memory_budget
+
+    def tiles(self) -> list[Region]:
+        """The regions in which to apply the transformation, in order"""
+        return grid_regions(
+            self.image_shape, block_shape=self.tile_shape or self.image_shape
+        )
+
+    def report(self) -> str:
+        """Text summary of the plan, for a dry run"""
+        lines = [
+            f"image: {self.image_shape} {self.image_dtype}",
+            f"budget: {_format_bytes(self.memory_budget)}",
+            f"tiling: {'none' if self.tile_shape is None else self.tile_shape}",
+            f"precision: {'none' if self.precision is None else np.dtype(self.precision).name}",
+            f"workers: {self.workers}",
+        ] + [f"  {s.name}: {_format_bytes(s.peak_bytes)}" for s in self.stages]
+        lines.append(
+            f"peak: {_format_bytes(self.peak_bytes)} ({'fits' if self.fits else 'EXCEEDS BUDGET'})"
+        )
+        return "\n".join(lines)
+
+
+@doc(
+    summary="Plan how to run spot detection on an image within a memory budget.",
+    extended_summary="""
+        Peak memory use is estimated per stage of detection--transformation,
+        standardisation, thresholding and labelling, label expansion--from the image
+        size and type and from the steps in the transformation. Plans are considered in
+        order of preference: no tiling (the reference behaviour), then tiling at double
+        precision, then tiling at single precision; for tiling, more workers and then
+        larger tiles are preferred. For detection by intensity threshold, there's no
+        transformation, and the only plan is to run detection as is. The first plan
+        which fits is chosen; if none fits,
+        the plan with the smallest estimated peak is returned, and its `fits` is false.
+        Estimates are approximate; they count the arrays which detection builds, not
+        interpreter overhead or allocator fragmentation, so leave some headroom.
+    """,
+    parameters=dict(
+        image_shape="Shape of the image in which spots will be detected",
+        image_dtype="Data type of the image in which spots will be detected",
+        transform="The DoG transformation (or a specification which builds one) to be used for detection, or null for detection by intensity threshold",
+        memory_budget="Number of bytes available to detection",
+        expand_px="The number of pixels by which detected regions will be expanded",
+        max_workers="Maximum number of tiles to transform concurrently; defaults to the number of CPUs",
+    ),
+    raises=dict(
+        ValueError="If the memory budget or maximum number of workers isn't positive, or if the image is empty",
+    ),
+    returns="The chosen plan, with its memory estimates",
+)
+def plan_detection(  # pylint: disable=missing-function-docstring,too-many-arguments
+    image_shape: ImageShape,
+    image_dtype: npt.DTypeLike,
+    *,
+    transform: Union[
+        None, DifferenceOfGaussiansTransformation, TransformationSpecification
+    ],
+    memory_budget: int,
+    expand_px: Optional[Union[int, float]] = None,
+    max_workers: Optional[int] = None,
+) -> ExecutionPlan:
+    if memory_budget <= 0:
+        raise ValueError(f"Memory budget must be positive; got {memory_budget}")
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers < 1:
+        raise ValueError(
+            f"Maximum number of workers must be positive; got {max_workers}"
+        )
+    if any(n < 1 for n in image_shape):
+        raise ValueError(f"Image shape must be 3 positive lengths; got {image_shape}")
+    dtype = np.dtype(image_dtype)
+    if transform is None:
+        return ExecutionPlan(
+            image_shape=image_shape,
+            image_dtype=dtype,
+            memory_budget=memory_budget,
+            tile_shape=None,
+            precision=None,
+            workers=1,
+            stages=_estimate_intensity_stages(
+                image_shape, dtype, expand=bool(expand_px)
+            ),
+        )
+    if not isinstance(transform, DifferenceOfGaussiansTransformation):
+        transform = transform.transformation
+    dog = transform
+
+    def build(
+        tile: Optional[ImageShape], precision: type[np.floating], workers: int  # type: ignore[type-arg]
+    ) -> ExecutionPlan:
+        return ExecutionPlan(
+            image_shape=image_shape,
+            image_dtype=dtype,
+            memory_budget=memory_budget,
+            tile_shape=tile,
+            precision=precision,
+            workers=workers,
+            stages=_estimate_stages(
+                image_shape,
+                dtype,
+                transform=dog,
+                tile=tile,
+                precision=precision,
+                workers=workers,
+                expand=bool(expand_px),
+            ),
+        )
+
+    # Plans are built only as needed, since usually an early one (often the first) fits.
+    leanest = build(None, np.float64, 1)
+    if leanest.fits:
+        return leanest
+    for precision in (np.float64, np.float32):
+        for workers in range(max_workers, 0, -1):
+            for tile in _candidate_tiles(image_shape):
+                plan = build(tile, precision, workers)
+                if plan.fits:
+                    return plan
+                if plan.peak_bytes < leanest.peak_bytes:
+                    leanest = plan
+    return leanest
+
+
+def _candidate_tiles(image_shape: ImageShape) -> Iterable[ImageShape]:
+    """Tiles which span z, halving in y and x from the whole image down to a minimum side"""
+    depth, height, width = image_shape
+    side = max(height, width)
+    while True:
+        yield (depth, min(side, height), min(side, width))
+        if side <= MIN_TILE_SIDE:
+            break
+        side = max(-(-side // 2), MIN_TILE_SIDE)
+
+
+def _estimate_stages(  # pylint: disable=too-many-arguments,too-many-locals
+    image_shape: ImageShape,
+    dtype: np.dtype,  # type: ignore[type-arg]
+    *,
+    transform: DifferenceOfGaussiansTransformation,
+    tile: Optional[ImageShape],
+    precision: type[np.floating],  # type: ignore[type-arg]
+    workers: int,
+    expand: bool,
+) -> tuple[StageEstimate, ...]:
+    num_pixels = int(np.prod(image_shape))
+    input_bytes = num_pixels * dtype.itemsize
+    if tile is None:
+        out_bytes = num_pixels * _BLUR_BYTES
+        transform_bytes = input_bytes + _transform_bytes(transform, num_pixels, dtype)
+        # Standardisation builds the shifted image, then the scaled image from that,
+        # while the transformation's intermediate arrays are still alive.
+        standardise_bytes = (
+            transform_bytes + 2 * out_bytes if transform.standardise else 0
+        )
+    else:
+        out_bytes = num_pixels * np.dtype(precision).itemsize
+        pad = transform.effective_support_radius
+        padded_pixels = int(
+            np.prod([min(t + 2 * pad, n) for t, n in zip(tile, image_shape)])
+        )
+        transform_bytes = (
+            input_bytes
+            + out_bytes
+            + workers * _transform_bytes(transform, padded_pixels, dtype)
+        )
+        # Standardisation is in place, one slab at a time.
+        standardise_bytes = input_bytes + out_bytes
+    label_bytes = input_bytes + out_bytes + num_pixels * (_BOOL_BYTES + _LABEL_BYTES)
+    stages = [
+        StageEstimate(name="transform", peak_bytes=transform_bytes),
+        StageEstimate(name="standardise", peak_bytes=standardise_bytes),
+        StageEstimate(name="threshold_and_label", peak_bytes=label_bytes),
+    ]
+    if expand:
+        stages.append(
+            StageEstimate(
+                name="expand_labels",
+                peak_bytes=input_bytes
+                + out_bytes
+                + num_pixels * (_LABEL_BYTES + _EXPAND_LABELS_BYTES),
+            )
+        )
+    stages.append(
+        StageEstimate(
+            name="measure",
+            peak_bytes=input_bytes + out_bytes + num_pixels * _LABEL_BYTES,
+        )
+    )
+    return tuple(stages)
+
+
+def _estimate_intensity_stages(
+    image_shape: ImageShape,
+    dtype: np.dtype,  # type: ignore[type-arg]
+    *,
+    expand: bool,
+) -> tuple[StageEstimate, ...]:
+    num_pixels = int(np.prod(image_shape))
+    input_bytes = num_pixels * dtype.itemsize
+    # Hole filling works on the thresholded mask, its complement, and the filled result.
+    threshold_bytes = input_bytes + 3 * num_pixels * _BOOL_BYTES
+    label_bytes = input_bytes + num_pixels * (_BOOL_BYTES + _LABEL_BYTES)
+    # Removal of small objects builds a relabelled copy of the labels.
+    remove_bytes = input_bytes + 2 * num_pixels * _LABEL_BYTES
+    stages = [
+        StageEstimate(name="threshold_and_fill", peak_bytes=threshold_bytes),
+        StageEstimate(name="label", peak_bytes=label_bytes),
+        StageEstimate(name="remove_small_objects", peak_bytes=remove_bytes),
+    ]
+    if expand:
+        stages.append(
+            StageEstimate(
+                name="expand_labels",
+                peak_bytes=input_bytes
+                + num_pixels * (_LABEL_BYTES + _EXPAND_LABELS_BYTES),
+            )
+        )
+    stages.append(
+        StageEstimate(
+            name="measure", peak_bytes=input_bytes + num_pixels * _LABEL_BYTES
+        )
+    )
+    return tuple(stages)
+
+
+def _transform_bytes(
+    transform: DifferenceOfGaussiansTransformation,
+    num_pixels: int,
+    dtype: np.dtype,  # type: ignore[type-arg]
+) -> int:
+    """Peak bytes of the arrays built by the (unstandardised) transformation of an image"""
+    # The pre-difference output is the size of the input; then the narrow and wide blurs
+    # (each of which builds a floating-point copy of its input) and their difference are
+    # all alive at once.
+    pre = num_pixels * dtype.itemsize if transform.pre_diff is not None else 0
+    blurs = 4 * num_pixels * _BLUR_BYTES
+    # Post-difference processing (e.g. division by a blur of the original image) typically
+    # builds another blur (with its own copy of the input) and a result.
+    post = 3 * num_pixels * _BLUR_BYTES if transform.post_diff is not None else 0
+    return pre + blurs + post
+
+
+def _format_bytes(num_bytes: int) -> str:
+    return f"{num_bytes / 2**20:.1f} MiB"
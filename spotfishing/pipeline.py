@@ -0,0 +1,150 @@
+"""Asynchronous pipeline of spot detection over many images, overlapping loading with detection"""
+
+import asyncio
+import inspect
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Generic,
+    Iterable,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+import numpy.typing as npt
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+
+from ._types import PixelValue
+from .detection_result import DetectionResult
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = ["DetectionPipeline", "PipelineResult"]
+
+Key = TypeVar("Key")
+
+Image = npt.NDArray[PixelValue]
+
+Loader = Union[Callable[[Key], Image], Callable[[Key], Awaitable[Image]]]
+
+Detector = Callable[[Image], DetectionResult]
+
+
+@doc(
+    summary="Spot detection result for one of the images of a pipeline",
+    parameters=dict(
+        key="The key by which the image was loaded",
+        result="The result of detecting spots in the image",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class PipelineResult(Generic[Key]):  # pylint: disable=missing-class-docstring
+    key: Key
+    result: DetectionResult
+
+
+@doc(
+    summary="Detection of spots in a stream of images, loading the next images while detecting in the current one",
+    extended_summary="""
+        Images are loaded in the background, up to `prefetch` of them at once, while
+        detection runs (in a worker thread, so that the event loop stays responsive) on
+        the image before them. A loader may be a coroutine function (e.g., for an
+        asynchronous storage client), or a plain function, which is then run in a worker
+        thread. Results come out in the order of the keys.
+
+        Memory is bounded: at most `prefetch` images are being loaded or waiting for
+        detection at any time, plus the one in detection. When the consumer of results
+        falls behind, no more images are loaded until it catches up. If the consumer
+        stops early, or any load or detection fails, images still being loaded are
+        abandoned, and the error (if any) is raised to the consumer. To stop early
+        promptly, close the iteration, e.g. with `contextlib.aclosing`.
+    """,
+    parameters=dict(
+        load="Function (plain or coroutine) which loads the image with the given key",
+        detect="Function which detects spots in an image, e.g. detect_spots_dog with its settings fixed",
+        prefetch="Greatest number of images to have loaded (or loading) ahead of detection",
+        executor="Executor in which to run detection, and plain loaders; if null, the event loop's default",
+    ),
+    raises=dict(
+        ValueError="If the number of images to prefetch isn't positive",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class DetectionPipeline(Generic[Key]):  # pylint: disable=missing-class-docstring
+    load: Loader[Key]
+    detect: Detector
+    prefetch: int = 2
+    executor: Optional[Executor] = None
+
+    def __post_init__(self) -> None:
+        if self.prefetch < 1:
+            raise ValueError(
+                f"Number of images to prefetch must be positive; got {self.prefetch}"
+            )
+
+    async def run(
+        self, keys: Union[Iterable[Key], AsyncIterable[Key]]
+    ) -> AsyncIterator[PipelineResult[Key]]:
+        """Detect spots in the image for each key, yielding each result in order of the keys."""
+        loop = asyncio.get_running_loop()
+        # Each slot is held from the start of an image's loading until its detection begins.
+        slots = asyncio.Semaphore(self.prefetch)
+        # Each key with its image's loading, in order of the keys; null marks the end.
+        pending: asyncio.Queue[
+            Optional[tuple[Key, asyncio.Future[Image]]]
+        ] = asyncio.Queue(maxsize=self.prefetch)
+
+        async def load_one(key: Key) -> Image:
+            if inspect.iscoroutinefunction(self.load):
+                return await self.load(key)  # type: ignore[no-any-return]
+            return await loop.run_in_executor(self.executor, self.load, key)  # type: ignore[arg-type]
+
+        async def produce() -> None:
+            try:
+                async for key in _as_async_iterable(keys):
+                    await slots.acquire()
+                    loading = asyncio.ensure_future(load_one(key))
+                    try:
+                        await pending.put((key, loading))
+                    except asyncio.CancelledError:
+                        loading.cancel()
+                        raise
+            finally:
+                await pending.put(None)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while (item := await pending.get()) is not None:
+                key, loading = item
+                try:
+                    image = await loading
+                finally:
+                    slots.release()
+                result = await loop.run_in_executor(self.executor, self.detect, image)
+                yield PipelineResult(key=key, result=result)
+            # Raise any error from iterating over the keys.
+            await producer
+        finally:
+            producer.cancel()
+            while not pending.empty():
+                item = pending.get_nowait()
+                if item is not None:
+                    item[1].cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+
+
+async def _as_async_iterable(
+    keys: Union[Iterable[Key], AsyncIterable[Key]]
+) -> AsyncIterator[Key]:
+    if isinstance(keys, AsyncIterable):
+        async for key in keys:
+            yield key
+    else:
+        for key in keys:
+            yield key
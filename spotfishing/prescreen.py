@@ -0,0 +1,125 @@
+"""Cheap, coarse screening of an image for regions which may contain spots"""
+
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+from scipy import ndimage as ndi
+
+from ._tiling import Region
+from ._types import PixelValue
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = ["PreScreen", "block_max", "find_candidate_regions"]
+
+Numeric = Union[int, float]
+
+BlockShape = tuple[int, int, int]
+
+
+@doc(
+    summary="Parameters for pre-screening an image for regions which may contain spots",
+    extended_summary="""
+        The image is reduced to the maximum of each of a grid of blocks, and only the
+        blocks whose maximum exceeds the signal floor--along with their immediate
+        neighbours, to catch the flanks of spots--are regarded as candidates to contain
+        spots. Detection then does the expensive work only within (and around, to the
+        extent needed by filter support) the candidate regions.
+
+        For detection by simple intensity threshold, the signal floor defaults to the
+        spot threshold, and the result is the same as without pre-screening. For
+        detection by difference of Gaussians, the threshold is in units of the
+        transformed image, so the floor must be given, in units of the input image,
+        as the level which no spot-containing region fails to exceed (e.g., a little
+        above background); see `detect_spots_dog` for how the image is transformed and
+        standardised when detection is restricted to regions.
+    """,
+    parameters=dict(
+        block_shape="Shape (z, y, x) of the blocks to which to reduce the image",
+        signal_floor="Input pixel value which a block's maximum must exceed for the block to be a candidate to contain spots",
+    ),
+    raises=dict(
+        ValueError="If the block shape isn't 3 positive integers",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class PreScreen:  # pylint: disable=missing-class-docstring
+    block_shape: BlockShape = (8, 32, 32)
+    signal_floor: Optional[Numeric] = None
+
+    def __post_init__(self) -> None:
+        if len(self.block_shape) != 3 or any(
+            int(s) != s or s < 1 for s in self.block_shape
+        ):
+            raise ValueError(
+                f"Block shape must be 3 positive integers; got {self.block_shape}"
+            )
+
+
+@doc(
+    summary="Reduce an image to the maximum value in each of a grid of blocks.",
+    parameters=dict(
+        image="The image to reduce",
+        block_shape="Shape of each block; the blocks at the far end of each axis may be smaller",
+    ),
+    returns="Array with one entry (the maximum pixel value) per block",
+)
+def block_max(  # pylint: disable=missing-function-docstring
+    image: npt.NDArray[PixelValue], *, block_shape: BlockShape
+) -> npt.NDArray[PixelValue]:
+    # Pad up to a whole number of blocks with the image's own minimum, which can't affect any block max.
+    num_blocks = [-(-n // b) for n, b in zip(image.shape, block_shape)]
+    pad_width = [
+        (0, nb * b - n) for nb, b, n in zip(num_blocks, block_shape, image.shape)
+    ]
+    padded = (
+        np.pad(image, pad_width, constant_values=image.min())
+        if any(after for _, after in pad_width)
+        else image
+    )
+    blocks = padded.reshape(
+        num_blocks[0],
+        block_shape[0],
+        num_blocks[1],
+        block_shape[1],
+        num_blocks[2],
+        block_shape[2],
+    )
+    return blocks.max(axis=(1, 3, 5))  # type: ignore[no-any-return]
+
+
+@doc(
+    summary="Find the regions of an image which may contain spots.",
+    parameters=dict(
+        image="The image to screen",
+        block_shape="Shape (z, y, x) of the blocks to which to reduce the image",
+        signal_floor="Input pixel value which a block's maximum must exceed for the block to be a candidate to contain spots",
+    ),
+    returns="Bounding boxes (in pixel coordinates) of the connected groups of candidate blocks; these may overlap, but each candidate pixel is in at least one; empty if the image has no candidate block",
+)
+def find_candidate_regions(  # pylint: disable=missing-function-docstring
+    image: npt.NDArray[PixelValue],
+    *,
+    block_shape: BlockShape,
+    signal_floor: Numeric,
+) -> list[Region]:
+    if image.size == 0:
+        return []
+    candidates = block_max(image, block_shape=block_shape) > signal_floor
+    if not candidates.any():
+        return []
+    # Include each candidate's neighbours, to catch the flanks of spots which straddle blocks.
+    full_connectivity = ndi.generate_binary_structure(3, 3)  # type: ignore[attr-defined]
+    candidates = ndi.binary_dilation(candidates, structure=full_connectivity)  # type: ignore[attr-defined]
+    groups, _ = ndi.label(candidates, structure=full_connectivity)  # type: ignore[attr-defined]
+    return [
+        tuple(  # type: ignore[misc]
+            slice(s.start * b, min(s.stop * b, n))
+            for s, b, n in zip(block_slices, block_shape, image.shape)
+        )
+        for block_slices in ndi.find_objects(groups)  # type: ignore[attr-defined]
+    ]
@@ -0,0 +1,293 @@
+"""Sub-pixel refinement of detected spots, for all spots of a detection at once"""
+
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+
+from ._exceptions import DimensionalityError
+from ._types import PixelValue
+from .crops import BoxShape, SpotCrops, extract_crops_at
+from .detection_result import DetectionResult
+from .roi_tools import SpotsTable, get_centroids_array
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = ["RefinedSpotKeys", "RefinementMethod", "refine_spots"]
+
+# default number of spots to fit at once, to bound the size of the stacked Jacobians
+DEFAULT_SPOTS_PER_BATCH = 2048
+
+# default number of Levenberg-Marquardt iterations
+DEFAULT_MAX_ITERATIONS = 25
+
+# smallest standard deviation allowed for a fitted spot, to keep the model well-defined
+MIN_SIGMA = 0.25
+
+# relative decrease in cost below which a spot's fit is regarded as converged
+_RELATIVE_TOLERANCE = 1e-8
+
+# damping above which a spot's fit is regarded as unable to make further progress
+_MAX_DAMPING = 1e8
+
+# parameter order for the 3D Gaussian model: background, amplitude, center (z, y, x), sigma (z, xy)
+_NUM_PARAMS = 7
+
+
+class RefinementMethod(Enum):
+    """How to estimate each spot's sub-pixel center, spread, and amplitude"""
+
+    MOMENTS = "moments"
+    GAUSSIAN_FIT = "gaussian_fit"
+
+
+class RefinedSpotKeys(Enum):
+    """The keys (column names) added to a table of spots by refinement"""
+
+    Z = "zcFit"
+    Y = "ycFit"
+    X = "xcFit"
+    SIGMA_Z = "sigmaZ"
+    SIGMA_XY = "sigmaXY"
+    AMPLITUDE = "amplitude"
+    BACKGROUND = "background"
+    SUCCESS = "fitSuccess"
+
+    @classmethod
+    def to_list(cls) -> list[str]:  # pylint: disable=missing-function-docstring
+        return [m.value for m in cls]
+
+
+@doc(
+    summary="Refine the center of every detected spot by fitting a 3D Gaussian, all spots at once.",
+    extended_summary="""
+        A box is cropped around each spot (see extract_spot_crops), and the crops are
+        stacked so that the model of each spot--constant background plus a Gaussian with
+        one spread along z and another shared by y and x--is fit by Levenberg-Marquardt
+        iterations which run over all spots of a batch simultaneously, rather than one
+        optimisation per spot. The moment-based estimator, which is used anyway to
+        initialise the fit, is much cheaper still and is available on its own. A fit is
+        regarded as a success if its parameters are finite, and its center lies within
+        the spot's crop.
+    """,
+    parameters=dict(
+        data="Detection result, or table of detected spots",
+        box_shape="Side lengths (dz, dy, dx) of the box around each spot to which to fit",
+        image="Image in which to refine spots; if omitted, the image of the detection result is used, but generally the image which was input to detection is what should be given",
+        method="How to estimate the spot parameters",
+        max_iterations="Number of Levenberg-Marquardt iterations, for fitting",
+        spots_per_batch="Number of spots to fit at once",
+    ),
+    raises=dict(
+        DimensionalityError="If the image isn't 3D",
+        ValueError="If the box shape isn't 3 positive integers, if the number of spots per batch isn't positive, or if no image is available",
+    ),
+    returns="Copy of the spots table, with fitted center, spread, amplitude, background, and fit success columns added",
+)
+def refine_spots(  # pylint: disable=missing-function-docstring,too-many-locals
+    data: SpotsTable,
+    *,
+    box_shape: BoxShape,
+    image: Optional[npt.NDArray[PixelValue]] = None,
+    method: RefinementMethod = RefinementMethod.GAUSSIAN_FIT,
+    max_iterations: int = DEFAULT_MAX_ITERATIONS,
+    spots_per_batch: int = DEFAULT_SPOTS_PER_BATCH,
+) -> pd.DataFrame:
+    table = data.table if isinstance(data, DetectionResult) else data
+    if image is None:
+        if not isinstance(data, DetectionResult):
+            raise ValueError("An image is required to refine spots from a table")
+        image = data.image
+    if image.ndim != 3:
+        raise DimensionalityError(
+            f"Expected 3D image in which to refine spots but got {image.ndim}-dimensional"
+        )
+    if len(box_shape) != 3 or any(int(s) != s or s < 1 for s in box_shape):
+        raise ValueError(f"Box shape must be 3 positive integers; got {box_shape}")
+    if spots_per_batch < 1:
+        raise ValueError(
+            f"Number of spots per batch must be positive; got {spots_per_batch}"
+        )
+    centers = get_centroids_array(table)
+    params = np.empty((len(centers), _NUM_PARAMS), dtype=np.float64)
+    success = np.empty(len(centers), dtype=bool)
+    for start in range(0, len(centers), spots_per_batch):
+        batch = slice(start, start + spots_per_batch)
+        crops = extract_crops_at(
+            image,
+            centers=centers[batch],
+            box_shape=box_shape,
+            fill_value=0,
+            spots_per_chunk=spots_per_batch,
+        )
+        params[batch], success[batch] = _estimate_parameters(
+            crops, method=method, max_iterations=max_iterations
+        )
+    refined = table.copy()
+    for key, values in zip(RefinedSpotKeys, _to_output_columns(params)):
+        refined[key.value] = values
+    refined[RefinedSpotKeys.SUCCESS.value] = success
+    return refined
+
+
+def _estimate_parameters(
+    crops: SpotCrops, *, method: RefinementMethod, max_iterations: int
+) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.bool_]]:
+    values = crops.crops.reshape(len(crops), -1).astype(np.float64)
+    weights = crops.valid.reshape(len(crops), -1).astype(np.float64)
+    grid = _local_grid(crops.crops.shape[1:])
+    params = _moments(values, weights=weights, grid=grid)
+    if method == RefinementMethod.GAUSSIAN_FIT:
+        params = _levenberg_marquardt(
+            params, values=values, weights=weights, grid=grid, iterations=max_iterations
+        )
+    elif method != RefinementMethod.MOMENTS:
+        raise ValueError(f"Unsupported refinement method: {method}")
+    box = np.asarray(crops.crops.shape[1:], dtype=np.float64)
+    centers = params[:, 2:5]
+    success = (
+        np.all(np.isfinite(params), axis=1)
+        & np.all(centers >= -0.5, axis=1)
+        & np.all(centers <= box - 0.5, axis=1)
+    )
+    # Move centers from crop-local to image coordinates.
+    params[:, 2:5] += crops.origins
+    return params, success
+
+
+def _local_grid(shape: tuple[int, ...]) -> npt.NDArray[np.float64]:
+    """(3, M) array of the (z, y, x) coordinates of each voxel of a crop of the given shape"""
+    return np.indices(shape, dtype=np.float64).reshape(3, -1)
+
+
+def _moments(
+    values: npt.NDArray[np.float64],
+    *,
+    weights: npt.NDArray[np.float64],
+    grid: npt.NDArray[np.float64],
+) -> npt.NDArray[np.float64]:
+    """Estimate model parameters from background-subtracted intensity moments of each crop."""
+    masked = np.where(weights > 0, values, np.inf)
+    background = np.min(masked, axis=1)
+    background = np.where(np.isfinite(background), background, 0.0)
+    signal = np.clip(values - background[:, None], 0, None) * weights
+    total = signal.sum(axis=1)
+    amplitude = signal.max(axis=1)
+    safe_total = np.where(total > 0, total, 1.0)
+    center = (signal @ grid.T) / safe_total[:, None]
+    # Fall back to crop center where there's no signal at all.
+    center = np.where(total[:, None] > 0, center, (grid.max(axis=1) / 2)[None, :])
+    sq_dev = (grid[None, :, :] - center[:, :, None]) ** 2
+    # subscripts: s(pot), a(xis), p(ixel)
+    var = np.einsum("sp,sap->sa", signal, sq_dev) / safe_total[:, None]
+    sigma_z = np.sqrt(var[:, 0])
+    sigma_xy = np.sqrt((var[:, 1] + var[:, 2]) / 2)
+    params = np.column_stack([background, amplitude, center, sigma_z, sigma_xy])
+    params[:, 5:] = np.clip(params[:, 5:], MIN_SIGMA, None)
+    return params
+
+
+def _model(  # pylint: disable=invalid-name
+    params: npt.NDArray[np.float64], *, grid: npt.NDArray[np.float64]
+) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]:
+    """Evaluate the model (N, M) for each spot's parameters, along with its Gaussian part."""
+    # The Gaussian is separable, so exponentials are needed only along each axis of the crop.
+    axes = [np.unique(grid[i]) for i in range(3)]
+    gz, gy, gx = (
+        np.exp(-((ax[None, :] - params[:, 2 + i, None]) ** 2) / (2 * sig**2))
+        for i, (ax, sig) in enumerate(
+            zip(axes, (params[:, 5, None], params[:, 6, None], params[:, 6, None]))
+        )
+    )
+    gauss = (
+        gz[:, :, None, None] * gy[:, None, :, None] * gx[:, None, None, :]
+    ).reshape(params.shape[0], -1)
+    return params[:, 0, None] + params[:, 1, None] * gauss, gauss
+
+
+def _jacobian(  # pylint: disable=invalid-name
+    params: npt.NDArray[np.float64],
+    *,
+    grid: npt.NDArray[np.float64],
+    gauss: npt.NDArray[np.float64],
+) -> npt.NDArray[np.float64]:
+    """Evaluate the model's Jacobian, as an (N, 7, M) array so that it's ready for batched matrix products."""
+    sz, sxy = params[:, 5, None], params[:, 6, None]
+    dz = grid[None, 0] - params[:, 2, None]
+    dy = grid[None, 1] - params[:, 3, None]
+    dx = grid[None, 2] - params[:, 4, None]
+    ag = params[:, 1, None] * gauss
+    jac = np.empty((params.shape[0], _NUM_PARAMS, grid.shape[1]), dtype=np.float64)
+    jac[:, 0] = 1.0
+    jac[:, 1] = gauss
+    np.multiply(ag, dz / sz**2, out=jac[:, 2])
+    np.multiply(ag, dy / sxy**2, out=jac[:, 3])
+    np.multiply(ag, dx / sxy**2, out=jac[:, 4])
+    np.multiply(jac[:, 2], dz / sz, out=jac[:, 5])
+    np.multiply(jac[:, 3], dy / sxy, out=jac[:, 6])
+    jac[:, 6] += jac[:, 4] * (dx / sxy)
+    return jac
+
+
+def _levenberg_marquardt(  # pylint: disable=too-many-locals
+    params: npt.NDArray[np.float64],
+    *,
+    values: npt.NDArray[np.float64],
+    weights: npt.NDArray[np.float64],
+    grid: npt.NDArray[np.float64],
+    iterations: int,
+) -> npt.NDArray[np.float64]:
+    """Run LM iterations for all spots at once, with a separate damping factor per spot.
+
+    Spots drop out of the iterations as they converge, so that later iterations
+    (which typically refine only a few stragglers) are cheaper than the first ones.
+    """
+    params = params.copy()
+    damping = np.full(params.shape[0], 1e-3)
+    model, gauss = _model(params, grid=grid)
+    cost = np.sum(weights * (model - values) ** 2, axis=1)
+    active = np.arange(params.shape[0])
+    for _ in range(iterations):
+        if active.size == 0:
+            break
+        current, active_weights = params[active], weights[active]
+        jac = _jacobian(current, grid=grid, gauss=gauss[active])
+        wjac = jac * active_weights[:, None, :]
+        hessian = wjac @ jac.transpose(0, 2, 1)
+        gradient = wjac @ (model[active] - values[active])[:, :, None]
+        diag = np.einsum("nii->ni", hessian)  # writeable view of each diagonal
+        diag *= 1 + damping[active, None]
+        diag += 1e-12
+        try:
+            step = np.linalg.solve(hessian, -gradient)[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = (np.linalg.pinv(hessian) @ -gradient)[:, :, 0]
+        candidate = current + step
+        candidate[:, 5:] = np.clip(candidate[:, 5:], MIN_SIGMA, None)
+        new_model, new_gauss = _model(candidate, grid=grid)
+        new_cost = np.sum(active_weights * (new_model - values[active]) ** 2, axis=1)
+        old_cost = cost[active]
+        improved = new_cost < old_cost
+        accepted = active[improved]
+        params[accepted] = candidate[improved]
+        model[accepted] = new_model[improved]
+        gauss[accepted] = new_gauss[improved]
+        cost[accepted] = new_cost[improved]
+        damping[active] = np.where(improved, damping[active] / 10, damping[active] * 10)
+        converged = (
+            improved & (old_cost - new_cost <= _RELATIVE_TOLERANCE * old_cost)
+        ) | (damping[active] > _MAX_DAMPING)
+        active = active[~converged]
+    return params
+
+
+def _to_output_columns(
+    params: npt.NDArray[np.float64],
+) -> list[npt.NDArray[np.float64]]:
+    """Order parameter columns to match RefinedSpotKeys (all but the success flag)."""
+    # z, y, x, sigma_z, sigma_xy, amplitude, background, by the model's parameter order
+    return [params[:, i] for i in (2, 3, 4, 5, 6, 1, 0)]
@@ -1,15 +1,29 @@
 """Tools for working with spots/ROIs"""
 
-from typing import Mapping, TypeAlias
+from dataclasses import dataclass
+from typing import Iterator, Mapping, TypeAlias, Union
 
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
 from gertils.geometry import ImagePoint3D
 from numpydoc_decorator import doc  # type: ignore[import-untyped]
 from pandas import Series
 
-from .detection_result import RoiCenterKeys
+from ._exceptions import DimensionalityError
+from .detection_result import DetectionResult, RoiCenterKeys
+
+__all__ = [
+    "RoiCentroids",
+    "get_centroid_from_record",
+    "get_centroids_array",
+    "get_centroids_from_table",
+]
 
 Record: TypeAlias = Series | Mapping[str, object]  # type: ignore[explicit-any]
 
+SpotsTable: TypeAlias = Union[DetectionResult, pd.DataFrame]
+
 
 @doc(
     summary="Get region centroid from data row.",
@@ -30,3 +44,77 @@ def get_centroid_from_record(  # pylint: disable=missing-function-docstring
         y=rec[RoiCenterKeys.Y.value],  # type: ignore[arg-type]
         x=rec[RoiCenterKeys.X.value],  # type: ignore[arg-type]
     )
+
+
+@doc(
+    summary="Get all region centroids from a table as a single (N, 3) array.",
+    extended_summary="""
+        This is the bulk counterpart of get_centroid_from_record; rather than building
+        one point object per row, the (z, y, x) columns are pulled out of the table in
+        one vectorised step. Row order of the table is preserved.
+    """,
+    parameters=dict(
+        data="Detection result, or table with the (z, y, x) centroid columns",
+    ),
+    raises=dict(
+        KeyError="If any of the required coordinate columns isn't present in the table",
+    ),
+    returns="Array of floating-point (z, y, x) coordinates, one row per table row",
+)
+def get_centroids_array(  # pylint: disable=missing-function-docstring
+    data: SpotsTable,
+) -> npt.NDArray[np.float64]:
+    table = data.table if isinstance(data, DetectionResult) else data
+    return table[RoiCenterKeys.to_list()].to_numpy(dtype=np.float64)
+
+
+@doc(
+    summary="Compact collection of region centroids, backed by a single (N, 3) array",
+    extended_summary="""
+        Point objects are built only on access (indexing or iteration), so the cost of
+        constructing an ImagePoint3D is paid only for centroids which are actually used
+        in that form.
+    """,
+    parameters=dict(
+        coordinates="Array of (z, y, x) coordinates, one row per centroid",
+    ),
+    raises=dict(
+        DimensionalityError="If the given coordinates aren't an (N, 3) array",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class RoiCentroids:  # pylint: disable=missing-class-docstring
+    coordinates: npt.NDArray[np.float64]
+
+    def __post_init__(self) -> None:
+        if self.coordinates.ndim != 2 or self.coordinates.shape[1] != 3:
+            raise DimensionalityError(
+                f"Centroid coordinates must be an (N, 3) array, not of shape {self.coordinates.shape}"
+            )
+
+    def __len__(self) -> int:
+        return self.coordinates.shape[0]
+
+    def __getitem__(self, index: int) -> ImagePoint3D:
+        point = self.coordinates[index]
+        return ImagePoint3D(z=float(point[0]), y=float(point[1]), x=float(point[2]))
+
+    def __iter__(self) -> Iterator[ImagePoint3D]:
+        for point in self.coordinates.tolist():
+            yield ImagePoint3D(z=point[0], y=point[1], x=point[2])
+
+
+@doc(
+    summary="Get all region centroids from a table as a compact point collection.",
+    parameters=dict(
+        data="Detection result, or table with the (z, y, x) centroid columns",
+    ),
+    raises=dict(
+        KeyError="If any of the required coordinate columns isn't present in the table",
+    ),
+    returns="Collection of the table's centroids, in row order",
+)
+def get_centroids_from_table(  # pylint: disable=missing-function-docstring
+    data: SpotsTable,
+) -> RoiCentroids:
+    return RoiCentroids(coordinates=get_centroids_array(data))
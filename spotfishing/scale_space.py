@@ -0,0 +1,299 @@
+"""DoG spot detection at several scales, sharing the preprocessing and Gaussian blurs among scales"""
+
+from dataclasses import dataclass
+from typing import Optional, Sequence, Union, cast
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+from skimage.filters import gaussian as gaussian_filter
+
+from ._constants import ROI_SCALE_KEY
+from ._measurement import check_input_image, detect_in_transformed
+from ._types import Image, ImageEndomorphism, NumpyFloat, PixelValue
+from .detection_result import DetectionResult
+from .dog_transform import (
+    DifferenceOfGaussiansTransformation,
+    PostDifferenceTransformation,
+    gaussian_radius,
+    is_numeric,
+)
+from .spatial_index import VoxelSize, deduplicate_spots
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = [
+    "ScaleSpaceDetectionResult",
+    "ScaleSpaceTransformation",
+    "detect_spots_multiscale",
+]
+
+# (narrow, wide) indices into the sigmas of a scale space
+ScalePair = tuple[int, int]
+
+Numeric = Union[int, float]
+
+FloatImage = npt.NDArray[NumpyFloat]
+
+
+@doc(
+    summary="Bundle of parameters defining DoG transformation at several scales, sharing the steps which don't depend on scale",
+    extended_summary="""
+        The preprocessing is done once, and the Gaussian blurs are built as a stack, each
+        level blurred from the one before by the Gaussian which makes up the difference
+        in variance (sqrt(sigma_k^2 - sigma_(k-1)^2)), so each blur is cheaper than
+        blurring the image from scratch. The preprocessed image is first padded (by
+        repeating its edges) by the kernel radius of the widest Gaussian, so that
+        blurring level by level matches blurring from scratch (with skimage's default
+        'nearest' boundary mode) up to the sampling of the kernels. Each scale is the
+        difference of the blurs of a pair of sigmas, to which the post-difference step
+        and any standardisation are applied separately, as by the equivalent
+        single-scale transformation (see single_scale).
+    """,
+    parameters=dict(
+        pre_diff="Transformation to apply to image before taking differences of smoothed versions",
+        sigmas="Strictly increasing standard deviations of the Gaussians with which to blur the image",
+        post_diff="What (if anything) to do to each difference before standardisation; as for DifferenceOfGaussiansTransformation, this is fed the original image and the difference",
+        standardise="Whether to standardise each difference to mean 0 and standard deviation 1",
+        pairs="Pairs of (narrow, wide) indices into the sigmas, each defining a scale as the difference of those blurs; adjacent sigmas if omitted",
+        batch_post_diff="Whether to apply the post-difference step once, to the stack (along a new first axis) of all scales' differences, rather than once per scale; only for a step which broadcasts over that axis, e.g. division by a blur of the original image (as for looptrace), which is then computed once",
+    ),
+    raises=dict(
+        TypeError="If any sigma is non-numeric",
+        ValueError="If there are fewer than two sigmas, or they're not positive and strictly increasing, or if a pair isn't of increasing indices into the sigmas, or pairs are repeated",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class ScaleSpaceTransformation:  # pylint: disable=missing-class-docstring
+    pre_diff: Optional[ImageEndomorphism]
+    sigmas: tuple[Numeric, ...]
+    post_diff: Optional[PostDifferenceTransformation]
+    standardise: bool
+    pairs: Optional[tuple[ScalePair, ...]] = None
+    batch_post_diff: bool = False
+
+    def __post_init__(self) -> None:
+        if not all(is_numeric(s) for s in self.sigmas):
+            raise TypeError(f"At least one sigma is non-numeric: {self.sigmas}")
+        if len(self.sigmas) < 2:
+            raise ValueError(f"Need at least 2 sigmas; got {len(self.sigmas)}")
+        if self.sigmas[0] <= 0 or any(
+            s <= t for s, t in zip(self.sigmas[1:], self.sigmas[:-1])
+        ):
+            raise ValueError(
+                f"Sigmas must be positive and strictly increasing; got {self.sigmas}"
+            )
+        if self.pairs is not None:
+            if len(self.pairs) == 0:
+                raise ValueError("Need at least 1 pair of sigmas")
+            for pair in self.pairs:
+                if len(pair) != 2 or not 0 <= pair[0] < pair[1] < len(self.sigmas):
+                    raise ValueError(
+                        f"Each pair must be of increasing indices into the {len(self.sigmas)} sigmas; got {pair}"
+                    )
+            if len(set(self.pairs)) != len(self.pairs):
+                raise ValueError(f"Repeated pair(s) of sigmas: {self.pairs}")
+
+    @classmethod
+    def from_transformation(
+        cls,
+        transform: DifferenceOfGaussiansTransformation,
+        *,
+        sigmas: Sequence[Numeric],
+        pairs: Optional[Sequence[ScalePair]] = None,
+        batch_post_diff: bool = False,
+    ) -> "ScaleSpaceTransformation":
+        """Take the steps which don't depend on scale from the given single-scale transformation, e.g. the looptrace one."""
+        return cls(
+            pre_diff=transform.pre_diff,
+            sigmas=tuple(sigmas),
+            post_diff=transform.post_diff,
+            standardise=transform.standardise,
+            pairs=None if pairs is None else tuple(tuple(p) for p in pairs),  # type: ignore[misc]
+            batch_post_diff=batch_post_diff,
+        )
+
+    @property
+    def scale_pairs(self) -> tuple[ScalePair, ...]:
+        """The (narrow, wide) indices into the sigmas of each scale"""
+        return (
+            tuple((i, i + 1) for i in range(len(self.sigmas) - 1))
+            if self.pairs is None
+            else self.pairs
+        )
+
+    @property
+    def scales(self) -> tuple[tuple[Numeric, Numeric], ...]:
+        """The (narrow, wide) sigmas of each scale"""
+        return tuple((self.sigmas[i], self.sigmas[j]) for i, j in self.scale_pairs)
+
+    def single_scale(self, scale: int) -> DifferenceOfGaussiansTransformation:
+        """The transformation which, by itself, computes the given (by index) scale of this one"""
+        sigma_narrow, sigma_wide = self.scales[scale]
+        return DifferenceOfGaussiansTransformation(
+            pre_diff=self.pre_diff,
+            sigma_narrow=sigma_narrow,
+            sigma_wide=sigma_wide,
+            post_diff=self.post_diff,
+            standardise=self.standardise,
+        )
+
+    @doc(
+        summary="Apply the transformation at each scale to the given image.",
+        parameters=dict(input_image="The image (array of pixel values) to transform"),
+        returns="The transformed image for each scale, in order of the scales",
+    )
+    def __call__(  # pylint: disable=too-many-locals
+        self, input_image: Image
+    ) -> list[FloatImage]:
+        img = self.pre_diff(input_image) if self.pre_diff is not None else input_image
+        pairs = self.scale_pairs
+        top = max(j for _, j in pairs)
+        pad = gaussian_radius(self.sigmas[top])
+        inner = tuple(slice(pad, pad + n) for n in img.shape)
+        # the last level (index) at which each blur is needed, so that it can be dropped after
+        last_use: dict[int, int] = {}
+        for i, j in pairs:
+            last_use[i] = max(last_use.get(i, j), j)
+            last_use[j] = max(last_use.get(j, j), j)
+
+        batch = self.batch_post_diff and self.post_diff is not None
+        differences: Optional[npt.NDArray[np.float64]] = (
+            np.empty((len(pairs),) + img.shape, dtype=np.float64) if batch else None
+        )
+        results: list[Optional[FloatImage]] = [None] * len(pairs)
+        blurs: dict[int, FloatImage] = {}
+        level = np.pad(img, pad, mode="edge")
+        previous_sigma = 0.0
+        for k in range(top + 1):
+            sigma = self.sigmas[k]
+            level = gaussian_filter(level, np.sqrt(sigma**2 - previous_sigma**2))
+            previous_sigma = sigma
+            if k in last_use:
+                blurs[k] = level[inner]
+            for pair_index, (i, j) in enumerate(pairs):
+                if j != k:
+                    continue
+                if differences is None:
+                    results[pair_index] = self._finish(
+                        self._post(input_image, blurs[i] - blurs[j])
+                    )
+                else:
+                    np.subtract(blurs[i], blurs[j], out=differences[pair_index])
+            blurs = {i: b for i, b in blurs.items() if last_use[i] > k}
+        if differences is not None:
+            processed = self._post(input_image, differences)
+            results = [self._finish(d) for d in processed]
+        return results  # type: ignore[return-value]
+
+    def _post(self, input_image: Image, img: FloatImage) -> FloatImage:
+        if self.post_diff is None:
+            return img
+        # The difference of Gaussians is float, though the protocol types it as an image.
+        processed: FloatImage = self.post_diff(old_img=input_image, new_img=img)  # type: ignore[arg-type,assignment]
+        return processed
+
+    def _finish(self, img: FloatImage) -> FloatImage:
+        return (img - np.mean(img)) / np.std(img) if self.standardise else img
+
+
+@doc(
+    summary="The result of spot detection at each of several scales",
+    parameters=dict(
+        scales="The (narrow, wide) sigmas of each scale",
+        results="The result of detection at each scale, in order of the scales",
+    ),
+    raises=dict(ValueError="If the numbers of scales and results differ"),
+)
+@dataclass(frozen=True, kw_only=True)
+class ScaleSpaceDetectionResult:  # pylint: disable=missing-class-docstring
+    scales: tuple[tuple[Numeric, Numeric], ...]
+    results: tuple[DetectionResult, ...]
+
+    def __post_init__(self) -> None:
+        if len(self.scales) != len(self.results):
+            raise ValueError(
+                f"Need a result for each scale; got {len(self.results)} result(s) for {len(self.scales)} scale(s)"
+            )
+
+    @doc(
+        summary="Combine the tables of all scales, with the index of each spot's scale in a new column.",
+        parameters=dict(
+            min_distance="If given, spots (of any scales) within this distance of each other are collapsed to the brightest",
+            voxel_size="Physical size of a voxel in (z, y, x), for the distance between spots",
+        ),
+        returns="Table of the spots from each scale, in order of the scales, then as for the scale",
+    )
+    def merged_table(  # pylint: disable=missing-function-docstring
+        self,
+        *,
+        min_distance: Optional[Numeric] = None,
+        voxel_size: VoxelSize = (1, 1, 1),
+    ) -> pd.DataFrame:
+        table = pd.concat(
+            [
+                r.table.assign(**{ROI_SCALE_KEY: np.full(r.table.shape[0], i)})
+                for i, r in enumerate(self.results)
+            ],
+            ignore_index=True,
+        )
+        if min_distance is not None:
+            table = deduplicate_spots(
+                table, min_distance=min_distance, voxel_size=voxel_size
+            )
+        return table
+
+
+@doc(
+    summary="Detect spots by difference of Gaussians filter at several scales.",
+    extended_summary="""
+        The image is transformed at all scales at once (see ScaleSpaceTransformation),
+        and spots are then detected in each scale's transformed image as by
+        detect_spots_dog.
+    """,
+    parameters=dict(
+        input_image="3D image in which to detect spots",
+        spot_threshold="The minimum (after transformation) pixel value required to regard a pixel as part of a spot, for all scales or for each",
+        expand_px="The number of pixels by which to expand a detected and defined region",
+        transform="The multi-scale DoG transformation",
+    ),
+    returns="The scales, and for each, the table of ROI coordinates and data, transformed image, and region labels array",
+    raises=dict(
+        TypeError="If the given `transform` isn't specifically a `ScaleSpaceTransformation`",
+        ValueError="If thresholds are given for each scale, but their number isn't the number of scales",
+    ),
+)
+def detect_spots_multiscale(  # pylint: disable=missing-function-docstring
+    input_image: npt.NDArray[PixelValue],
+    *,
+    spot_threshold: Union[Numeric, Sequence[Numeric]],
+    expand_px: Optional[Numeric],
+    transform: ScaleSpaceTransformation,
+) -> ScaleSpaceDetectionResult:
+    check_input_image(input_image)
+    if not isinstance(transform, ScaleSpaceTransformation):
+        raise TypeError(
+            f"For multi-scale detection, the transformation must be of type {ScaleSpaceTransformation.__name__}; got {type(transform).__name__}"
+        )
+    num_scales = len(transform.scale_pairs)
+    thresholds = cast(
+        list[Numeric],
+        (
+            [spot_threshold] * num_scales
+            if is_numeric(spot_threshold)
+            else list(spot_threshold)  # type: ignore[arg-type]
+        ),
+    )
+    if len(thresholds) != num_scales:
+        raise ValueError(
+            f"Need a threshold for each of the {num_scales} scale(s); got {len(thresholds)}"
+        )
+    results = [
+        detect_in_transformed(
+            img, input_image=input_image, spot_threshold=threshold, expand_px=expand_px
+        )
+        for img, threshold in zip(transform(input_image), thresholds)
+    ]
+    return ScaleSpaceDetectionResult(scales=transform.scales, results=tuple(results))
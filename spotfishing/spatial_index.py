@@ -0,0 +1,247 @@
+"""Spatial indexing of detected spots, for neighbour queries and deduplication"""
+
+from dataclasses import dataclass
+from enum import Enum
+from functools import cached_property
+from typing import Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from ._constants import ROI_AREA_KEY, ROI_MEAN_INTENSITY_KEY_CAMEL_CASE
+from ._exceptions import DimensionalityError
+from .detection_result import DetectionResult, RoiCenterKeys
+from .roi_tools import SpotsTable, get_centroids_array
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = [
+    "DeduplicationStrategy",
+    "SpotSpatialIndex",
+    "deduplicate_spots",
+]
+
+Numeric = Union[int, float]
+
+VoxelSize = tuple[Numeric, Numeric, Numeric]
+
+
+class DeduplicationStrategy(Enum):
+    """How to reduce a group of mutually-close spots to a single spot"""
+
+    KEEP_FIRST = "keep_first"
+    KEEP_BRIGHTEST = "keep_brightest"
+    MERGE = "merge"
+
+
+@doc(
+    summary="KD-tree over spot centroids, for radius and nearest-neighbour queries",
+    extended_summary="""
+        Coordinates are stored and given to queries in (z, y, x) pixel units, but
+        distances are always in the physical units defined by the voxel size, so that
+        anisotropic sampling (typically coarser in z) is accounted for.
+    """,
+    parameters=dict(
+        coordinates="Array of (z, y, x) spot centroids, in pixel units",
+        voxel_size="Physical size of a voxel along each of (z, y, x)",
+    ),
+    raises=dict(
+        DimensionalityError="If the coordinates aren't an (N, 3) array",
+        ValueError="If any component of the voxel size isn't strictly positive",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class SpotSpatialIndex:  # pylint: disable=missing-class-docstring
+    coordinates: npt.NDArray[np.float64]
+    voxel_size: VoxelSize = (1, 1, 1)
+
+    def __post_init__(self) -> None:
+        if self.coordinates.ndim != 2 or self.coordinates.shape[1] != 3:
+            raise DimensionalityError(
+                f"Spot coordinates must be an (N, 3) array, not of shape {self.coordinates.shape}"
+            )
+        if len(self.voxel_size) != 3 or any(s <= 0 for s in self.voxel_size):
+            raise ValueError(
+                f"Voxel size must be 3 strictly positive values; got {self.voxel_size}"
+            )
+
+    @classmethod
+    def from_table(
+        cls, data: SpotsTable, *, voxel_size: VoxelSize = (1, 1, 1)
+    ) -> "SpotSpatialIndex":
+        """Build the index from the centroid columns of a detection result or table."""
+        return cls(coordinates=get_centroids_array(data), voxel_size=voxel_size)
+
+    def __len__(self) -> int:
+        return self.coordinates.shape[0]
+
+    @doc(
+        summary="Find the indexed spots within given distance of each query point.",
+        parameters=dict(
+            points="Array of (z, y, x) query points, in pixel units",
+            radius="Maximum (physical) distance from a query point",
+        ),
+        returns="For each query point, the sorted indices of the indexed spots within the radius",
+    )
+    def query_radius(  # pylint: disable=missing-function-docstring
+        self, points: npt.NDArray[np.float64], radius: Numeric
+    ) -> list[npt.NDArray[np.intp]]:
+        hits = self._tree.query_ball_point(self._scale(points), r=radius)
+        return [np.sort(np.asarray(h, dtype=np.intp)) for h in hits]
+
+    @doc(
+        summary="Find the k indexed spots nearest to each query point.",
+        parameters=dict(
+            points="Array of (z, y, x) query points, in pixel units",
+            k="Number of neighbours to find for each query point",
+        ),
+        returns="Pair of (M, k) arrays of (physical) distances and indices, ordered by increasing distance; missing neighbours have infinite distance and index equal to the number of indexed spots",
+        raises=dict(ValueError="If k is less than 1"),
+    )
+    def query_nearest(  # pylint: disable=missing-function-docstring
+        self, points: npt.NDArray[np.float64], k: int
+    ) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.intp]]:
+        if k < 1:
+            raise ValueError(f"Number of neighbours must be at least 1; got {k}")
+        dists, idxs = self._tree.query(self._scale(points), k=[i + 1 for i in range(k)])
+        return dists, idxs
+
+    @doc(
+        summary="Find all pairs of indexed spots within given distance of each other.",
+        parameters=dict(radius="Maximum (physical) distance between spots of a pair"),
+        returns="(M, 2) array of index pairs (i, j), with i < j",
+    )
+    def pairs_within(  # pylint: disable=missing-function-docstring
+        self, radius: Numeric
+    ) -> npt.NDArray[np.intp]:
+        return self._tree.query_pairs(r=radius, output_type="ndarray").astype(np.intp)  # type: ignore[no-any-return]
+
+    @doc(
+        summary="Group the indexed spots by chains of proximity.",
+        extended_summary="""
+            Two spots are in the same group if they're within the radius of each other,
+            or if they're linked by a chain of spots which are each within the radius
+            of the next (i.e., single-linkage clustering).
+        """,
+        parameters=dict(radius="Maximum (physical) distance between linked spots"),
+        returns="Group index for each indexed spot, with groups numbered by first appearance",
+    )
+    def groups_within(  # pylint: disable=missing-function-docstring
+        self, radius: Numeric
+    ) -> npt.NDArray[np.intp]:
+        num_spots = len(self)
+        pairs = self.pairs_within(radius)
+        graph = coo_matrix(
+            (np.ones(pairs.shape[0], dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+            shape=(num_spots, num_spots),
+        )
+        _, groups = connected_components(graph, directed=False)
+        # Renumber so that group IDs follow order of first appearance in the index.
+        _, first_seen, inverse = np.unique(
+            groups, return_index=True, return_inverse=True
+        )
+        return np.argsort(np.argsort(first_seen))[inverse].astype(np.intp)  # type: ignore[no-any-return]
+
+    @cached_property
+    def _tree(self) -> cKDTree:
+        # Build the tree once, on the physically-scaled coordinates.
+        return cKDTree(self._scale(self.coordinates))
+
+    def _scale(self, points: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+        return np.asarray(points, dtype=np.float64).reshape(-1, 3) * np.asarray(
+            self.voxel_size, dtype=np.float64
+        )
+
+
+@doc(
+    summary="Reduce each group of mutually-close spots in a table to a single spot.",
+    extended_summary="""
+        Groups are formed by chains of proximity (see SpotSpatialIndex.groups_within),
+        which is what's needed e.g. to collapse the duplicate detections of a single
+        spot which arise from overlapping fields of view or tiles. The output has the
+        same columns as the input, with one row per group, in order of each group's
+        first appearance in the input. Merging averages only the centroid and mean
+        intensity, and sums the area; any other column (e.g. regionId, or scale) is
+        taken from the group's brightest spot.
+    """,
+    parameters=dict(
+        data="Detection result, or table of detected spots",
+        min_distance="Spots within this (physical) distance of each other are regarded as duplicates",
+        voxel_size="Physical size of a voxel along each of (z, y, x)",
+        strategy="How to reduce each group of duplicates to a single spot; merging takes area-weighted averages of centroid and mean intensity, and total area",
+    ),
+    raises=dict(
+        KeyError="If the table lacks a column required by the chosen strategy",
+    ),
+    returns="Table of deduplicated spots, with a fresh index",
+)
+def deduplicate_spots(  # pylint: disable=missing-function-docstring
+    data: SpotsTable,
+    *,
+    min_distance: Numeric,
+    voxel_size: VoxelSize = (1, 1, 1),
+    strategy: DeduplicationStrategy = DeduplicationStrategy.KEEP_BRIGHTEST,
+) -> pd.DataFrame:
+    table: pd.DataFrame = data.table if isinstance(data, DetectionResult) else data
+    index = SpotSpatialIndex.from_table(table, voxel_size=voxel_size)
+    groups = index.groups_within(min_distance)
+    if strategy == DeduplicationStrategy.KEEP_FIRST:
+        brightness = None
+    elif strategy in (
+        DeduplicationStrategy.KEEP_BRIGHTEST,
+        DeduplicationStrategy.MERGE,
+    ):
+        brightness = table[ROI_MEAN_INTENSITY_KEY_CAMEL_CASE].to_numpy()
+    else:
+        raise ValueError(f"Unsupported deduplication strategy: {strategy}")
+    kept = table.iloc[_representatives(groups, brightness=brightness)].reset_index(
+        drop=True
+    )
+    if strategy == DeduplicationStrategy.MERGE:
+        _merge_groups_into(kept, table=table, groups=groups)
+    return kept
+
+
+def _representatives(
+    groups: npt.NDArray[np.intp], *, brightness: Optional[npt.NDArray[np.float64]]
+) -> npt.NDArray[np.intp]:
+    """Index of the first (or, given brightness, the brightest, first among equals) row of each group, in order of group"""
+    order: npt.NDArray[np.intp] = np.lexsort(
+        (np.arange(len(groups)), groups)
+        if brightness is None
+        else (np.arange(len(groups)), -brightness, groups)
+    )
+    # After sorting by group, the first row of each run is the group's representative.
+    is_first = np.ones(len(order), dtype=np.bool_)
+    is_first[1:] = groups[order][1:] != groups[order][:-1]
+    return order[is_first]
+
+
+def _merge_groups_into(
+    kept: pd.DataFrame, *, table: pd.DataFrame, groups: npt.NDArray[np.intp]
+) -> None:
+    """Replace the centroid, area, and mean intensity of each group's representative by values merged over the group."""
+    num_groups = kept.shape[0]
+    area = table[ROI_AREA_KEY].to_numpy(dtype=np.float64)
+    # With weights, bincount's counts are floats (no copy here).
+    total_area = np.asarray(
+        np.bincount(groups, weights=area, minlength=num_groups), dtype=np.float64
+    )
+
+    def weighted_mean(column: str) -> npt.NDArray[np.float64]:
+        values = table[column].to_numpy(dtype=np.float64)
+        sums = np.asarray(
+            np.bincount(groups, weights=area * values, minlength=num_groups),
+            dtype=np.float64,
+        )
+        return sums / total_area
+
+    for column in RoiCenterKeys.to_list() + [ROI_MEAN_INTENSITY_KEY_CAMEL_CASE]:
+        kept[column] = weighted_mean(column)
+    kept[ROI_AREA_KEY] = total_area
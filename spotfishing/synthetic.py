@@ -0,0 +1,104 @@
+"""Synthetic images of spots, with known ground truth, for testing and benchmarking"""
+
+from typing import Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+
+from ._exceptions import DimensionalityError
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = ["random_spot_centers", "render_gaussian_spots"]
+
+Numeric = Union[int, float]
+
+ImageShape = tuple[int, int, int]
+
+
+@doc(
+    summary="Draw random spot centers within an image, keeping clear of its border.",
+    parameters=dict(
+        shape="Shape (z, y, x) of the image in which to place spots",
+        num_spots="Number of spot centers to draw",
+        margin="Minimum distance from a center to the image border, per axis (z, y, x)",
+        rng="Source of randomness",
+    ),
+    raises=dict(
+        ValueError="If the margin leaves no room for a spot center along some axis",
+    ),
+    returns="(N, 3) array of (z, y, x) spot centers",
+)
+def random_spot_centers(  # pylint: disable=missing-function-docstring
+    shape: ImageShape,
+    *,
+    num_spots: int,
+    margin: tuple[Numeric, Numeric, Numeric],
+    rng: np.random.Generator,
+) -> npt.NDArray[np.float64]:
+    low = np.asarray(margin, dtype=np.float64)
+    high = np.asarray(shape, dtype=np.float64) - 1 - low
+    if np.any(high < low):
+        raise ValueError(f"Margin {margin} leaves no room for spots in shape {shape}")
+    return rng.uniform(low, high, size=(num_spots, 3))
+
+
+@doc(
+    summary="Render 3D Gaussian spots onto a constant background, with optional noise.",
+    extended_summary="""
+        Each spot is rendered only within 4 standard deviations of its center, so
+        rendering cost scales with the number of spots rather than with the product of
+        number of spots and image size.
+    """,
+    parameters=dict(
+        shape="Shape (z, y, x) of the image to render",
+        centers="(N, 3) array of (z, y, x) spot centers",
+        sigma_z="Standard deviation of each spot along z",
+        sigma_xy="Standard deviation of each spot along each of y and x",
+        amplitudes="Peak height above background of each spot (or one value for all spots)",
+        background="Constant background level",
+        noise_sd="Standard deviation of additive Gaussian noise; no noise if omitted",
+        rng="Source of randomness for the noise",
+    ),
+    raises=dict(
+        DimensionalityError="If the centers aren't an (N, 3) array",
+        ValueError="If noise is requested without a source of randomness",
+    ),
+    returns="Image of unsigned 16-bit pixel values, clipped into the type's range",
+)
+def render_gaussian_spots(  # pylint: disable=missing-function-docstring,too-many-arguments,too-many-locals
+    shape: ImageShape,
+    *,
+    centers: npt.NDArray[np.float64],
+    sigma_z: Numeric,
+    sigma_xy: Numeric,
+    amplitudes: Union[Numeric, npt.NDArray[np.float64]],
+    background: Numeric = 0,
+    noise_sd: Optional[Numeric] = None,
+    rng: Optional[np.random.Generator] = None,
+) -> npt.NDArray[np.uint16]:
+    if centers.ndim != 2 or centers.shape[1] != 3:
+        raise DimensionalityError(
+            f"Spot centers must be an (N, 3) array, not of shape {centers.shape}"
+        )
+    if noise_sd is not None and rng is None:
+        raise ValueError("Noise requires a source of randomness")
+    img = np.full(shape, float(background), dtype=np.float64)
+    heights = np.broadcast_to(np.asarray(amplitudes, dtype=np.float64), (len(centers),))
+    sigmas = np.array([sigma_z, sigma_xy, sigma_xy], dtype=np.float64)
+    radii = np.ceil(4 * sigmas).astype(int)
+    for center, height in zip(centers, heights):
+        start = np.maximum(np.floor(center).astype(int) - radii, 0)
+        stop = np.minimum(np.floor(center).astype(int) + radii + 1, shape)
+        if np.any(stop <= start):
+            continue
+        box = tuple(slice(a, b) for a, b in zip(start, stop))
+        exponent = sum(
+            ((grid - c) / s) ** 2 for grid, c, s in zip(np.ogrid[box], center, sigmas)
+        )
+        img[box] += height * np.exp(-exponent / 2)
+    if noise_sd is not None:
+        img += rng.normal(0, noise_sd, size=shape)  # type: ignore[union-attr]
+    return np.clip(np.rint(img), 0, np.iinfo(np.uint16).max).astype(np.uint16)
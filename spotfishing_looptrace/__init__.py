@@ -1,5 +1,6 @@
 """Exports from the looptrace-related subpackage"""
 
+from .temporal_reuse import PositionTransformer, ReuseMode, ReusePolicy, ReuseReport
 from .transformation_specification import (
     ORIGINAL_LOOPTRACE_DOG_SPECIFICATION,
     DifferenceOfGaussiansSpecificationForLooptrace,
@@ -11,4 +12,8 @@ __credits__ = ["Vince Reuter"]
 __all__ = [
     "DifferenceOfGaussiansSpecificationForLooptrace",
     "ORIGINAL_LOOPTRACE_DOG_SPECIFICATION",
+    "PositionTransformer",
+    "ReuseMode",
+    "ReusePolicy",
+    "ReuseReport",
 ]
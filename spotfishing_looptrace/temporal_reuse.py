@@ -0,0 +1,351 @@
+"""Reuse of background and normalisation work across the timepoints of one position"""
+
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+from numpydoc_decorator import doc  # type: ignore[import-untyped]
+from skimage.filters import gaussian as gaussian_filter
+
+from spotfishing._types import Image, NumpyFloat
+from spotfishing.dog_transform import DifferenceOfGaussiansTransformation
+
+from .transformation_specification import (
+    POST_DIVIDE_SIGMA,
+    DifferenceOfGaussiansSpecificationForLooptrace,
+)
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+__all__ = [
+    "PositionTransformer",
+    "ReuseMode",
+    "ReusePolicy",
+    "ReuseReport",
+]
+
+
+class ReuseMode(Enum):
+    """What to do with the work cached from an earlier frame, when the new frame is close enough to that one"""
+
+    RECOMPUTE = "recompute"
+    REUSE = "reuse"
+    UPDATE = "update"
+
+
+@doc(
+    summary="When and how to reuse the divisor blur and normalisation statistics of an earlier frame",
+    extended_summary="""
+        Each frame is compared, cheaply, to the frame from which the cached work was
+        computed: for the divisor, by way of a thumbnail of block means of the frame
+        (averaging away pixel noise, as the blur does); for the statistics, by way of a
+        strided subsample of the transformed frame. In REUSE mode, the cached work is
+        used as is if the comparison is within the tolerance.
+        In UPDATE mode, the cached work is first adjusted for the change: the divisor
+        blur is scaled by the overall gain between the thumbnails (blurring is linear,
+        so this is exact for a uniform change in brightness, e.g. by photobleaching), and
+        the statistics are shifted and scaled by the change in the subsample's
+        statistics. For the divisor, the tolerance then applies to what's left after
+        the adjustment; for the statistics, it bounds the size of the adjustment. In
+        RECOMPUTE mode, nothing is reused, and the result is exactly that of the
+        looptrace transformation.
+    """,
+    parameters=dict(
+        mode="Whether, and how, to reuse cached work",
+        divisor_tolerance="Greatest mean relative difference between a frame's thumbnail and the (gain-adjusted, in UPDATE mode) cached one for which to reuse the divisor blur",
+        statistics_tolerance="Greatest change in the subsample's mean (in units of its standard deviation), or relative change in its standard deviation, for which to reuse the normalisation statistics",
+        max_reuses="Greatest number of consecutive frames for which to reuse each piece of cached work before computing it afresh, or null for no limit",
+        thumbnail_block="Shape (z, y, x) of the blocks averaged for a frame's thumbnail, which is also the step between the pixels subsampled for statistics",
+    ),
+    raises=dict(
+        ValueError="If a tolerance or the maximum number of reuses is negative, or the block shape isn't 3 positive integers",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class ReusePolicy:  # pylint: disable=missing-class-docstring
+    mode: ReuseMode = ReuseMode.UPDATE
+    divisor_tolerance: float = 0.02
+    statistics_tolerance: float = 0.02
+    max_reuses: Optional[int] = None
+    thumbnail_block: tuple[int, int, int] = (1, 8, 8)
+
+    def __post_init__(self) -> None:
+        if self.divisor_tolerance < 0 or self.statistics_tolerance < 0:
+            raise ValueError(
+                f"Tolerances must be nonnegative; got {self.divisor_tolerance} (divisor) and {self.statistics_tolerance} (statistics)"
+            )
+        if self.max_reuses is not None and self.max_reuses < 0:
+            raise ValueError(
+                f"Maximum number of reuses must be nonnegative; got {self.max_reuses}"
+            )
+        if len(self.thumbnail_block) != 3 or any(
+            int(s) != s or s < 1 for s in self.thumbnail_block
+        ):
+            raise ValueError(
+                f"Thumbnail block shape must be 3 positive integers; got {self.thumbnail_block}"
+            )
+
+
+@doc(
+    summary="Account of the work done and avoided by a position's transformer",
+    extended_summary="""
+        Reusing the divisor avoids a whole blur of the frame, but updating it (scaling
+        by the gain) costs a pass over the frame. Reusing the statistics avoids only
+        the reductions for the mean and standard deviation of the whole transformed
+        frame; the shift and scale by the statistics are applied to every frame
+        either way, so they aren't counted as work which reuse avoids.
+    """,
+    parameters=dict(
+        frames="Number of frames transformed",
+        divisor_computed="Number of frames for which the divisor blur was computed",
+        divisor_reused="Number of frames for which the cached divisor blur was reused (possibly updated)",
+        statistics_computed="Number of frames for which the normalisation statistics were computed",
+        statistics_reused="Number of frames for which the cached normalisation statistics were reused (possibly updated)",
+        divisor_seconds="Total time spent computing divisor blurs",
+        statistics_seconds="Total time spent computing normalisation statistics (the mean and standard deviation of the whole transformed frame)",
+        checking_seconds="Total time spent comparing frames to decide whether to reuse work",
+        updating_seconds="Total time spent adjusting cached work for reuse (scaling the divisor blur by the gain)",
+    ),
+)
+@dataclass(frozen=True, kw_only=True)
+class ReuseReport:  # pylint: disable=missing-class-docstring,too-many-instance-attributes
+    frames: int
+    divisor_computed: int
+    divisor_reused: int
+    statistics_computed: int
+    statistics_reused: int
+    divisor_seconds: float
+    statistics_seconds: float
+    checking_seconds: float
+    updating_seconds: float
+
+    @property
+    def estimated_seconds_saved(self) -> float:
+        """Time which reused work would have taken to compute (at the average cost of computing it), less the time spent checking and updating"""
+        saved = 0.0
+        if self.divisor_computed > 0:
+            saved += self.divisor_reused * self.divisor_seconds / self.divisor_computed
+        if self.statistics_computed > 0:
+            saved += (
+                self.statistics_reused
+                * self.statistics_seconds
+                / self.statistics_computed
+            )
+        return saved - self.checking_seconds - self.updating_seconds
+
+
+@doc(
+    summary="Stateful looptrace DoG transformation for the frames (timepoints) of one imaging position",
+    extended_summary="""
+        In a time series, the same position is imaged many times, with slowly changing
+        background. This transformation caches the blur of the original image by which
+        the difference of Gaussians is divided, and the statistics with which the
+        result is standardised, and reuses them (according to the policy) for later
+        frames of the position which are close enough to the frame from which they
+        were computed. Use one instance per position, and give it the position's frames
+        in order, either by calling it, or by giving its `transformation` to
+        `detect_spots_dog`. The transformation is only for whole frames, not for
+        regions of them (as with pre-screening, masking, or a memory budget).
+    """,
+    parameters=dict(
+        specification="The looptrace DoG specification to apply",
+        policy="When and how to reuse work from earlier frames",
+    ),
+)
+@dataclass(kw_only=True)
+class PositionTransformer:  # pylint: disable=missing-class-docstring,too-many-instance-attributes
+    specification: DifferenceOfGaussiansSpecificationForLooptrace
+    policy: ReusePolicy = field(default_factory=ReusePolicy)
+    # cached divisor blur, with the thumbnail of the frame from which it was computed
+    _divisor: Optional[npt.NDArray[NumpyFloat]] = field(
+        default=None, init=False, repr=False
+    )
+    _divisor_thumbnail: Optional[npt.NDArray[NumpyFloat]] = field(
+        default=None, init=False, repr=False
+    )
+    _divisor_reuses: int = field(default=0, init=False, repr=False)
+    # cached (full, subsample) mean and standard deviation
+    _statistics: Optional[tuple[float, float, float, float]] = field(
+        default=None, init=False, repr=False
+    )
+    _statistics_reuses: int = field(default=0, init=False, repr=False)
+    _frame_shape: Optional[tuple[int, ...]] = field(
+        default=None, init=False, repr=False
+    )
+    _counts: dict[str, int] = field(default_factory=dict, init=False, repr=False)
+    _seconds: dict[str, float] = field(default_factory=dict, init=False, repr=False)
+
+    @property
+    def transformation(self) -> DifferenceOfGaussiansTransformation:
+        """The DoG transformation, whose post-difference step divides and standardises with reuse of cached work"""
+        base = self.specification.transformation
+        return DifferenceOfGaussiansTransformation(
+            pre_diff=base.pre_diff,
+            sigma_narrow=base.sigma_narrow,
+            sigma_wide=base.sigma_wide,
+            post_diff=self._post_diff,
+            standardise=False,
+            support_radius=base.support_radius,
+        )
+
+    def __call__(self, frame: Image) -> npt.NDArray[NumpyFloat]:
+        """Transform the next frame of the position."""
+        img: npt.NDArray[NumpyFloat] = self.transformation(frame)
+        return img
+
+    def report(self) -> ReuseReport:
+        """Account of the work done and avoided so far"""
+        return ReuseReport(
+            frames=self._counts.get("frames", 0),
+            divisor_computed=self._counts.get("divisor_computed", 0),
+            divisor_reused=self._counts.get("divisor_reused", 0),
+            statistics_computed=self._counts.get("statistics_computed", 0),
+            statistics_reused=self._counts.get("statistics_reused", 0),
+            divisor_seconds=self._seconds.get("divisor", 0.0),
+            statistics_seconds=self._seconds.get("statistics", 0.0),
+            checking_seconds=self._seconds.get("checking", 0.0),
+            updating_seconds=self._seconds.get("updating", 0.0),
+        )
+
+    def reset(self) -> None:
+        """Forget all cached work (but not the account of it), e.g. after a change of imaging conditions."""
+        self._divisor = self._divisor_thumbnail = self._statistics = None
+        self._divisor_reuses = self._statistics_reuses = 0
+        self._frame_shape = None
+
+    def _post_diff(self, *, old_img: Image, new_img: Image) -> Image:
+        if self._frame_shape is None:
+            self._frame_shape = old_img.shape
+        elif old_img.shape != self._frame_shape:
+            raise ValueError(
+                f"Frame shape {old_img.shape} differs from the position's frame shape {self._frame_shape}; note that this transformation can't be applied piecewise"
+            )
+        self._count("frames")
+        # The difference of Gaussians is float, though the protocol types it as an image.
+        img: npt.NDArray[NumpyFloat] = new_img.astype(np.float64, copy=False)
+        if self.specification.sigma_post_divide is not None:
+            img = img / self._get_divisor(old_img)
+        if self.specification.standardise:
+            mean, std = self._get_statistics(img)
+            img = (img - mean) / std
+        return img  # type: ignore[return-value]
+
+    def _get_divisor(self, frame: Image) -> npt.NDArray[NumpyFloat]:
+        thumbnail: Optional[npt.NDArray[NumpyFloat]] = None
+        if self._may_reuse(self._divisor_thumbnail, self._divisor_reuses):
+            start = time.perf_counter()
+            thumbnail = self._thumbnail(frame)
+            gain = self._check_divisor(thumbnail)
+            self._add_seconds("checking", start)
+            if gain is not None and self._divisor is not None:
+                self._count("divisor_reused")
+                self._divisor_reuses += 1
+                if gain == 1:
+                    return self._divisor
+                start = time.perf_counter()
+                updated = self._divisor * gain
+                self._add_seconds("updating", start)
+                return updated
+        start = time.perf_counter()
+        divisor: npt.NDArray[NumpyFloat] = gaussian_filter(frame, POST_DIVIDE_SIGMA)
+        # The thumbnail is the reference against which to check later frames, so it's
+        # needed (as part of building the cache) only if the divisor may be reused.
+        if thumbnail is None and self.policy.mode != ReuseMode.RECOMPUTE:
+            thumbnail = self._thumbnail(frame)
+        self._add_seconds("divisor", start)
+        self._divisor = divisor
+        self._divisor_thumbnail = thumbnail
+        self._divisor_reuses = 0
+        self._count("divisor_computed")
+        return divisor
+
+    def _check_divisor(self, thumbnail: npt.NDArray[NumpyFloat]) -> Optional[float]:
+        """Gain by which to scale the cached divisor for reuse, or null if it can't be reused (given that reuse is allowed)"""
+        cached: npt.NDArray[NumpyFloat] = self._divisor_thumbnail  # type: ignore[assignment]
+        reference_mean = float(np.mean(cached))
+        if reference_mean <= 0:
+            return None
+        gain = (
+            float(np.mean(thumbnail)) / reference_mean
+            if self.policy.mode == ReuseMode.UPDATE
+            else 1.0
+        )
+        expected = gain * cached
+        residual = float(np.mean(np.abs(thumbnail - expected))) / float(
+            np.mean(np.abs(expected))
+        )
+        return gain if residual <= self.policy.divisor_tolerance else None
+
+    def _get_statistics(self, img: npt.NDArray[NumpyFloat]) -> tuple[float, float]:
+        sub_stats: Optional[tuple[float, float]] = None
+        if self._may_reuse(self._statistics, self._statistics_reuses):
+            start = time.perf_counter()
+            sub_stats = self._subsample_statistics(img)
+            reusable = self._check_statistics(*sub_stats)
+            self._add_seconds("checking", start)
+            if reusable is not None:
+                self._count("statistics_reused")
+                self._statistics_reuses += 1
+                return reusable
+        start = time.perf_counter()
+        mean, std = float(np.mean(img)), float(np.std(img))
+        # As for the divisor's thumbnail, the subsample is needed only if the statistics may be reused.
+        if sub_stats is None and self.policy.mode != ReuseMode.RECOMPUTE:
+            sub_stats = self._subsample_statistics(img)
+        self._add_seconds("statistics", start)
+        self._statistics = None if sub_stats is None else (mean, std, *sub_stats)
+        self._statistics_reuses = 0
+        self._count("statistics_computed")
+        return mean, std
+
+    def _subsample_statistics(
+        self, img: npt.NDArray[NumpyFloat]
+    ) -> tuple[float, float]:
+        """Mean and standard deviation of a regular subsample of the image"""
+        subsample = img[
+            tuple(slice(None, None, step) for step in self.policy.thumbnail_block)
+        ]
+        return float(np.mean(subsample)), float(np.std(subsample))
+
+    def _check_statistics(
+        self, sub_mean: float, sub_std: float
+    ) -> Optional[tuple[float, float]]:
+        """The (possibly updated) cached statistics, or null if they can't be reused (given that reuse is allowed)"""
+        mean, std, ref_sub_mean, ref_sub_std = self._statistics  # type: ignore[misc]
+        if ref_sub_std <= 0 or sub_std <= 0:
+            return None
+        shift = abs(sub_mean - ref_sub_mean) / ref_sub_std
+        scale = abs(sub_std / ref_sub_std - 1)
+        if max(shift, scale) > self.policy.statistics_tolerance:
+            return None
+        if self.policy.mode == ReuseMode.UPDATE:
+            return mean + (sub_mean - ref_sub_mean), std * sub_std / ref_sub_std
+        return mean, std
+
+    def _may_reuse(self, cached: object, reuses: int) -> bool:
+        return (
+            self.policy.mode != ReuseMode.RECOMPUTE
+            and cached is not None
+            and (self.policy.max_reuses is None or reuses < self.policy.max_reuses)
+        )
+
+    def _thumbnail(self, img: Image) -> npt.NDArray[NumpyFloat]:
+        """Mean of each whole block of the image (any partial blocks at the far ends are left out)"""
+        counts = [
+            max(n // b, 1) for n, b in zip(img.shape, self.policy.thumbnail_block)
+        ]
+        sizes = [min(b, n) for b, n in zip(self.policy.thumbnail_block, img.shape)]
+        blocks = img[tuple(slice(0, c * b) for c, b in zip(counts, sizes))].reshape(
+            [d for count_and_size in zip(counts, sizes) for d in count_and_size]
+        )
+        return blocks.mean(axis=(1, 3, 5))  # type: ignore[no-any-return]
+
+    def _count(self, key: str) -> None:
+        self._counts[key] = self._counts.get(key, 0) + 1
+
+    def _add_seconds(self, key: str, start: float) -> None:
+        self._seconds[key] = self._seconds.get(key, 0.0) + time.perf_counter() - start
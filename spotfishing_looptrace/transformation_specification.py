@@ -15,6 +15,7 @@ from spotfishing._types import Image, ImageEndomorphism
 from spotfishing.dog_transform import (
     DifferenceOfGaussiansTransformation,
     PostDifferenceTransformation,
+    gaussian_radius,
 )
 
 __author__ = "Vince Reuter"
@@ -28,6 +29,12 @@ __all__ = [
 
 Numeric = Union[float, int]
 
+# radius of the ball used as footprint for the white tophat filter
+TOPHAT_BALL_RADIUS = 2
+
+# standard deviation of the blur of the original image, by which to divide after differencing
+POST_DIVIDE_SIGMA = 3
+
 
 @doc(
     summary="Build an instance with optional white tophat filter as preprocessing, and optional division by a Gaussian blur as postprocessing.",
@@ -53,12 +60,14 @@ class DifferenceOfGaussiansSpecificationForLooptrace:
     def transformation(self) -> "DifferenceOfGaussiansTransformation":
         # https://git.embl.de/grp-ellenberg/looptrace/-/blob/master/looptrace/image_processing_functions.py?ref_type=heads#L252
         pre: Optional[ImageEndomorphism] = (
-            partial(white_tophat, footprint=ball(2))
+            partial(white_tophat, footprint=ball(TOPHAT_BALL_RADIUS))
             if self.apply_white_tophat
             else None
         )
         post: Optional[PostDifferenceTransformation] = (
-            None if self.sigma_post_divide is None else partial(div_by_gauss, sigma=3)
+            None
+            if self.sigma_post_divide is None
+            else partial(div_by_gauss, sigma=POST_DIVIDE_SIGMA)
         )
         return DifferenceOfGaussiansTransformation(
             pre_diff=pre,
@@ -66,7 +75,19 @@ class DifferenceOfGaussiansSpecificationForLooptrace:
             sigma_wide=self.sigma_wide,
             post_diff=post,
             standardise=self.standardise,
+            support_radius=self.support_radius,
+        )
+
+    @property
+    def support_radius(self) -> int:
+        """How far (in pixels) a pixel of the transformed image can depend on the input"""
+        # Opening (for tophat) by a ball of radius 2 is erosion then dilation, each of radius 2.
+        radius: int = gaussian_radius(self.sigma_wide) + (
+            2 * TOPHAT_BALL_RADIUS if self.apply_white_tophat else 0
         )
+        if self.sigma_post_divide is not None:
+            radius = max(radius, gaussian_radius(POST_DIVIDE_SIGMA))
+        return radius
 
     # @doc(
     #     summary="Build an instance from parameters in a JSON file.",
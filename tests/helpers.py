@@ -2,20 +2,39 @@
 
 import os
 from pathlib import Path
-from typing import Union
+from typing import Callable, Mapping, Optional, Union
 
 import numpy as np
 
+from spotfishing import DetectionResult
+from spotfishing.dog_transform import DifferenceOfGaussiansTransformation
+from spotfishing.memory_planner import plan_detection
+from spotfishing.synthetic import random_spot_centers, render_gaussian_spots
+
 __author__ = "Vince Reuter"
 __credits__ = ["Vince Reuter"]
 
 __all__ = [
+    "SYNTHETIC_BACKGROUND",
+    "budgeted_detector",
     "get_img_data_file",
     "load_image_file",
+    "smallest_budget",
+    "synthetic_spots",
+    "synthetic_spots_image",
 ]
 
 Numeric = Union[float, int]
 
+# constant background level of synthetic images
+SYNTHETIC_BACKGROUND = 100
+
+# granularity of the search for the smallest memory budget
+BUDGET_STEP = 2**18
+
+# number of budget steps beyond which no budget is sought
+MAX_BUDGET_STEPS = 2**22
+
 
 def get_img_data_file(fn: str) -> Path:
     """Get the path to an input file (image data)."""
@@ -25,3 +44,136 @@ def get_img_data_file(fn: str) -> Path:
 def load_image_file(fn: str) -> np.ndarray:
     """Load an input image from disk, with the given name and stored in test data inputs folder."""
     return np.load(get_img_data_file(fn))  # type: ignore
+
+
+def synthetic_spots(  # pylint: disable=too-many-arguments
+    shape: tuple[int, int, int],
+    *,
+    num_spots: int,
+    seed: int,
+    spots_region: Optional[tuple[int, int, int]] = None,
+    amplitudes: Union[Numeric, tuple[Numeric, Numeric]] = (500, 1500),
+    noise_sd: Numeric = 3,
+    margin: tuple[int, int, int] = (4, 6, 6),
+) -> tuple[np.ndarray, np.ndarray]:
+    """Render randomly placed Gaussian spots (sigma 1.5 in z, 1.2 in y and x) on the synthetic background, with Gaussian noise.
+
+    Spots are placed within the region (from the origin) of the given shape, by default
+    the whole image, keeping the margin from its edges. The amplitude of each spot is
+    either the given value, or drawn uniformly from the given (low, high) range. The
+    result is a pair of spot centers and image.
+    """
+    rng = np.random.default_rng(seed)
+    centers = random_spot_centers(
+        spots_region or shape, num_spots=num_spots, margin=margin, rng=rng
+    )
+    image = render_gaussian_spots(
+        shape,
+        centers=centers,
+        sigma_z=1.5,
+        sigma_xy=1.2,
+        amplitudes=(
+            rng.uniform(*amplitudes, size=len(centers))
+            if isinstance(amplitudes, tuple)
+            else amplitudes
+        ),
+        background=SYNTHETIC_BACKGROUND,
+        noise_sd=noise_sd,
+        rng=rng,
+    )
+    return centers, image
+
+
+def synthetic_spots_image(  # pylint: disable=too-many-arguments
+    shape: tuple[int, int, int],
+    *,
+    num_spots: int,
+    seed: int,
+    spots_region: Optional[tuple[int, int, int]] = None,
+    amplitudes: Union[Numeric, tuple[Numeric, Numeric]] = (500, 1500),
+    noise_sd: Numeric = 3,
+    margin: tuple[int, int, int] = (4, 6, 6),
+) -> np.ndarray:
+    """Image of randomly placed Gaussian spots, as rendered by synthetic_spots"""
+    _, image = synthetic_spots(
+        shape,
+        num_spots=num_spots,
+        seed=seed,
+        spots_region=spots_region,
+        amplitudes=amplitudes,
+        noise_sd=noise_sd,
+        margin=margin,
+    )
+    return image
+
+
+def smallest_budget(
+    image: np.ndarray,
+    *,
+    transform: DifferenceOfGaussiansTransformation,
+    precision: type[np.floating],
+    expand_px: Optional[Numeric],
+) -> int:
+    """Smallest memory budget (a multiple of the budget step) for which the planner chooses the given precision for DoG detection in the image.
+
+    A bigger budget never gets a lower precision, so the budget is found by bisection.
+    """
+
+    def is_enough(steps: int) -> bool:
+        plan = plan_detection(
+            image.shape,
+            image.dtype,
+            transform=transform,
+            memory_budget=steps * BUDGET_STEP,
+            expand_px=expand_px,
+        )
+        return (
+            plan.fits
+            and np.dtype(plan.precision).itemsize >= np.dtype(precision).itemsize
+        )
+
+    low, high = 0, MAX_BUDGET_STEPS
+    if not is_enough(high):
+        raise ValueError(f"No budget gives a {np.dtype(precision).name} plan")
+    while high - low > 1:
+        middle = (low + high) // 2
+        if is_enough(middle):
+            high = middle
+        else:
+            low = middle
+    plan = plan_detection(
+        image.shape,
+        image.dtype,
+        transform=transform,
+        memory_budget=high * BUDGET_STEP,
+        expand_px=expand_px,
+    )
+    if plan.precision != precision:
+        raise ValueError(f"No budget gives a {np.dtype(precision).name} plan")
+    return high * BUDGET_STEP
+
+
+def budgeted_detector(
+    detect: Callable[..., DetectionResult],
+    images: Mapping[str, np.ndarray],
+    *,
+    transform: DifferenceOfGaussiansTransformation,
+    precision: type[np.floating],
+    expand_px: Optional[Numeric],
+) -> Callable[[np.ndarray], DetectionResult]:
+    """DoG detection within the smallest budget for the given precision, for each of the given images.
+
+    The budgets are found here, up front, so that the search isn't part of the time taken
+    by detection.
+    """
+    budgets = {
+        id(image): smallest_budget(
+            image, transform=transform, precision=precision, expand_px=expand_px
+        )
+        for image in images.values()
+    }
+
+    def detect_within_budget(image: np.ndarray) -> DetectionResult:
+        return detect(image, memory_budget=budgets[id(image)])
+
+    return detect_within_budget
@@ -0,0 +1,171 @@
+"""Tests for reuse of background and normalisation work across the timepoints of one position"""
+
+import numpy as np
+import numpy.testing as np_test
+import pytest
+
+from spotfishing import RoiCenterKeys, detect_spots_dog
+from spotfishing.accuracy import match_spots
+from spotfishing.synthetic import random_spot_centers, render_gaussian_spots
+from spotfishing_looptrace import (
+    ORIGINAL_LOOPTRACE_DOG_SPECIFICATION,
+    PositionTransformer,
+    ReuseMode,
+    ReusePolicy,
+)
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+SPEC = ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+SHAPE = (16, 128, 128)
+NUM_FRAMES = 6
+
+
+def make_frames(*, bleaching=0.98, seed=0):
+    """Frames of one position: fixed spots on a smooth background, uniformly dimming over time, with fresh noise"""
+    rng = np.random.default_rng(seed)
+    centers = random_spot_centers(SHAPE, num_spots=30, margin=(4, 6, 6), rng=rng)
+    amplitudes = rng.uniform(500, 1500, size=len(centers))
+    _, y, x = np.indices(SHAPE)
+    background = 200 + 100 * np.sin(y / 40) * np.cos(x / 50)
+    frames = []
+    for t in range(NUM_FRAMES):
+        spots = render_gaussian_spots(
+            SHAPE,
+            centers=centers,
+            sigma_z=1.5,
+            sigma_xy=1.2,
+            amplitudes=amplitudes,
+        ).astype(float)
+        frame = (bleaching**t) * (background + spots) + rng.normal(0, 3, size=SHAPE)
+        frames.append(np.clip(frame, 0, None).astype(np.uint16))
+    return frames
+
+
+@pytest.fixture(scope="module")
+def frames():
+    return make_frames()
+
+
+def test_recompute_mode_is_exactly_the_looptrace_transformation(frames):
+    transformer = PositionTransformer(
+        specification=SPEC, policy=ReusePolicy(mode=ReuseMode.RECOMPUTE)
+    )
+    for frame in frames:
+        np_test.assert_array_equal(transformer(frame), SPEC.transformation(frame))
+    report = transformer.report()
+    assert report.frames == NUM_FRAMES
+    assert report.divisor_computed == report.statistics_computed == NUM_FRAMES
+    assert report.divisor_reused == report.statistics_reused == 0
+    # No time is spent checking whether work can be reused, since it never can be.
+    assert report.checking_seconds == 0
+    assert report.estimated_seconds_saved == 0
+
+
+def test_update_mode_reuses_work_for_slowly_changing_frames(frames):
+    transformer = PositionTransformer(specification=SPEC)
+    for frame in frames:
+        observed = transformer(frame)
+        expected = SPEC.transformation(frame)
+        # Reused statistics are off by about the tolerance, relative to the values.
+        np_test.assert_allclose(observed, expected, rtol=0.05, atol=0.05)
+    report = transformer.report()
+    assert report.divisor_computed == report.statistics_computed == 1
+    assert report.divisor_reused == report.statistics_reused == NUM_FRAMES - 1
+    assert report.estimated_seconds_saved > 0
+
+
+def test_detection_with_reused_work_finds_same_spots(frames):
+    transformer = PositionTransformer(specification=SPEC)
+    for frame in frames:
+        reused = detect_spots_dog(
+            frame,
+            spot_threshold=15,
+            expand_px=1,
+            transform=transformer.transformation,
+        )
+        reference = detect_spots_dog(
+            frame, spot_threshold=15, expand_px=1, transform=SPEC.transformation
+        )
+        matching = match_spots(
+            reference.table[RoiCenterKeys.to_list()].to_numpy(),
+            reused.table[RoiCenterKeys.to_list()].to_numpy(),
+            max_distance=1,
+        )
+        assert matching.recall >= 0.95 and matching.precision >= 0.95
+    assert transformer.report().divisor_reused == NUM_FRAMES - 1
+
+
+def test_plain_reuse_is_refused_when_brightness_changes_too_much():
+    frames = make_frames(bleaching=0.9)
+    reuse = PositionTransformer(
+        specification=SPEC, policy=ReusePolicy(mode=ReuseMode.REUSE)
+    )
+    update = PositionTransformer(
+        specification=SPEC, policy=ReusePolicy(mode=ReuseMode.UPDATE)
+    )
+    for frame in frames:
+        reuse(frame)
+        update(frame)
+    # Dimming by 10% per frame is beyond tolerance for plain reuse, but a gain adjustment accounts for it.
+    assert reuse.report().divisor_reused == 0
+    assert update.report().divisor_reused == NUM_FRAMES - 1
+    # Adjusting the divisor for the gain costs time, which counts against the saving.
+    assert reuse.report().updating_seconds == 0 < update.report().updating_seconds
+
+
+def test_different_frame_forces_recomputation(frames):
+    transformer = PositionTransformer(specification=SPEC)
+    transformer(frames[0])
+    other = make_frames(seed=1)[0]
+    np_test.assert_array_equal(transformer(other), SPEC.transformation(other))
+    report = transformer.report()
+    assert report.divisor_computed == report.statistics_computed == 2
+
+
+def test_maximum_reuses_bounds_staleness(frames):
+    transformer = PositionTransformer(
+        specification=SPEC, policy=ReusePolicy(max_reuses=2)
+    )
+    for frame in frames:
+        transformer(frame)
+    report = transformer.report()
+    # compute, reuse, reuse, compute, reuse, reuse
+    assert report.divisor_computed == report.statistics_computed == 2
+    assert report.divisor_reused == report.statistics_reused == 4
+    never = PositionTransformer(specification=SPEC, policy=ReusePolicy(max_reuses=0))
+    for frame in frames:
+        never(frame)
+    assert never.report().checking_seconds == 0
+
+
+def test_reset_forgets_cached_work(frames):
+    transformer = PositionTransformer(specification=SPEC)
+    transformer(frames[0])
+    transformer.reset()
+    np_test.assert_array_equal(transformer(frames[1]), SPEC.transformation(frames[1]))
+    assert transformer.report().divisor_computed == 2
+
+
+def test_frames_must_keep_their_shape(frames):
+    transformer = PositionTransformer(specification=SPEC)
+    transformer(frames[0])
+    with pytest.raises(ValueError):
+        transformer(frames[1][:, :64, :64])
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(divisor_tolerance=-0.1),
+        dict(statistics_tolerance=-0.1),
+        dict(max_reuses=-1),
+        dict(thumbnail_block=(1, 8)),
+        dict(thumbnail_block=(0, 8, 8)),
+    ],
+)
+def test_policy_rejects_invalid_settings(kwargs):
+    with pytest.raises(ValueError):
+        ReusePolicy(**kwargs)
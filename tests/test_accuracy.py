@@ -0,0 +1,271 @@
+"""Tests for the accuracy of faster detection modes, relative to the reference detection"""
+
+import json
+from functools import partial
+
+import numpy as np
+import numpy.testing as np_test
+import pytest
+from helpers import (
+    SYNTHETIC_BACKGROUND,
+    budgeted_detector,
+    load_image_file,
+    synthetic_spots_image,
+)
+
+from spotfishing import DimensionalityError, detect_spots_dog, detect_spots_int
+from spotfishing.accuracy import (
+    AccuracyThresholds,
+    CaseReport,
+    compare_detectors,
+    match_spots,
+)
+from spotfishing.prescreen import PreScreen
+from spotfishing_looptrace import ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+DOG_THRESHOLD = 15
+DOG_EXPAND_PX = 10
+# DoG threshold for noisy images, low enough that noise is close to it
+NOISY_DOG_THRESHOLD = 6
+INT_THRESHOLD = 300
+INT_EXPAND_PX = 1
+MAX_MATCH_DISTANCE = 2
+
+# Modes which should reproduce the reference exactly
+EXACT = AccuracyThresholds(max_centroid_error=1e-6)
+
+# Modes which change the arithmetic, but not what's detected
+NEAR_EXACT = AccuracyThresholds(
+    min_recall=0.98, min_precision=0.98, max_centroid_error=0.05
+)
+
+# Modes which approximate part of the image
+APPROXIMATE = AccuracyThresholds(
+    min_recall=0.95, min_precision=0.95, max_centroid_error=0.5
+)
+
+reference_dog = partial(
+    detect_spots_dog,
+    spot_threshold=DOG_THRESHOLD,
+    expand_px=DOG_EXPAND_PX,
+    transform=ORIGINAL_LOOPTRACE_DOG_SPECIFICATION.transformation,
+)
+
+reference_int = partial(
+    detect_spots_int, spot_threshold=INT_THRESHOLD, expand_px=INT_EXPAND_PX
+)
+
+
+@pytest.fixture(scope="module")
+def synthetic_corpus():
+    return {
+        "synthetic_dense": synthetic_spots_image((16, 128, 128), num_spots=60, seed=1),
+        "synthetic_sparse": synthetic_spots_image(
+            (32, 128, 128), num_spots=10, seed=2, spots_region=(16, 48, 48)
+        ),
+    }
+
+
+@pytest.fixture(scope="module")
+def noisy_synthetic_corpus():
+    return {
+        "synthetic_noisy_sparse": synthetic_spots_image(
+            (32, 128, 128),
+            num_spots=10,
+            seed=3,
+            spots_region=(16, 48, 48),
+            noise_sd=40,
+        ),
+    }
+
+
+@pytest.fixture(scope="module")
+def real_corpus():
+    return {
+        name: load_image_file(f"img__{name}__smaller.npy")
+        for name in ["p0_t57_c0", "p13_t57_c0"]
+    }
+
+
+def assert_within_thresholds(report, thresholds):
+    violations = report.violations(thresholds)
+    assert violations == [], "\n".join(violations + [report.to_json(indent=2)])
+
+
+def budgeted_dog(corpus, *, precision):
+    return budgeted_detector(
+        reference_dog,
+        corpus,
+        transform=ORIGINAL_LOOPTRACE_DOG_SPECIFICATION.transformation,
+        precision=precision,
+        expand_px=DOG_EXPAND_PX,
+    )
+
+
+def prescreened_dog(_):
+    return partial(
+        reference_dog, prescreen=PreScreen(signal_floor=SYNTHETIC_BACKGROUND + 50)
+    )
+
+
+# Each candidate is built for its corpus, so that any setup per image isn't timed.
+@pytest.mark.parametrize(
+    ["mode", "build_candidate", "thresholds"],
+    [
+        ("dog_tiled_float64", partial(budgeted_dog, precision=np.float64), EXACT),
+        ("dog_tiled_float32", partial(budgeted_dog, precision=np.float32), NEAR_EXACT),
+        ("dog_prescreen", prescreened_dog, APPROXIMATE),
+    ],
+)
+def test_dog_modes_on_synthetic_images(
+    synthetic_corpus, mode, build_candidate, thresholds
+):
+    report = compare_detectors(
+        synthetic_corpus,
+        reference=reference_dog,
+        candidate=build_candidate(synthetic_corpus),
+        mode=mode,
+        max_distance=MAX_MATCH_DISTANCE,
+    )
+    assert all(c.num_reference > 0 for c in report.cases)
+    assert_within_thresholds(report, thresholds)
+
+
+def test_dog_prescreening_on_noisy_synthetic_images(noisy_synthetic_corpus):
+    reference = partial(reference_dog, spot_threshold=NOISY_DOG_THRESHOLD)
+    report = compare_detectors(
+        noisy_synthetic_corpus,
+        reference=reference,
+        candidate=partial(
+            reference, prescreen=PreScreen(signal_floor=SYNTHETIC_BACKGROUND + 200)
+        ),
+        mode="dog_prescreen",
+        max_distance=MAX_MATCH_DISTANCE,
+    )
+    assert all(c.num_reference > 0 for c in report.cases)
+    assert_within_thresholds(report, APPROXIMATE)
+
+
+@pytest.mark.parametrize(
+    ["mode", "precision", "thresholds"],
+    [
+        ("dog_tiled_float64", np.float64, EXACT),
+        ("dog_tiled_float32", np.float32, NEAR_EXACT),
+    ],
+)
+def test_dog_modes_on_real_images(real_corpus, mode, precision, thresholds):
+    report = compare_detectors(
+        real_corpus,
+        reference=reference_dog,
+        candidate=budgeted_dog(real_corpus, precision=precision),
+        mode=mode,
+        max_distance=MAX_MATCH_DISTANCE,
+    )
+    assert_within_thresholds(report, thresholds)
+
+
+@pytest.mark.parametrize("corpus_name", ["synthetic_corpus", "real_corpus"])
+def test_intensity_prescreening(request, corpus_name):
+    report = compare_detectors(
+        request.getfixturevalue(corpus_name),
+        reference=reference_int,
+        candidate=partial(reference_int, prescreen=PreScreen()),
+        mode="int_prescreen",
+        max_distance=MAX_MATCH_DISTANCE,
+    )
+    assert_within_thresholds(report, EXACT)
+
+
+def test_report_is_machine_readable(synthetic_corpus):
+    report = compare_detectors(
+        synthetic_corpus,
+        reference=reference_int,
+        candidate=reference_int,
+        mode="self",
+        max_distance=MAX_MATCH_DISTANCE,
+        repeats=2,
+    )
+    parsed = json.loads(report.to_json())
+    assert [c["case"] for c in parsed["cases"]] == list(synthetic_corpus)
+    for case in parsed["cases"]:
+        assert case["recall"] == case["precision"] == 1.0
+        assert case["mean_centroid_error"] == 0.0
+        assert case["speedup"] > 0
+    assert list(report.to_frame()["case"]) == list(synthetic_corpus)
+
+
+def test_matching_is_one_to_one_and_nearest_first():
+    reference = np.array([[0, 0, 0], [0, 0, 3]], dtype=float)
+    candidate = np.array([[0, 0, 1], [0, 0, 1.5], [0, 0, 9]], dtype=float)
+    matching = match_spots(reference, candidate, max_distance=2)
+    np_test.assert_array_equal(matching.reference_indices, [0, 1])
+    np_test.assert_array_equal(matching.candidate_indices, [0, 1])
+    np_test.assert_allclose(matching.distances, [1, 1.5])
+    assert matching.recall == 1.0
+    assert matching.precision == pytest.approx(2 / 3)
+
+
+def test_matching_distance_accounts_for_voxel_size():
+    reference = np.array([[0, 0, 0]], dtype=float)
+    candidate = np.array([[1, 0, 0]], dtype=float)
+    assert match_spots(reference, candidate, max_distance=2).num_matched == 1
+    assert (
+        match_spots(
+            reference, candidate, max_distance=2, voxel_size=(3, 1, 1)
+        ).num_matched
+        == 0
+    )
+
+
+def test_matching_with_no_spots_is_perfect():
+    matching = match_spots(np.empty((0, 3)), np.empty((0, 3)), max_distance=1)
+    assert matching.num_matched == 0
+    assert matching.recall == matching.precision == 1.0
+
+
+@pytest.mark.parametrize(
+    ["reference", "candidate", "kwargs", "error"],
+    [
+        (np.zeros((2, 2)), np.zeros((2, 3)), {}, DimensionalityError),
+        (np.zeros((2, 3)), np.zeros(3), {}, DimensionalityError),
+        (np.zeros((2, 3)), np.zeros((2, 3)), dict(max_distance=-1), ValueError),
+        (np.zeros((2, 3)), np.zeros((2, 3)), dict(voxel_size=(1, 0, 1)), ValueError),
+    ],
+)
+def test_matching_rejects_invalid_input(reference, candidate, kwargs, error):
+    with pytest.raises(error):
+        match_spots(reference, candidate, **{"max_distance": 1, **kwargs})
+
+
+def test_thresholds_report_each_shortfall():
+    report = CaseReport(
+        case="img",
+        mode="fast",
+        num_reference=10,
+        num_candidate=12,
+        num_matched=9,
+        recall=0.9,
+        precision=0.75,
+        mean_centroid_error=0.8,
+        max_centroid_error=1.5,
+        reference_seconds=1.0,
+        candidate_seconds=2.0,
+    )
+    assert report.speedup == 0.5
+    thresholds = AccuracyThresholds(
+        min_recall=0.95, min_precision=0.95, max_centroid_error=0.5, min_speedup=1
+    )
+    violations = thresholds.violations(report)
+    assert len(violations) == 4
+    assert all(v.startswith("fast on img") for v in violations)
+    assert APPROXIMATE.violations(report) != []
+    assert (
+        AccuracyThresholds(
+            min_recall=0.9, min_precision=0.75, max_centroid_error=0.8
+        ).violations(report)
+        == []
+    )
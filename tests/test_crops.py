@@ -0,0 +1,134 @@
+"""Tests for the extraction of spot-centred crops"""
+
+import hypothesis as hyp
+import numpy as np
+import numpy.testing as np_test
+import pandas as pd
+import pytest
+
+from spotfishing import DetectionResult, DimensionalityError
+from spotfishing.crops import extract_spot_crops
+from spotfishing.detection_result import DETECTION_RESULT_TABLE_COLUMNS
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+def build_table(centers) -> pd.DataFrame:
+    return pd.DataFrame(
+        [(*c, 1.0, 1.0) for c in centers], columns=DETECTION_RESULT_TABLE_COLUMNS
+    )
+
+
+def crop_one_by_one(image, center, box_shape, fill_value):
+    """Reference implementation: per-spot slicing of a padded image"""
+    pad = 20
+    padded = np.pad(image, pad, constant_values=fill_value)
+    origin = np.floor(np.asarray(center) + 0.5).astype(int) - np.array(box_shape) // 2
+    return padded[tuple(slice(o + pad, o + pad + n) for o, n in zip(origin, box_shape))]
+
+
+gen_box_side = hyp.strategies.integers(min_value=1, max_value=6)
+gen_center = hyp.strategies.tuples(
+    *(
+        hyp.strategies.floats(min_value=-2, max_value=12, allow_nan=False)
+        for _ in range(3)
+    )
+)
+
+
+@hyp.given(
+    centers=hyp.strategies.lists(gen_center, max_size=20),
+    box_shape=hyp.strategies.tuples(gen_box_side, gen_box_side, gen_box_side),
+    spots_per_chunk=hyp.strategies.integers(min_value=1, max_value=8),
+)
+def test_crops_match_per_spot_slicing(centers, box_shape, spots_per_chunk):
+    image = np.arange(8 * 9 * 10, dtype=np.uint16).reshape(8, 9, 10) + 1
+    observed = extract_spot_crops(
+        build_table(centers),
+        image=image,
+        box_shape=box_shape,
+        spots_per_chunk=spots_per_chunk,
+    )
+    assert observed.crops.shape == (len(centers), *box_shape)
+    assert observed.crops.dtype == image.dtype
+    for crop, valid, center in zip(observed.crops, observed.valid, centers):
+        np_test.assert_array_equal(
+            crop, crop_one_by_one(image, center, box_shape, fill_value=0)
+        )
+        # Pixel values are all positive, so validity is exactly where a value came from the image.
+        np_test.assert_array_equal(valid, crop > 0)
+
+
+def test_completeness_flags_crops_overlapping_border():
+    image = np.ones((10, 10, 10), dtype=np.uint16)
+    observed = extract_spot_crops(
+        build_table([(5.0, 5.0, 5.0), (0.2, 5.0, 5.0), (5.0, 5.0, 9.4)]),
+        image=image,
+        box_shape=(3, 3, 3),
+    )
+    np_test.assert_array_equal(observed.complete, [True, False, False])
+    np_test.assert_array_equal(observed.origins, [[4, 4, 4], [-1, 4, 4], [4, 4, 8]])
+
+
+def test_fill_value_determines_output_type_when_necessary():
+    image = np.ones((4, 4, 4), dtype=np.uint16)
+    observed = extract_spot_crops(
+        build_table([(0.0, 0.0, 0.0)]),
+        image=image,
+        box_shape=(2, 2, 2),
+        fill_value=np.nan,
+    )
+    assert np.isnan(observed.crops[0, 0, 0, 0])
+    assert observed.crops[0, 1, 1, 1] == 1
+
+
+def test_crops_from_memory_mapped_image(tmp_path):
+    image = np.random.default_rng(0).integers(0, 1000, size=(6, 7, 8), dtype=np.uint16)
+    path = tmp_path / "img.npy"
+    np.save(path, image)
+    centers = [(1.0, 2.0, 3.0), (5.0, 6.0, 7.0)]
+    from_memmap = extract_spot_crops(
+        build_table(centers), image=np.load(path, mmap_mode="r"), box_shape=(3, 3, 3)
+    )
+    in_memory = extract_spot_crops(
+        build_table(centers), image=image, box_shape=(3, 3, 3)
+    )
+    np_test.assert_array_equal(from_memmap.crops, in_memory.crops)
+    assert isinstance(from_memmap.crops, np.ndarray)
+    assert not isinstance(from_memmap.crops, np.memmap)
+
+
+def test_detection_result_image_is_used_by_default():
+    image = np.arange(27, dtype=np.uint16).reshape(3, 3, 3)
+    result = DetectionResult(
+        table=build_table([(1.0, 1.0, 1.0)]),
+        image=image,
+        labels=np.zeros_like(image, dtype=np.int32),
+    )
+    observed = extract_spot_crops(result, box_shape=(3, 3, 3))
+    np_test.assert_array_equal(observed.crops[0], image)
+
+
+@pytest.mark.parametrize("box_shape", [(3, 3), (0, 3, 3), (3, 2.5, 3)])
+def test_invalid_box_shape_is_rejected(box_shape):
+    with pytest.raises(ValueError):
+        extract_spot_crops(
+            build_table([]), image=np.zeros((3, 3, 3)), box_shape=box_shape
+        )
+
+
+@pytest.mark.parametrize("spots_per_chunk", [0, -1])
+def test_invalid_chunk_size_is_rejected(spots_per_chunk):
+    with pytest.raises(ValueError):
+        extract_spot_crops(
+            build_table([(1.0, 1.0, 1.0)]),
+            image=np.zeros((3, 3, 3)),
+            box_shape=(3, 3, 3),
+            spots_per_chunk=spots_per_chunk,
+        )
+
+
+def test_non_3d_image_is_rejected():
+    with pytest.raises(DimensionalityError):
+        extract_spot_crops(build_table([]), image=np.zeros((3, 3)), box_shape=(1, 1, 1))
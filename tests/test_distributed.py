@@ -0,0 +1,237 @@
+"""Tests for sharded spot detection by independent workers, coordinated through a shared filesystem"""
+
+import multiprocessing
+import os
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pytest
+from helpers import synthetic_spots_image
+
+from spotfishing import IncompleteWorkError, detect_spots_int, distributed
+from spotfishing.distributed import (
+    IMAGE_KEY_COLUMN,
+    WorkQueue,
+    merge_results,
+    run_worker,
+)
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+NUM_IMAGES = 7
+
+detect = partial(detect_spots_int, spot_threshold=300, expand_px=1)
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    paths = []
+    for i in range(NUM_IMAGES):
+        image = synthetic_spots_image(
+            (8, 48, 48), num_spots=5, seed=i, amplitudes=1000, margin=(3, 5, 5)
+        )
+        path = tmp_path / "images" / f"img_{i}.npy"
+        path.parent.mkdir(exist_ok=True)
+        np.save(path, image)
+        paths.append(str(path))
+    return paths
+
+
+def expected_merge(manifest):
+    tables = [
+        detect(np.load(path)).table.assign(**{IMAGE_KEY_COLUMN: path})
+        for path in manifest
+    ]
+    table = pd.concat(tables, ignore_index=True)
+    return table[[IMAGE_KEY_COLUMN] + list(table.columns[:-1])]
+
+
+def age_lease(queue, unit_id, seconds):
+    """Make the lease on the given unit look as if its last heartbeat was the given number of seconds ago."""
+    then = time.time() - seconds
+    os.utime(queue.lease_path(unit_id), (then, then))
+
+
+def test_queue_shards_manifest_in_order(tmp_path, manifest):
+    queue = WorkQueue.create(tmp_path / "queue", manifest=manifest, images_per_unit=3)
+    unit_ids = queue.unit_ids()
+    assert len(unit_ids) == 3
+    assert [img for u in unit_ids for img in queue.images(u)] == manifest
+    status = queue.status()
+    assert (status.pending, status.leased, status.done, status.failed) == (3, 0, 0, 0)
+
+
+def test_queue_cannot_be_created_twice(tmp_path, manifest):
+    WorkQueue.create(tmp_path / "queue", manifest=manifest, images_per_unit=3)
+    with pytest.raises(FileExistsError):
+        WorkQueue.create(tmp_path / "queue", manifest=manifest, images_per_unit=2)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(images_per_unit=0),
+        dict(images_per_unit=2, lease_timeout=0),
+        dict(images_per_unit=2, lease_timeout=10, heartbeat_interval=10),
+    ],
+)
+def test_queue_rejects_invalid_settings(tmp_path, manifest, kwargs):
+    with pytest.raises(ValueError):
+        WorkQueue.create(tmp_path / "queue", manifest=manifest, **kwargs)
+
+
+def test_several_processes_share_the_work(tmp_path, manifest):
+    queue = WorkQueue.create(tmp_path / "queue", manifest=manifest, images_per_unit=1)
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(queue,),
+            kwargs=dict(detect=detect, worker_id=f"node{i}"),
+        )
+        for i in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=120)
+        assert worker.exitcode == 0
+    status = queue.status()
+    assert status.finished and status.done == NUM_IMAGES
+    assert list(queue.lease_path("x").parent.glob("*.lease")) == []
+    pd.testing.assert_frame_equal(merge_results(queue), expected_merge(manifest))
+
+
+def test_claims_are_exclusive(tmp_path, manifest):
+    queue = WorkQueue.create(tmp_path / "queue", manifest=manifest, images_per_unit=3)
+    leases = [queue.claim(worker_id=f"w{i}") for i in range(4)]
+    assert [lease.unit_id for lease in leases[:3]] == queue.unit_ids()
+    assert leases[3] is None
+    assert queue.status().leased == 3
+
+
+def test_expired_lease_is_taken_over(tmp_path, manifest):
+    queue = WorkQueue.create(
+        tmp_path / "queue",
+        manifest=manifest,
+        images_per_unit=NUM_IMAGES,
+        lease_timeout=60,
+        heartbeat_interval=10,
+    )
+    first = queue.claim(worker_id="dead")
+    age_lease(queue, first.unit_id, 30)
+    assert queue.claim(worker_id="other") is None
+    age_lease(queue, first.unit_id, 90)
+    second = queue.claim(worker_id="other")
+    assert second is not None and second.unit_id == first.unit_id
+    assert second.is_held() and not first.is_held()
+    # The original holder, if it's alive after all, sees its lease is lost.
+    assert not first.beat()
+    first.release()
+    assert second.is_held()
+
+
+def test_lease_broken_and_retaken_during_takeover_is_left_alone(
+    tmp_path, manifest, monkeypatch
+):
+    queue = WorkQueue.create(
+        tmp_path / "queue",
+        manifest=manifest,
+        images_per_unit=NUM_IMAGES,
+        lease_timeout=60,
+        heartbeat_interval=10,
+    )
+    dead = queue.claim(worker_id="dead")
+    age_lease(queue, dead.unit_id, 90)
+    rename = os.rename
+    competitors = []
+
+    def rename_after_competitor(src, dst):
+        # Between the slow worker's check of the expired lease and its rename, a
+        # competitor breaks the lease (renaming unhindered) and takes a new one.
+        monkeypatch.setattr(distributed.os, "rename", rename)
+        competitors.append(queue._try_lease(dead.unit_id, worker_id="fast"))
+        rename(src, dst)
+
+    monkeypatch.setattr(distributed.os, "rename", rename_after_competitor)
+    assert queue._try_lease(dead.unit_id, worker_id="slow") is None
+    assert len(competitors) == 1
+    fast = competitors[0]
+    assert fast is not None and fast.is_held() and not dead.is_held()
+    assert queue.status().leased == 1
+
+
+def test_open_queue_has_settings_of_creation(tmp_path, manifest):
+    created = WorkQueue.create(
+        tmp_path / "queue",
+        manifest=manifest,
+        images_per_unit=3,
+        lease_timeout=60,
+        heartbeat_interval=10,
+    )
+    opened = WorkQueue.open(tmp_path / "queue")
+    assert opened == created
+    assert opened.claim(worker_id="w") is not None
+
+
+def test_worker_refuses_settings_other_than_the_queue(tmp_path, manifest):
+    WorkQueue.create(tmp_path / "queue", manifest=manifest, images_per_unit=3)
+    impatient = WorkQueue(
+        root=tmp_path / "queue", lease_timeout=5, heartbeat_interval=1
+    )
+    with pytest.raises(ValueError):
+        impatient.claim(worker_id="w")
+    with pytest.raises(ValueError):
+        run_worker(impatient, detect=detect)
+
+
+def test_missing_queue_cannot_be_opened(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        WorkQueue.open(tmp_path / "queue")
+
+
+def test_heartbeats_keep_lease_alive(tmp_path, manifest):
+    queue = WorkQueue.create(
+        tmp_path / "queue",
+        manifest=manifest,
+        images_per_unit=NUM_IMAGES,
+        lease_timeout=0.5,
+        heartbeat_interval=0.1,
+    )
+    with queue.claim(worker_id="busy") as lease:
+        time.sleep(1.5)
+        assert queue.claim(worker_id="other") is None
+        assert lease.is_held()
+    assert not lease.path.exists()
+    assert queue.status().pending == 1
+
+
+def test_failed_unit_is_recorded_and_blocks_merge(tmp_path, manifest):
+    manifest = manifest[:3] + [str(tmp_path / "missing.npy")] + manifest[3:]
+    queue = WorkQueue.create(tmp_path / "queue", manifest=manifest, images_per_unit=2)
+    assert run_worker(queue, detect=detect, worker_id="solo") == 4
+    status = queue.status()
+    assert (status.done, status.failed) == (3, 1)
+    failed_unit = queue.unit_ids()[1]
+    report = queue.failure_path(failed_unit).read_text()
+    assert "solo" in report and "FileNotFoundError" in report
+    with pytest.raises(IncompleteWorkError):
+        merge_results(queue)
+    partial_merge = merge_results(queue, allow_incomplete=True)
+    assert set(partial_merge[IMAGE_KEY_COLUMN]) == set(manifest) - set(
+        queue.images(failed_unit)
+    )
+
+
+def test_worker_stops_after_maximum_units(tmp_path, manifest):
+    queue = WorkQueue.create(tmp_path / "queue", manifest=manifest, images_per_unit=2)
+    assert run_worker(queue, detect=detect, max_units=2) == 2
+    assert queue.status().done == 2
+    with pytest.raises(IncompleteWorkError):
+        merge_results(queue)
+    assert run_worker(queue, detect=detect) == 2
+    pd.testing.assert_frame_equal(merge_results(queue), expected_merge(manifest))
@@ -0,0 +1,172 @@
+"""Tests for DoG spot detection which streams through the image block by block"""
+
+from dataclasses import replace
+
+import numpy as np
+import numpy.testing as np_test
+import pandas as pd
+import pytest
+from helpers import synthetic_spots_image
+
+from spotfishing import detect_spots_dog
+from spotfishing.fused import ResponseStatistics, SparseResponse, detect_spots_dog_fused
+from spotfishing_looptrace import ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+SHAPE = (20, 150, 130)
+
+TRANSFORM = ORIGINAL_LOOPTRACE_DOG_SPECIFICATION.transformation
+
+
+@pytest.fixture(scope="module")
+def image():
+    return synthetic_spots_image(SHAPE, num_spots=60, seed=5)
+
+
+@pytest.mark.parametrize(
+    ["transform", "threshold"],
+    [(TRANSFORM, 15), (replace(TRANSFORM, standardise=False), 0.05)],
+)
+@pytest.mark.parametrize(
+    ["block_shape", "workers"], [((16, 96, 96), 1), ((7, 40, 50), 1), ((7, 40, 50), 3)]
+)
+def test_fused_detection_matches_whole_image_detection(
+    image, transform, threshold, block_shape, workers
+):
+    expected = detect_spots_dog(
+        image, spot_threshold=threshold, expand_px=1, transform=transform
+    )
+    observed = detect_spots_dog_fused(
+        image,
+        spot_threshold=threshold,
+        expand_px=1,
+        transform=transform,
+        block_shape=block_shape,
+        workers=workers,
+    )
+    assert expected.table.shape[0] > 0
+    pd.testing.assert_frame_equal(observed.table, expected.table)
+    np_test.assert_array_equal(observed.labels, expected.labels)
+    # The response is kept exactly where the transformed image is above the threshold.
+    above = expected.image > threshold
+    np_test.assert_array_equal(observed.response.indices, np.flatnonzero(above))
+    np_test.assert_allclose(observed.response.values, expected.image[above])
+    assert observed.response.nbytes < expected.image.nbytes / 10
+    np_test.assert_allclose(observed.build_image(workers=workers), expected.image)
+
+
+def test_statistics_are_those_of_the_whole_transformed_image(image):
+    observed = detect_spots_dog_fused(
+        image, spot_threshold=15, expand_px=1, transform=TRANSFORM
+    )
+    img = replace(TRANSFORM, standardise=False)(image)
+    assert observed.statistics.mean == pytest.approx(np.mean(img))
+    assert observed.statistics.std == pytest.approx(np.std(img))
+    unstandardised = detect_spots_dog_fused(
+        image,
+        spot_threshold=15,
+        expand_px=1,
+        transform=replace(TRANSFORM, standardise=False),
+    )
+    assert unstandardised.statistics is None
+
+
+def test_given_statistics_are_used(image):
+    first = detect_spots_dog_fused(
+        image, spot_threshold=15, expand_px=1, transform=TRANSFORM
+    )
+    again = detect_spots_dog_fused(
+        image,
+        spot_threshold=15,
+        expand_px=1,
+        transform=TRANSFORM,
+        statistics=first.statistics,
+    )
+    pd.testing.assert_frame_equal(again.table, first.table)
+    stricter = detect_spots_dog_fused(
+        image,
+        spot_threshold=15,
+        expand_px=1,
+        transform=TRANSFORM,
+        statistics=replace(first.statistics, std=2 * first.statistics.std),
+    )
+    assert stricter.response.indices.size < first.response.indices.size
+
+
+def test_each_pass_transforms_each_block_once(image):
+    calls = []
+
+    def counting_pre_diff(img):
+        calls.append(img.shape)
+        return img
+
+    transform = replace(TRANSFORM, pre_diff=counting_pre_diff)
+    block_shape = (20, 75, 65)
+    first = detect_spots_dog_fused(
+        image,
+        spot_threshold=15,
+        expand_px=1,
+        transform=transform,
+        block_shape=block_shape,
+    )
+    # One pass for the statistics, and one to threshold
+    assert len(calls) == 2 * 4
+    calls.clear()
+    detect_spots_dog_fused(
+        image,
+        spot_threshold=15,
+        expand_px=1,
+        transform=transform,
+        block_shape=block_shape,
+        statistics=first.statistics,
+    )
+    assert len(calls) == 4
+
+
+def test_conversion_to_detection_result(image):
+    observed = detect_spots_dog_fused(
+        image, spot_threshold=15, expand_px=1, transform=TRANSFORM
+    ).to_detection_result()
+    expected = detect_spots_dog(
+        image, spot_threshold=15, expand_px=1, transform=TRANSFORM
+    )
+    pd.testing.assert_frame_equal(observed.table, expected.table)
+    np_test.assert_allclose(observed.image, expected.image)
+
+
+def test_sparse_response_to_dense():
+    response = SparseResponse(
+        shape=(2, 2, 3), indices=np.array([1, 7]), values=np.array([2.0, 3.0])
+    )
+    dense = response.to_dense(fill_value=0)
+    assert dense[0, 0, 1] == 2 and dense[1, 0, 1] == 3 and dense.sum() == 5
+    np_test.assert_array_equal(response.coordinates(), [[0, 0, 1], [1, 0, 1]])
+    assert np.isnan(response.to_dense()[0, 0, 0])
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(block_shape=(0, 8, 8)),
+        dict(block_shape=(8, 8)),
+        dict(workers=0),
+        dict(
+            transform=replace(TRANSFORM, standardise=False),
+            statistics=ResponseStatistics(mean=0, std=1),
+        ),
+    ],
+)
+def test_invalid_options_are_rejected(image, kwargs):
+    kwargs = dict(transform=TRANSFORM) | kwargs
+    with pytest.raises(ValueError):
+        detect_spots_dog_fused(image, spot_threshold=15, expand_px=1, **kwargs)
+
+
+def test_transformation_must_be_dog(image):
+    with pytest.raises(TypeError):
+        detect_spots_dog_fused(
+            image, spot_threshold=15, expand_px=1, transform=lambda img: img
+        )
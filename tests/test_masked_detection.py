@@ -0,0 +1,190 @@
+"""Tests for spot detection restricted to masked regions, e.g. nuclei"""
+
+from dataclasses import replace
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pytest
+from helpers import synthetic_spots_image
+
+from spotfishing import (
+    ROI_REGION_ID_KEY,
+    DetectionResult,
+    RoiCenterKeys,
+    detect_spots_dog,
+    detect_spots_int,
+)
+from spotfishing.detection_result import (
+    DETECTION_RESULT_TABLE_COLUMNS,
+    IllegalDetectionResult,
+)
+from spotfishing.prescreen import PreScreen
+from spotfishing_looptrace import ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+SHAPE = (16, 160, 160)
+
+detect_int = partial(detect_spots_int, spot_threshold=300, expand_px=1)
+
+detect_dog = partial(
+    detect_spots_dog,
+    spot_threshold=15,
+    expand_px=1,
+    transform=ORIGINAL_LOOPTRACE_DOG_SPECIFICATION.transformation,
+)
+
+detect_dog_unstandardised = partial(
+    detect_spots_dog,
+    spot_threshold=0.05,
+    expand_px=1,
+    transform=replace(
+        ORIGINAL_LOOPTRACE_DOG_SPECIFICATION.transformation, standardise=False
+    ),
+)
+
+
+@pytest.fixture(scope="module")
+def image():
+    return synthetic_spots_image(SHAPE, num_spots=80, seed=11)
+
+
+@pytest.fixture(scope="module")
+def nuclei():
+    """Label image of two box-shaped nuclei, and one ball-shaped nucleus"""
+    labels = np.zeros(SHAPE, dtype=np.uint16)
+    labels[:, 10:60, 20:70] = 3
+    labels[:, 100:150, 90:150] = 8
+    z, y, x = np.ogrid[: SHAPE[0], : SHAPE[1], : SHAPE[2]]
+    labels[((y - 120) ** 2 + (x - 35) ** 2 < 25**2) & (z >= 0)] = 5
+    return labels
+
+
+def expected_table(reference, mask):
+    """Filter the reference table to spots with centroid in a masked region, tagged with the region's ID."""
+    table = reference.table
+    voxels = np.floor(table[RoiCenterKeys.to_list()].to_numpy() + 0.5).astype(int)
+    ids = mask[tuple(voxels.T)]
+    expected = table[ids > 0].reset_index(drop=True)
+    expected[ROI_REGION_ID_KEY] = ids[ids > 0]
+    return expected
+
+
+def sort_spots(table):
+    return table.sort_values(RoiCenterKeys.to_list()).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("detect", [detect_int, detect_dog_unstandardised])
+def test_masked_detection_matches_filtered_whole_image_detection(image, nuclei, detect):
+    expected = expected_table(detect(image), nuclei)
+    observed = detect(image, mask=nuclei)
+    assert expected.shape[0] > 0
+    pd.testing.assert_frame_equal(sort_spots(observed.table), sort_spots(expected))
+
+
+@pytest.mark.parametrize("detect", [detect_int, detect_dog_unstandardised])
+def test_spot_reaching_far_beyond_its_region_is_whole(image, nuclei, detect):
+    # A long bar from inside nucleus 3 (x < 70) to well beyond the padding of its box
+    img = image.copy()
+    img[7:10, 34:37, 35:95] = 2000
+    expected = expected_table(detect(img), nuclei)
+    observed = detect(img, mask=nuclei)
+    pd.testing.assert_frame_equal(sort_spots(observed.table), sort_spots(expected))
+    assert observed.table["area"].max() >= 3 * 3 * 60
+
+
+def test_boolean_mask_regions_are_connected_components(image, nuclei):
+    observed = detect_int(image, mask=nuclei > 0)
+    assert set(observed.table[ROI_REGION_ID_KEY]) <= {1, 2, 3}
+    by_label = detect_int(image, mask=nuclei)
+    pd.testing.assert_frame_equal(
+        sort_spots(observed.table).drop(columns=ROI_REGION_ID_KEY),
+        sort_spots(by_label.table).drop(columns=ROI_REGION_ID_KEY),
+    )
+
+
+@pytest.mark.parametrize("detect", [detect_int, detect_dog])
+def test_labels_correspond_to_table_rows(image, nuclei, detect):
+    result = detect(image, mask=nuclei)
+    num_spots = result.table.shape[0]
+    assert num_spots > 0
+    assert set(np.unique(result.labels)) == set(range(num_spots + 1))
+    for i, row in result.table.iterrows():
+        voxel = tuple(
+            np.floor(row[RoiCenterKeys.to_list()].to_numpy(dtype=float) + 0.5).astype(
+                int
+            )
+        )
+        assert nuclei[voxel] == row[ROI_REGION_ID_KEY]
+        assert np.sum(result.labels == i + 1) == row["area"]
+
+
+def test_standardised_dog_detection_finds_spots_in_regions_only(image, nuclei):
+    reference = expected_table(detect_dog(image), nuclei)
+    observed = detect_dog(image, mask=nuclei)
+    assert abs(observed.table.shape[0] - reference.shape[0]) <= 0.1 * reference.shape[0]
+    assert observed.table[ROI_REGION_ID_KEY].isin([3, 5, 8]).all()
+
+
+@pytest.mark.parametrize("detect", [detect_int, detect_dog])
+def test_empty_mask_gives_empty_result(image, detect):
+    result = detect(image, mask=np.zeros(SHAPE, dtype=bool))
+    assert list(result.table.columns) == DETECTION_RESULT_TABLE_COLUMNS + [
+        ROI_REGION_ID_KEY
+    ]
+    assert result.table.shape[0] == 0
+    assert not np.any(result.labels)
+
+
+@pytest.mark.parametrize(
+    "mask",
+    [
+        np.ones((4, 4, 4), dtype=bool),
+        np.ones(SHAPE, dtype=float),
+        np.full(SHAPE, -1, dtype=np.int16),
+        [[[1]]],
+    ],
+)
+@pytest.mark.parametrize("detect", [detect_int, detect_dog])
+def test_invalid_mask_is_rejected(image, detect, mask):
+    with pytest.raises(ValueError):
+        detect(image, mask=mask)
+
+
+@pytest.mark.parametrize(
+    ["detect", "prescreen"],
+    [
+        (detect_int, PreScreen()),
+        (detect_dog, PreScreen(signal_floor=150)),
+    ],
+)
+def test_mask_and_prescreen_are_mutually_exclusive(image, nuclei, detect, prescreen):
+    with pytest.raises(ValueError):
+        detect(image, mask=nuclei, prescreen=prescreen)
+
+
+@pytest.mark.parametrize(
+    ["extra_columns", "is_legal"],
+    [
+        ([], True),
+        ([ROI_REGION_ID_KEY], True),
+        ([ROI_REGION_ID_KEY, ROI_REGION_ID_KEY], False),
+        (["other"], False),
+    ],
+)
+def test_detection_result_allows_only_known_optional_columns(extra_columns, is_legal):
+    table = pd.DataFrame(columns=DETECTION_RESULT_TABLE_COLUMNS + extra_columns)
+    build = partial(
+        DetectionResult,
+        table=table,
+        image=np.zeros((1, 1, 1)),
+        labels=np.zeros((1, 1, 1), dtype=int),
+    )
+    if is_legal:
+        build()
+    else:
+        with pytest.raises(IllegalDetectionResult):
+            build()
@@ -0,0 +1,211 @@
+"""Tests for planning spot detection within a memory budget"""
+
+import tracemalloc
+from functools import partial
+
+import numpy as np
+import numpy.testing as np_test
+import pandas as pd
+import pytest
+from helpers import synthetic_spots_image
+
+from spotfishing import (
+    InsufficientMemoryBudgetError,
+    RoiCenterKeys,
+    detect_spots_dog,
+    detect_spots_int,
+    memory_planner,
+)
+from spotfishing.memory_planner import plan_detection
+from spotfishing.prescreen import PreScreen
+from spotfishing_looptrace import ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+SPEC = ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+THRESHOLD = 15
+EXPAND_PX = 1
+
+detect = partial(
+    detect_spots_dog,
+    spot_threshold=THRESHOLD,
+    expand_px=EXPAND_PX,
+    transform=SPEC.transformation,
+)
+
+
+@pytest.fixture(scope="module")
+def spots_image():
+    return synthetic_spots_image((16, 160, 160), num_spots=40, seed=7, amplitudes=1000)
+
+
+def plan_for(image, budget, **kwargs):
+    return plan_detection(
+        image.shape,
+        image.dtype,
+        transform=SPEC,
+        memory_budget=budget,
+        expand_px=EXPAND_PX,
+        **kwargs,
+    )
+
+
+def test_generous_budget_gives_reference_behaviour(spots_image):
+    plan = plan_for(spots_image, 2**40)
+    assert plan.fits
+    assert plan.tile_shape is None
+    assert plan.precision == np.float64
+    plain = detect(spots_image)
+    budgeted = detect(spots_image, memory_budget=2**40)
+    pd.testing.assert_frame_equal(budgeted.table, plain.table)
+    np_test.assert_array_equal(budgeted.image, plain.image)
+
+
+def test_estimate_of_peak_memory_is_realistic(spots_image):
+    estimate = plan_for(spots_image, 2**40).peak_bytes
+    tracemalloc.start()
+    try:
+        detect(spots_image)
+        _, observed = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # The input image already exists, so isn't counted by the trace.
+    observed += spots_image.nbytes
+    assert 0.75 * observed <= estimate <= 1.5 * observed
+
+
+def test_tighter_budget_tiles_transformation_with_same_result(spots_image):
+    reference = plan_for(spots_image, 2**40)
+    peaks = {s.name: s.peak_bytes for s in reference.stages}
+    # Budget which the untiled transformation and standardisation exceed, but no other stage does.
+    budget = max(v for k, v in peaks.items() if k not in {"transform", "standardise"})
+    budget = max(budget, peaks["standardise"] // 2)
+    plan = plan_for(spots_image, budget, max_workers=2)
+    assert plan.fits
+    assert plan.tile_shape is not None
+    assert plan.precision == np.float64
+    plain = detect(spots_image)
+    budgeted = detect(spots_image, memory_budget=budget)
+    pd.testing.assert_frame_equal(budgeted.table, plain.table)
+    np_test.assert_allclose(budgeted.image, plain.image, atol=1e-9)
+
+
+def test_reduced_precision_is_chosen_only_when_necessary(spots_image):
+    plans = [
+        plan_for(spots_image, b, max_workers=1)
+        for b in range(2**20, 2**28, 2**18)
+    ]
+    precisions = [p.precision for p in plans if p.fits and p.tile_shape is not None]
+    assert np.float32 in precisions and np.float64 in precisions
+    # Float32 plans are chosen only for budgets smaller than any float64 plan.
+    first_float64 = precisions.index(np.float64)
+    assert all(p == np.float32 for p in precisions[:first_float64])
+    assert all(p == np.float64 for p in precisions[first_float64:])
+
+
+def test_reduced_precision_detection_finds_same_spots(spots_image):
+    budget = next(
+        b for b in range(2**20, 2**28, 2**18) if plan_for(spots_image, b).fits
+    )
+    assert plan_for(spots_image, budget).precision == np.float32
+    plain = detect(spots_image)
+    budgeted = detect(spots_image, memory_budget=budget)
+    assert budgeted.image.dtype == np.float32
+    assert budgeted.table.shape[0] == plain.table.shape[0]
+    np_test.assert_allclose(
+        budgeted.table[RoiCenterKeys.to_list()],
+        plain.table[RoiCenterKeys.to_list()],
+        atol=1e-3,
+    )
+
+
+def test_impossible_budget_is_reported_and_refused(spots_image):
+    plan = plan_for(spots_image, 1024)
+    assert not plan.fits
+    assert "EXCEEDS BUDGET" in plan.report()
+    with pytest.raises(InsufficientMemoryBudgetError):
+        detect(spots_image, memory_budget=1024)
+
+
+def test_plans_are_built_only_until_one_fits(spots_image, monkeypatch):
+    peaks = []
+    estimate = memory_planner._estimate_stages
+
+    def recording_estimate(*args, **kwargs):
+        stages = estimate(*args, **kwargs)
+        peaks.append(max(s.peak_bytes for s in stages))
+        return stages
+
+    monkeypatch.setattr(memory_planner, "_estimate_stages", recording_estimate)
+    assert plan_for(spots_image, 2**40).tile_shape is None
+    assert len(peaks) == 1
+    peaks.clear()
+    # When no plan fits, every plan is considered, and the leanest is returned.
+    plan = plan_for(spots_image, 1024, max_workers=2)
+    assert not plan.fits
+    assert len(peaks) > 1
+    assert plan.peak_bytes == min(peaks)
+
+
+def test_report_lists_every_stage(spots_image):
+    report = plan_for(spots_image, 2**40).report()
+    for stage in [
+        "transform",
+        "standardise",
+        "threshold_and_label",
+        "expand_labels",
+        "measure",
+    ]:
+        assert stage in report
+
+
+def test_tiles_cover_image_exactly_once(spots_image):
+    plan = plan_for(spots_image, 8 * 2**20)
+    assert plan.tile_shape is not None
+    coverage = np.zeros(spots_image.shape, dtype=int)
+    for tile in plan.tiles():
+        coverage[tile] += 1
+    assert np.all(coverage == 1)
+
+
+@pytest.mark.parametrize(
+    "kwargs", [dict(memory_budget=0), dict(memory_budget=2**30, max_workers=0)]
+)
+def test_planner_rejects_invalid_arguments(kwargs):
+    with pytest.raises(ValueError):
+        plan_detection((4, 4, 4), np.uint16, transform=SPEC, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(prescreen=PreScreen(block_shape=(8, 32, 32), signal_floor=200)),
+        dict(mask=np.ones((16, 160, 160), dtype=bool)),
+    ],
+)
+def test_budget_cannot_be_combined_with_prescreen_or_mask(spots_image, kwargs):
+    with pytest.raises(ValueError):
+        detect(spots_image, memory_budget=2**40, **kwargs)
+
+
+def test_intensity_detection_is_planned_and_budgeted(spots_image):
+    plan = plan_detection(
+        spots_image.shape,
+        spots_image.dtype,
+        transform=None,
+        memory_budget=2**40,
+        expand_px=EXPAND_PX,
+    )
+    assert plan.fits and plan.tile_shape is None and plan.precision is None
+    report = plan.report()
+    assert "precision: none" in report and "threshold_and_fill" in report
+    detect_int = partial(detect_spots_int, spot_threshold=500, expand_px=EXPAND_PX)
+    plain = detect_int(spots_image)
+    assert plain.table.shape[0] > 0
+    pd.testing.assert_frame_equal(
+        detect_int(spots_image, memory_budget=2**40).table, plain.table
+    )
+    with pytest.raises(InsufficientMemoryBudgetError):
+        detect_int(spots_image, memory_budget=1024)
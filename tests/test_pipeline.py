@@ -0,0 +1,187 @@
+"""Tests for the asynchronous pipeline of spot detection over many images"""
+
+import asyncio
+import threading
+from contextlib import aclosing
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pytest
+from helpers import synthetic_spots_image
+
+from spotfishing import detect_spots_dog
+from spotfishing.pipeline import DetectionPipeline
+from spotfishing_looptrace import ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+detect = partial(
+    detect_spots_dog,
+    spot_threshold=15,
+    expand_px=1,
+    transform=ORIGINAL_LOOPTRACE_DOG_SPECIFICATION.transformation,
+)
+
+
+def make_image(seed):
+    return synthetic_spots_image((12, 64, 64), num_spots=8, seed=seed, amplitudes=1000)
+
+
+class Tracker:
+    """Count images which have begun loading but not yet entered detection."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ahead = 0
+        self.max_ahead = 0
+        self.loaded = []
+
+    def start_load(self, key):
+        with self.lock:
+            self.ahead += 1
+            self.max_ahead = max(self.max_ahead, self.ahead)
+            self.loaded.append(key)
+
+    def start_detect(self):
+        with self.lock:
+            self.ahead -= 1
+
+
+async def collect(pipeline, keys):
+    return [r async for r in pipeline.run(keys)]
+
+
+def test_results_match_direct_detection_in_order_of_keys():
+    keys = [3, 1, 4, 1, 5]
+    pipeline = DetectionPipeline(load=make_image, detect=detect, prefetch=2)
+    results = asyncio.run(collect(pipeline, keys))
+    assert [r.key for r in results] == keys
+    for r in results:
+        pd.testing.assert_frame_equal(r.result.table, detect(make_image(r.key)).table)
+
+
+def test_coroutine_loader_and_asynchronous_keys():
+    async def load(key):
+        await asyncio.sleep(0.01)
+        return make_image(key)
+
+    async def keys():
+        for k in range(3):
+            yield k
+
+    pipeline = DetectionPipeline(load=load, detect=detect)
+    results = asyncio.run(collect(pipeline, keys()))
+    assert [r.key for r in results] == [0, 1, 2]
+
+
+def test_loading_overlaps_detection():
+    num_images = 4
+    loaded = [threading.Event() for _ in range(num_images)]
+
+    def load(key):
+        loaded[key].set()
+        return np.full((1, 1, 1), key)
+
+    def waiting_detect(image):
+        key = image.item()
+        # Detection of each image waits for the next image to be loaded; without
+        # overlap, that load would only begin after this detection returns.
+        if key + 1 < num_images:
+            assert loaded[key + 1].wait(
+                timeout=10
+            ), f"Image {key + 1} wasn't loaded during detection of image {key}"
+        return image
+
+    pipeline = DetectionPipeline(load=load, detect=waiting_detect, prefetch=1)
+    results = asyncio.run(collect(pipeline, range(num_images)))
+    assert [r.key for r in results] == list(range(num_images))
+
+
+@pytest.mark.parametrize("prefetch", [1, 2, 4])
+def test_prefetch_is_bounded_when_consumer_is_slow(prefetch):
+    tracker = Tracker()
+
+    def load(key):
+        tracker.start_load(key)
+        return np.full((1, 1, 1), key)
+
+    def fast_detect(image):
+        tracker.start_detect()
+        return image
+
+    async def consume_slowly():
+        pipeline = DetectionPipeline(load=load, detect=fast_detect, prefetch=prefetch)
+        keys = []
+        async for r in pipeline.run(range(12)):
+            await asyncio.sleep(0.02)
+            # Backpressure: loading gets no further ahead of the consumer than the prefetch allows.
+            assert len(tracker.loaded) <= len(keys) + 1 + prefetch
+            keys.append(r.key)
+        return keys
+
+    assert asyncio.run(consume_slowly()) == list(range(12))
+    assert tracker.max_ahead <= prefetch
+
+
+def test_stopping_early_abandons_remaining_images():
+    tracker = Tracker()
+
+    def load(key):
+        tracker.start_load(key)
+        return np.full((1, 1, 1), key)
+
+    async def take_two():
+        pipeline = DetectionPipeline(load=load, detect=lambda img: img, prefetch=2)
+        taken = []
+        async with aclosing(pipeline.run(range(100))) as results:
+            async for r in results:
+                taken.append(r.key)
+                if len(taken) == 2:
+                    break
+        await asyncio.sleep(0.05)
+        return taken
+
+    assert asyncio.run(take_two()) == [0, 1]
+    assert len(tracker.loaded) <= 2 + 1 + 2
+
+
+@pytest.mark.parametrize("failing_stage", ["load", "detect"])
+def test_error_reaches_consumer(failing_stage):
+    def load(key):
+        if failing_stage == "load" and key == 2:
+            raise OSError("unreadable")
+        return np.full((1, 1, 1), key)
+
+    def checked_detect(image):
+        if failing_stage == "detect" and image.item() == 2:
+            raise RuntimeError("bad image")
+        return image
+
+    pipeline = DetectionPipeline(load=load, detect=checked_detect)
+    received = []
+
+    async def consume():
+        async for r in pipeline.run(range(5)):
+            received.append(r.key)
+
+    with pytest.raises(OSError if failing_stage == "load" else RuntimeError):
+        asyncio.run(consume())
+    assert received == [0, 1]
+
+
+def test_error_from_keys_reaches_consumer():
+    def keys():
+        yield 0
+        raise KeyError("no more")
+
+    pipeline = DetectionPipeline(load=make_image, detect=detect)
+    with pytest.raises(KeyError):
+        asyncio.run(collect(pipeline, keys()))
+
+
+def test_prefetch_must_be_positive():
+    with pytest.raises(ValueError):
+        DetectionPipeline(load=make_image, detect=detect, prefetch=0)
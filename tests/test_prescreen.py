@@ -0,0 +1,211 @@
+"""Tests for coarse pre-screening of images before spot detection"""
+
+from dataclasses import replace
+from functools import partial
+
+import hypothesis as hyp
+import numpy as np
+import numpy.testing as np_test
+import pandas as pd
+import pytest
+from helpers import SYNTHETIC_BACKGROUND, synthetic_spots
+
+from spotfishing import RoiCenterKeys, detect_spots_dog, detect_spots_int
+from spotfishing._tiling import merge_overlapping_regions, transform_regions
+from spotfishing.accuracy import match_spots
+from spotfishing.detection_result import DETECTION_RESULT_TABLE_COLUMNS
+from spotfishing.prescreen import PreScreen, block_max, find_candidate_regions
+from spotfishing_looptrace import ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+detect_dog = partial(
+    detect_spots_dog, transform=ORIGINAL_LOOPTRACE_DOG_SPECIFICATION.transformation
+)
+
+
+@pytest.fixture(scope="module")
+def sparse_spots():
+    """Centers of a handful of spots clustered in a corner, and a large, mostly empty image of them"""
+    return synthetic_spots(
+        (32, 128, 128), num_spots=8, seed=42, spots_region=(16, 48, 48)
+    )
+
+
+@pytest.fixture(scope="module")
+def sparse_spots_image(sparse_spots):
+    _, image = sparse_spots
+    return image
+
+
+@pytest.fixture(scope="module")
+def noisy_sparse_spots():
+    """As the sparse spots, but with noise which dwarfs that of the cleaner image"""
+    return synthetic_spots(
+        (32, 128, 128), num_spots=8, seed=42, spots_region=(16, 48, 48), noise_sd=40
+    )
+
+
+@hyp.given(
+    dims=hyp.strategies.tuples(
+        *(hyp.strategies.integers(min_value=1, max_value=12) for _ in range(3))
+    ),
+    block_shape=hyp.strategies.tuples(
+        *(hyp.strategies.integers(min_value=1, max_value=5) for _ in range(3))
+    ),
+    seed=hyp.strategies.integers(min_value=0, max_value=2**32 - 1),
+)
+def test_block_max_matches_brute_force(dims, block_shape, seed):
+    image = np.random.default_rng(seed).integers(0, 1000, size=dims, dtype=np.uint16)
+    observed = block_max(image, block_shape=block_shape)
+    bz, by, bx = block_shape
+    for (i, j, k), value in np.ndenumerate(observed):
+        block = image[
+            i * bz : (i + 1) * bz, j * by : (j + 1) * by, k * bx : (k + 1) * bx
+        ]
+        assert value == block.max()
+
+
+def test_candidate_regions_cover_every_pixel_above_floor(sparse_spots_image):
+    floor = 300
+    regions = find_candidate_regions(
+        sparse_spots_image, block_shape=(8, 16, 16), signal_floor=floor
+    )
+    covered = np.zeros(sparse_spots_image.shape, dtype=bool)
+    for region in regions:
+        covered[region] = True
+    assert np.all(covered[sparse_spots_image > floor])
+    assert covered.mean() < 0.25
+
+
+def test_piecewise_transformation_matches_whole_image_transformation(
+    sparse_spots_image,
+):
+    transform = replace(
+        ORIGINAL_LOOPTRACE_DOG_SPECIFICATION.transformation, standardise=False
+    )
+    regions = [
+        (slice(0, 16), slice(0, 100), slice(30, 128)),
+        (slice(16, 32), slice(60, 128), slice(0, 128)),
+    ]
+    observed = np.zeros(sparse_spots_image.shape)
+    transform_regions(transform, sparse_spots_image, regions=regions, out=observed)
+    expected = transform(sparse_spots_image)
+    for region in regions:
+        np_test.assert_allclose(observed[region], expected[region])
+
+
+@pytest.mark.parametrize("threshold", [200, 500])
+@pytest.mark.parametrize("expand_px", [None, 1])
+def test_intensity_detection_is_unaffected_by_prescreening(
+    sparse_spots_image, threshold, expand_px
+):
+    plain = detect_spots_int(
+        sparse_spots_image, spot_threshold=threshold, expand_px=expand_px
+    )
+    screened = detect_spots_int(
+        sparse_spots_image,
+        spot_threshold=threshold,
+        expand_px=expand_px,
+        prescreen=PreScreen(block_shape=(4, 16, 16)),
+    )
+    assert plain.table.shape[0] > 0
+    pd.testing.assert_frame_equal(screened.table, plain.table)
+    np_test.assert_array_equal(screened.labels, plain.labels)
+
+
+@pytest.mark.parametrize(
+    ["spots_name", "threshold", "signal_floor"],
+    [
+        ("sparse_spots", 15, SYNTHETIC_BACKGROUND + 50),
+        # A threshold low enough that noise is close to it
+        ("noisy_sparse_spots", 6, SYNTHETIC_BACKGROUND + 200),
+    ],
+)
+def test_dog_detection_with_prescreening_finds_each_spot(
+    request, spots_name, threshold, signal_floor
+):
+    centers, image = request.getfixturevalue(spots_name)
+    screened = detect_dog(
+        image,
+        spot_threshold=threshold,
+        expand_px=None,
+        prescreen=PreScreen(signal_floor=signal_floor),
+    )
+    assert list(screened.table.columns) == DETECTION_RESULT_TABLE_COLUMNS
+    matching = match_spots(
+        centers, screened.table[RoiCenterKeys.to_list()].to_numpy(), max_distance=1
+    )
+    assert matching.recall == matching.precision == 1
+
+
+def test_dog_prescreening_with_noise_finds_same_spots_as_without(noisy_sparse_spots):
+    _, image = noisy_sparse_spots
+    plain = detect_dog(image, spot_threshold=6, expand_px=None)
+    screened = detect_dog(
+        image,
+        spot_threshold=6,
+        expand_px=None,
+        prescreen=PreScreen(signal_floor=SYNTHETIC_BACKGROUND + 200),
+    )
+    assert screened.table.shape[0] == plain.table.shape[0] > 0
+    np_test.assert_allclose(
+        screened.table[RoiCenterKeys.to_list()],
+        plain.table[RoiCenterKeys.to_list()],
+        atol=0.5,
+    )
+
+
+def test_dog_prescreening_standardises_over_candidate_regions(noisy_sparse_spots):
+    _, image = noisy_sparse_spots
+    floor = SYNTHETIC_BACKGROUND + 200
+    screened = detect_dog(
+        image,
+        spot_threshold=6,
+        expand_px=None,
+        prescreen=PreScreen(signal_floor=floor),
+    )
+    regions = merge_overlapping_regions(
+        find_candidate_regions(image, block_shape=(8, 32, 32), signal_floor=floor)
+    )
+    inside = np.zeros(image.shape, dtype=bool)
+    for region in regions:
+        inside[region] = True
+    assert 0 < inside.mean() < 0.5
+    assert np.mean(screened.image[inside]) == pytest.approx(0, abs=1e-9)
+    assert np.std(screened.image[inside]) == pytest.approx(1)
+    assert not np.any(screened.image[~inside])
+
+
+@pytest.mark.parametrize(
+    ["detect", "threshold", "prescreen"],
+    [
+        (detect_dog, 15, PreScreen(signal_floor=SYNTHETIC_BACKGROUND + 50)),
+        (detect_spots_int, 300, PreScreen()),
+    ],
+)
+def test_empty_image_gives_empty_result(detect, threshold, prescreen):
+    rng = np.random.default_rng(0)
+    image = (SYNTHETIC_BACKGROUND + rng.normal(0, 3, size=(32, 256, 256))).astype(
+        np.uint16
+    )
+    result = detect(image, spot_threshold=threshold, expand_px=1, prescreen=prescreen)
+    assert list(result.table.columns) == DETECTION_RESULT_TABLE_COLUMNS
+    assert result.table.shape[0] == 0
+    assert result.image.shape == image.shape
+    assert not np.any(result.labels)
+
+
+def test_dog_prescreening_requires_signal_floor(sparse_spots_image):
+    with pytest.raises(ValueError):
+        detect_dog(
+            sparse_spots_image, spot_threshold=15, expand_px=1, prescreen=PreScreen()
+        )
+
+
+@pytest.mark.parametrize("block_shape", [(8, 8), (0, 8, 8), (8, 2.5, 8)])
+def test_prescreen_rejects_invalid_block_shape(block_shape):
+    with pytest.raises(ValueError):
+        PreScreen(block_shape=block_shape)
@@ -0,0 +1,157 @@
+"""Tests for the sub-pixel refinement of detected spots"""
+
+import numpy as np
+import numpy.testing as np_test
+import pandas as pd
+import pytest
+
+from spotfishing import RoiCenterKeys, detect_spots_int
+from spotfishing.detection_result import DETECTION_RESULT_TABLE_COLUMNS
+from spotfishing.refinement import RefinedSpotKeys, RefinementMethod, refine_spots
+from spotfishing.synthetic import random_spot_centers, render_gaussian_spots
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+SIGMA_Z = 1.5
+SIGMA_XY = 1.2
+BOX_SHAPE = (9, 9, 9)
+
+
+@pytest.fixture(scope="module")
+def spots_image_and_truth():
+    rng = np.random.default_rng(1234)
+    shape = (24, 64, 64)
+    # Place spots on a coarse jittered grid, so that crops don't contain neighbours.
+    grid = np.stack(
+        np.meshgrid([12], np.arange(8, 64, 12), np.arange(8, 64, 12), indexing="ij"),
+        axis=-1,
+    ).reshape(-1, 3)
+    centers = grid + rng.uniform(-0.5, 0.5, size=grid.shape)
+    image = render_gaussian_spots(
+        shape,
+        centers=centers,
+        sigma_z=SIGMA_Z,
+        sigma_xy=SIGMA_XY,
+        amplitudes=1000,
+        background=100,
+        noise_sd=5,
+        rng=rng,
+    )
+    return image, centers
+
+
+def build_table(centers) -> pd.DataFrame:
+    return pd.DataFrame(
+        [(*c, 1.0, 1.0) for c in centers], columns=DETECTION_RESULT_TABLE_COLUMNS
+    )
+
+
+@pytest.mark.parametrize(
+    ["method", "max_center_error"],
+    [(RefinementMethod.GAUSSIAN_FIT, 0.1), (RefinementMethod.MOMENTS, 0.5)],
+)
+def test_refined_centers_are_close_to_truth(
+    spots_image_and_truth, method, max_center_error
+):
+    image, truth = spots_image_and_truth
+    # Start from whole-pixel guesses, as detection would give.
+    observed = refine_spots(
+        build_table(np.round(truth)), image=image, box_shape=BOX_SHAPE, method=method
+    )
+    assert observed[RefinedSpotKeys.SUCCESS.value].all()
+    fitted = observed[
+        [RefinedSpotKeys.Z.value, RefinedSpotKeys.Y.value, RefinedSpotKeys.X.value]
+    ].to_numpy()
+    assert np.max(np.abs(fitted - truth)) < max_center_error
+
+
+def test_gaussian_fit_recovers_spread_amplitude_and_background(spots_image_and_truth):
+    image, truth = spots_image_and_truth
+    observed = refine_spots(
+        build_table(np.round(truth)), image=image, box_shape=BOX_SHAPE
+    )
+    np_test.assert_allclose(observed[RefinedSpotKeys.SIGMA_Z.value], SIGMA_Z, rtol=0.1)
+    np_test.assert_allclose(
+        observed[RefinedSpotKeys.SIGMA_XY.value], SIGMA_XY, rtol=0.1
+    )
+    np_test.assert_allclose(observed[RefinedSpotKeys.AMPLITUDE.value], 1000, rtol=0.1)
+    np_test.assert_allclose(observed[RefinedSpotKeys.BACKGROUND.value], 100, atol=10)
+
+
+def test_batching_does_not_affect_result(spots_image_and_truth):
+    image, truth = spots_image_and_truth
+    table = build_table(np.round(truth))
+    all_at_once = refine_spots(table, image=image, box_shape=BOX_SHAPE)
+    in_batches = refine_spots(
+        table, image=image, box_shape=BOX_SHAPE, spots_per_batch=3
+    )
+    pd.testing.assert_frame_equal(all_at_once, in_batches)
+
+
+def test_refinement_of_detection_result_preserves_table_and_adds_columns(
+    spots_image_and_truth,
+):
+    image, _ = spots_image_and_truth
+    result = detect_spots_int(image, spot_threshold=500, expand_px=None)
+    observed = refine_spots(result, image=image, box_shape=BOX_SHAPE)
+    assert list(observed.columns) == (
+        DETECTION_RESULT_TABLE_COLUMNS + RefinedSpotKeys.to_list()
+    )
+    pd.testing.assert_frame_equal(
+        observed[DETECTION_RESULT_TABLE_COLUMNS], result.table
+    )
+    detected = result.table[RoiCenterKeys.to_list()].to_numpy()
+    fitted = observed[
+        [RefinedSpotKeys.Z.value, RefinedSpotKeys.Y.value, RefinedSpotKeys.X.value]
+    ].to_numpy()
+    assert np.max(np.abs(fitted - detected)) < 1
+
+
+def test_refinement_of_empty_table():
+    observed = refine_spots(
+        build_table([]), image=np.zeros((5, 5, 5), dtype=np.uint16), box_shape=(3, 3, 3)
+    )
+    assert list(observed.columns) == (
+        DETECTION_RESULT_TABLE_COLUMNS + RefinedSpotKeys.to_list()
+    )
+    assert observed.shape[0] == 0
+
+
+def test_spot_near_border_is_fit_from_valid_part_of_crop():
+    shape = (12, 20, 20)
+    center = np.array([[1.2, 10.3, 9.8]])
+    image = render_gaussian_spots(
+        shape, centers=center, sigma_z=SIGMA_Z, sigma_xy=SIGMA_XY, amplitudes=1000
+    )
+    observed = refine_spots(
+        build_table(np.round(center)), image=image, box_shape=BOX_SHAPE
+    )
+    fitted = observed[
+        [RefinedSpotKeys.Z.value, RefinedSpotKeys.Y.value, RefinedSpotKeys.X.value]
+    ].to_numpy()
+    np_test.assert_allclose(fitted, center, atol=0.05)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [dict(box_shape=(0, 3, 3)), dict(spots_per_batch=0), dict(spots_per_batch=-1)],
+)
+def test_invalid_options_are_rejected(kwargs):
+    kwargs = dict(box_shape=(3, 3, 3)) | kwargs
+    with pytest.raises(ValueError):
+        refine_spots(
+            build_table([(1.0, 1.0, 1.0)]),
+            image=np.zeros((3, 3, 3), dtype=np.uint16),
+            **kwargs,
+        )
+
+
+def test_random_spot_centers_respect_margin():
+    centers = random_spot_centers(
+        (10, 20, 30), num_spots=100, margin=(2, 3, 4), rng=np.random.default_rng(0)
+    )
+    assert centers.shape == (100, 3)
+    assert np.all(centers >= [2, 3, 4])
+    assert np.all(centers <= [7, 16, 25])
@@ -0,0 +1,83 @@
+"""Tests for the tools for working with spot/ROI centroids"""
+
+import hypothesis as hyp
+import numpy as np
+import numpy.testing as np_test
+import pandas as pd
+import pytest
+from gertils.geometry import ImagePoint3D
+
+from spotfishing import DetectionResult, DimensionalityError, RoiCenterKeys
+from spotfishing.detection_result import DETECTION_RESULT_TABLE_COLUMNS
+from spotfishing.roi_tools import (
+    RoiCentroids,
+    get_centroid_from_record,
+    get_centroids_array,
+    get_centroids_from_table,
+)
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+gen_coordinate = hyp.strategies.floats(
+    min_value=0, max_value=1000, allow_nan=False, allow_infinity=False
+)
+gen_coordinates = hyp.strategies.lists(
+    hyp.strategies.tuples(gen_coordinate, gen_coordinate, gen_coordinate),
+    max_size=50,
+)
+
+
+def build_table(coordinates: list[tuple[float, float, float]]) -> pd.DataFrame:
+    return pd.DataFrame(
+        [(*zyx, 1.0, 100.0) for zyx in coordinates],
+        columns=DETECTION_RESULT_TABLE_COLUMNS,
+    )
+
+
+@hyp.given(coordinates=gen_coordinates)
+def test_centroids_array_matches_record_by_record_extraction(coordinates):
+    table = build_table(coordinates)
+    observed = get_centroids_array(table)
+    assert observed.shape == (len(coordinates), 3)
+    expected = [
+        (pt.z, pt.y, pt.x)
+        for pt in (get_centroid_from_record(row) for _, row in table.iterrows())
+    ]
+    np_test.assert_array_equal(observed, np.array(expected).reshape(-1, 3))
+
+
+@hyp.given(coordinates=gen_coordinates)
+def test_centroid_collection_views_match_record_by_record_extraction(coordinates):
+    table = build_table(coordinates)
+    centroids = get_centroids_from_table(table)
+    expected = [get_centroid_from_record(row) for _, row in table.iterrows()]
+    assert len(centroids) == len(expected)
+    assert list(centroids) == expected
+    assert [centroids[i] for i in range(len(centroids))] == expected
+
+
+def test_centroids_can_be_taken_from_detection_result():
+    table = build_table([(1.0, 2.0, 3.0), (4.0, 5.0, 6.0)])
+    result = DetectionResult(
+        table=table,
+        image=np.zeros((2, 2, 2)),
+        labels=np.zeros((2, 2, 2), dtype=np.int32),
+    )
+    np_test.assert_array_equal(
+        get_centroids_array(result), np.array([[1, 2, 3], [4, 5, 6]])
+    )
+    assert get_centroids_from_table(result)[1] == ImagePoint3D(z=4.0, y=5.0, x=6.0)
+
+
+def test_centroids_array_requires_coordinate_columns():
+    table = build_table([(1.0, 2.0, 3.0)]).drop(columns=[RoiCenterKeys.Y.value])
+    with pytest.raises(KeyError):
+        get_centroids_array(table)
+
+
+@pytest.mark.parametrize("shape", [(3,), (2, 2), (2, 3, 1)])
+def test_centroid_collection_requires_n_by_3_array(shape):
+    with pytest.raises(DimensionalityError):
+        RoiCentroids(coordinates=np.zeros(shape))
@@ -0,0 +1,154 @@
+"""Tests for DoG spot detection at several scales"""
+
+from functools import partial
+
+import numpy as np
+import numpy.testing as np_test
+import pandas as pd
+import pytest
+
+from spotfishing import ROI_SCALE_KEY, DetectionResult, RoiCenterKeys, detect_spots_dog
+from spotfishing.accuracy import match_spots
+from spotfishing.detection_result import DETECTION_RESULT_TABLE_COLUMNS
+from spotfishing.scale_space import ScaleSpaceTransformation, detect_spots_multiscale
+from spotfishing.synthetic import random_spot_centers, render_gaussian_spots
+from spotfishing_looptrace import ORIGINAL_LOOPTRACE_DOG_SPECIFICATION
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+SHAPE = (16, 128, 128)
+
+SIGMAS = (0.8, 1.3, 2.0, 3.0)
+
+build_scale_space = partial(
+    ScaleSpaceTransformation.from_transformation,
+    ORIGINAL_LOOPTRACE_DOG_SPECIFICATION.transformation,
+    sigmas=SIGMAS,
+)
+
+
+@pytest.fixture(scope="module")
+def image():
+    """Image of small spots and of large spots"""
+    rng = np.random.default_rng(3)
+    centers = random_spot_centers(SHAPE, num_spots=50, margin=(4, 8, 8), rng=rng)
+    small = render_gaussian_spots(
+        SHAPE, centers=centers[:25], sigma_z=1.2, sigma_xy=1.0, amplitudes=1000
+    )
+    large = render_gaussian_spots(
+        SHAPE, centers=centers[25:], sigma_z=2.5, sigma_xy=2.5, amplitudes=600
+    )
+    noise = rng.normal(100, 3, size=SHAPE)
+    return np.clip(small + large + noise, 0, None).astype(np.uint16)
+
+
+@pytest.mark.parametrize("pairs", [None, [(0, 2), (1, 3)], [(2, 3), (0, 1), (0, 3)]])
+def test_each_scale_matches_single_scale_transformation(image, pairs):
+    transform = build_scale_space(pairs=pairs)
+    observed = transform(image)
+    assert len(observed) == len(transform.scales)
+    for i, img in enumerate(observed):
+        expected = transform.single_scale(i)(image)
+        assert (expected.ndim, expected.shape) == (img.ndim, img.shape)
+        # Blurring level by level differs from blurring from scratch only by the sampling of the kernels.
+        np_test.assert_allclose(img, expected, atol=5e-3 * np.abs(expected).max())
+
+
+def test_batched_post_difference_step_matches_per_scale(image):
+    per_scale = build_scale_space()(image)
+    batched = build_scale_space(batch_post_diff=True)(image)
+    for expected, observed in zip(per_scale, batched):
+        np_test.assert_allclose(observed, expected)
+
+
+def test_default_pairs_are_adjacent_sigmas():
+    transform = build_scale_space()
+    assert transform.scale_pairs == ((0, 1), (1, 2), (2, 3))
+    assert transform.scales == ((0.8, 1.3), (1.3, 2.0), (2.0, 3.0))
+
+
+def test_detection_at_each_scale_matches_single_scale_detection(image):
+    transform = build_scale_space()
+    result = detect_spots_multiscale(
+        image, spot_threshold=10, expand_px=1, transform=transform
+    )
+    for i, observed in enumerate(result.results):
+        expected = detect_spots_dog(
+            image,
+            spot_threshold=10,
+            expand_px=1,
+            transform=transform.single_scale(i),
+        )
+        assert expected.table.shape[0] > 0
+        matching = match_spots(
+            expected.table[RoiCenterKeys.to_list()].to_numpy(),
+            observed.table[RoiCenterKeys.to_list()].to_numpy(),
+            max_distance=1,
+        )
+        assert matching.recall >= 0.95 and matching.precision >= 0.95
+
+
+def test_merged_table_tags_spots_with_scale(image):
+    result = detect_spots_multiscale(
+        image, spot_threshold=[10, 10, 8], expand_px=1, transform=build_scale_space()
+    )
+    table = result.merged_table()
+    assert list(table.columns) == DETECTION_RESULT_TABLE_COLUMNS + [ROI_SCALE_KEY]
+    assert table.shape[0] == sum(r.table.shape[0] for r in result.results)
+    for i, r in enumerate(result.results):
+        pd.testing.assert_frame_equal(
+            table[table[ROI_SCALE_KEY] == i]
+            .drop(columns=ROI_SCALE_KEY)
+            .reset_index(drop=True),
+            r.table,
+            check_dtype=False,
+        )
+    # The merged table is a legal detection result table.
+    DetectionResult(
+        table=table, image=result.results[0].image, labels=result.results[0].labels
+    )
+    deduplicated = result.merged_table(min_distance=2)
+    assert 0 < deduplicated.shape[0] < table.shape[0]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(sigmas=(1.0,)),
+        dict(sigmas=(0, 1.0)),
+        dict(sigmas=(1.0, 1.0, 2.0)),
+        dict(sigmas=(2.0, 1.0)),
+        dict(pairs=[]),
+        dict(pairs=[(1, 0)]),
+        dict(pairs=[(0, 4)]),
+        dict(pairs=[(0, 1, 2)]),
+        dict(pairs=[(0, 1), (0, 1)]),
+    ],
+)
+def test_invalid_scale_space_is_rejected(kwargs):
+    with pytest.raises(ValueError):
+        build_scale_space(**kwargs)
+
+
+def test_non_numeric_sigma_is_rejected():
+    with pytest.raises(TypeError):
+        build_scale_space(sigmas=(1.0, "2"))
+
+
+def test_thresholds_must_match_scales(image):
+    with pytest.raises(ValueError):
+        detect_spots_multiscale(
+            image, spot_threshold=[10, 10], expand_px=1, transform=build_scale_space()
+        )
+
+
+def test_transformation_must_be_scale_space(image):
+    with pytest.raises(TypeError):
+        detect_spots_multiscale(
+            image,
+            spot_threshold=10,
+            expand_px=1,
+            transform=ORIGINAL_LOOPTRACE_DOG_SPECIFICATION.transformation,
+        )
@@ -0,0 +1,171 @@
+"""Tests for the spatial index over detected spots"""
+
+import hypothesis as hyp
+import numpy as np
+import numpy.testing as np_test
+import pandas as pd
+import pytest
+
+from spotfishing import (
+    ROI_AREA_KEY,
+    ROI_MEAN_INTENSITY_KEY_CAMEL_CASE,
+    ROI_REGION_ID_KEY,
+    ROI_SCALE_KEY,
+)
+from spotfishing.detection_result import DETECTION_RESULT_TABLE_COLUMNS
+from spotfishing.spatial_index import (
+    DeduplicationStrategy,
+    SpotSpatialIndex,
+    deduplicate_spots,
+)
+
+__author__ = "Vince Reuter"
+__credits__ = ["Vince Reuter"]
+
+
+gen_points = hyp.strategies.integers(min_value=0, max_value=40).flatmap(
+    lambda n: hyp.strategies.builds(
+        lambda seed: np.random.default_rng(seed).uniform(0, 20, size=(n, 3)),
+        hyp.strategies.integers(min_value=0, max_value=2**32 - 1),
+    )
+)
+gen_voxel_size = hyp.strategies.tuples(
+    *(hyp.strategies.sampled_from([0.5, 1.0, 3.0]) for _ in range(3))
+)
+
+
+def build_table(rows: list[tuple[float, float, float, float, float]]) -> pd.DataFrame:
+    return pd.DataFrame(rows, columns=DETECTION_RESULT_TABLE_COLUMNS)
+
+
+def brute_force_distances(points, voxel_size):
+    scaled = points * np.array(voxel_size)
+    return np.linalg.norm(scaled[:, None, :] - scaled[None, :, :], axis=-1)
+
+
+@hyp.given(points=gen_points, voxel_size=gen_voxel_size)
+def test_radius_query_matches_brute_force(points, voxel_size):
+    radius = 5.0
+    index = SpotSpatialIndex(coordinates=points, voxel_size=voxel_size)
+    dists = brute_force_distances(points, voxel_size)
+    observed = index.query_radius(points, radius)
+    expected = [np.flatnonzero(row <= radius) for row in dists]
+    assert len(observed) == len(expected)
+    for obs, exp in zip(observed, expected):
+        np_test.assert_array_equal(obs, exp)
+
+
+@hyp.given(points=gen_points, voxel_size=gen_voxel_size)
+def test_pairs_match_brute_force(points, voxel_size):
+    radius = 4.0
+    index = SpotSpatialIndex(coordinates=points, voxel_size=voxel_size)
+    dists = brute_force_distances(points, voxel_size)
+    expected = {
+        (i, j)
+        for i in range(len(points))
+        for j in range(i + 1, len(points))
+        if dists[i, j] <= radius
+    }
+    assert set(map(tuple, index.pairs_within(radius).tolist())) == expected
+
+
+def test_nearest_neighbour_query_accounts_for_anisotropy():
+    points = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 2.0]])
+    query = np.array([[0.0, 0.0, 0.0]])
+    _, isotropic = SpotSpatialIndex(coordinates=points).query_nearest(query, k=3)
+    np_test.assert_array_equal(isotropic, [[0, 1, 2]])
+    dists, anisotropic = SpotSpatialIndex(
+        coordinates=points, voxel_size=(3, 1, 1)
+    ).query_nearest(query, k=3)
+    np_test.assert_array_equal(anisotropic, [[0, 2, 1]])
+    np_test.assert_allclose(dists, [[0.0, 2.0, 3.0]])
+
+
+def test_groups_follow_chains_of_proximity_and_order_of_first_appearance():
+    points = np.array(
+        [[0.0, 0.0, 10.0], [0.0, 0.0, 0.0], [0.0, 0.0, 1.5], [0.0, 0.0, 3.0]]
+    )
+    groups = SpotSpatialIndex(coordinates=points).groups_within(1.6)
+    np_test.assert_array_equal(groups, [0, 1, 1, 1])
+
+
+@pytest.mark.parametrize(
+    ["strategy", "expected_rows"],
+    [
+        (
+            DeduplicationStrategy.KEEP_FIRST,
+            [(0.0, 0.0, 0.0, 1.0, 100.0), (0.0, 0.0, 20.0, 2.0, 50.0)],
+        ),
+        (
+            DeduplicationStrategy.KEEP_BRIGHTEST,
+            [(0.0, 0.0, 1.0, 3.0, 300.0), (0.0, 0.0, 20.0, 2.0, 50.0)],
+        ),
+        (
+            DeduplicationStrategy.MERGE,
+            [(0.0, 0.0, 0.75, 4.0, 250.0), (0.0, 0.0, 20.0, 2.0, 50.0)],
+        ),
+    ],
+)
+def test_deduplication_strategies(strategy, expected_rows):
+    table = build_table(
+        [
+            (0.0, 0.0, 0.0, 1.0, 100.0),
+            (0.0, 0.0, 20.0, 2.0, 50.0),
+            (0.0, 0.0, 1.0, 3.0, 300.0),
+        ]
+    )
+    observed = deduplicate_spots(table, min_distance=2, strategy=strategy)
+    expected = build_table(expected_rows)
+    pd.testing.assert_frame_equal(observed, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("strategy", list(DeduplicationStrategy))
+def test_deduplication_keeps_optional_columns(strategy):
+    table = build_table(
+        [
+            (0.0, 0.0, 0.0, 1.0, 100.0),
+            (0.0, 0.0, 20.0, 2.0, 50.0),
+            (0.0, 0.0, 1.0, 3.0, 300.0),
+        ]
+    ).assign(**{ROI_REGION_ID_KEY: [4, 5, 6], ROI_SCALE_KEY: [0, 1, 2]})
+    observed = deduplicate_spots(table, min_distance=2, strategy=strategy)
+    assert list(observed.columns) == list(table.columns)
+    first_ids = [4, 5] if strategy == DeduplicationStrategy.KEEP_FIRST else [6, 5]
+    assert observed[ROI_REGION_ID_KEY].tolist() == first_ids
+    assert observed[ROI_SCALE_KEY].tolist() == [i - 4 for i in first_ids]
+
+
+@pytest.mark.parametrize("strategy", list(DeduplicationStrategy))
+def test_deduplication_of_empty_table_is_empty(strategy):
+    table = build_table([])
+    observed = deduplicate_spots(table, min_distance=2, strategy=strategy)
+    assert list(observed.columns) == DETECTION_RESULT_TABLE_COLUMNS
+    assert observed.shape[0] == 0
+
+
+@hyp.given(points=gen_points)
+def test_deduplicated_spots_are_pairwise_separated(points):
+    n = len(points)
+    table = build_table([(*p, 1.0, float(i)) for i, p in enumerate(points.tolist())])
+    min_distance = 3.0
+    observed = deduplicate_spots(
+        table, min_distance=min_distance, strategy=DeduplicationStrategy.KEEP_FIRST
+    )
+    kept = observed[["zc", "yc", "xc"]].to_numpy()
+    dists = brute_force_distances(kept, (1, 1, 1))
+    assert np.all(dists[np.triu_indices(len(kept), k=1)] > min_distance)
+    assert observed[ROI_AREA_KEY].sum() <= n
+    assert set(observed[ROI_MEAN_INTENSITY_KEY_CAMEL_CASE]) <= set(range(n))
+
+
+@pytest.mark.parametrize("voxel_size", [(1, 1), (0, 1, 1), (1, -1, 1)])
+def test_index_rejects_invalid_voxel_size(voxel_size):
+    with pytest.raises(ValueError):
+        SpotSpatialIndex(coordinates=np.zeros((1, 3)), voxel_size=voxel_size)
+
+
+@pytest.mark.parametrize("k", [0, -1])
+def test_nearest_query_rejects_too_few_neighbours(k):
+    index = SpotSpatialIndex(coordinates=np.zeros((2, 3)))
+    with pytest.raises(ValueError):
+        index.query_nearest(np.zeros((1, 3)), k=k)